@@ -1,15 +1,23 @@
 import asyncio
 import aio_pika
 
+from src.base_image import BaseImageManager
+from src.build_pool import BuildWorkerPool
+from src.concurrency import AdaptiveConcurrency
 from src.docker import Docker
+from src.job_store import JobStore
 from src.logger import get_logger
 from src.message_handlers.kill_build import kill_build_command_handler
 from src.message_handlers.ping import ping_command_handler
-from src.message_handlers.build import build_command_handler
+from src.message_handlers.build import build_command_handler, run_build_job
 from src.message_handlers.status import status_command_handler
 from src.message_handler import MessageHandler
 from src.rabbitmq import RabbitMQ
+from src.routes.metrics import handle_metrics
 from src.routes.status import handle_status
+from src.scheduler import BuildScheduler
+from src.single_flight import BuildSingleFlight
+from src.stage_limits import StageLimits
 from src.states import StateManager
 from src.storage import MinioClient
 from src.webserver import Webserver
@@ -22,6 +30,45 @@ loop = asyncio.get_event_loop()
 async def main(loop):
 
 
+    # ----------------------
+    # State Manager
+    # ----------------------
+    job_store = None
+    if env.JOB_STORE_ENABLED:
+        job_store = JobStore(env.JOB_STORE_PATH, retention=env.JOB_STORE_RETENTION_DAYS * 24 * 3600)
+        job_store.open()
+    state_manager = StateManager(
+        compact_after=env.JOB_COMPACT_AFTER,
+        max_jobs=env.JOB_HISTORY_MAX,
+        store=job_store
+    )
+    orphaned = state_manager.restore() if job_store is not None else []
+
+
+    # ----------------------
+    # Build workers
+    # ----------------------
+    # forked by a forkserver, so the workers don't inherit the connections of this process
+    # sized for the most builds the adaptive concurrency may run at once
+    build_workers = env.CONCURRENCY_MAX if env.CONCURRENCY_ADAPTIVE else env.BUILD_WORKERS
+    build_pool = BuildWorkerPool(
+        size=build_workers,
+        job_fn=run_build_job,
+        state_manager=state_manager,
+        scheduler=BuildScheduler(
+            max_running=min(env.CONCURRENCY_INITIAL, build_workers) if env.CONCURRENCY_ADAPTIVE else env.BUILD_MAX_RUNNING,
+            debounce=env.BUILD_DEBOUNCE_WINDOW if env.BUILD_DEBOUNCE else None
+        ),
+        stage_limits=StageLimits({
+            "download": env.STAGE_LIMIT_DOWNLOAD,
+            "build": env.STAGE_LIMIT_BUILD,
+            "push": env.STAGE_LIMIT_PUSH,
+        }),
+        preempt_superseded=env.BUILD_DEBOUNCE_PREEMPT
+    )
+    build_pool.start(loop)
+
+
     # ---------------------- 
     # RabbitMQ
     # ---------------------- 
@@ -48,6 +95,13 @@ async def main(loop):
     # ----------------------
     # Storage
     # ----------------------
+    MinioClient.configure_pool(
+        max_workers=env.STORAGE_MAX_WORKERS,
+        max_connections=env.STORAGE_MAX_CONNECTIONS,
+        range_threshold=env.STORAGE_RANGE_THRESHOLD,
+        range_chunk_size=env.STORAGE_RANGE_CHUNK_SIZE,
+        range_fanout=env.STORAGE_RANGE_FANOUT
+    )
     storage = MinioClient(
         endpoint=env.MINIO_ADDRESS+ ":" + str(env.MINIO_PORT),
         access_key=env.MINIO_USERNAME,
@@ -80,6 +134,31 @@ async def main(loop):
         logger.error("docker connection failed")
         logger.error(e)
         exit(1)
+
+    if env.CONCURRENCY_ADAPTIVE:
+        AdaptiveConcurrency(
+            build_pool,
+            docker,
+            upload_folder=env.DEFAULT_UPLOAD_FOLDER,
+            min_limit=env.CONCURRENCY_MIN,
+            max_limit=env.CONCURRENCY_MAX,
+            interval=env.CONCURRENCY_INTERVAL,
+            cpu_pressure_max=env.CONCURRENCY_CPU_PRESSURE_MAX,
+            io_pressure_max=env.CONCURRENCY_IO_PRESSURE_MAX,
+            docker_latency_max=env.CONCURRENCY_DOCKER_LATENCY_MAX,
+            min_free_disk=env.CONCURRENCY_MIN_FREE_DISK
+        ).start(loop)
+
+    if env.BASE_IMAGE_ENABLED:
+        try:
+            base_images = BaseImageManager(docker, env.BASE_IMAGE_LOCK, env.BASE_IMAGE_NAME)
+            base = await asyncio.to_thread(base_images.ensure, env.DEFAULT_TEAM_BUILD_DOCKERFILE)
+            if base is not None:
+                logger.info(f"base image {base[0]} ready")
+        except Exception as e:
+            # the builds retry it on demand
+            logger.error("base image preparation failed")
+            logger.error(e)
     
     
     # ----------------------
@@ -92,6 +171,7 @@ async def main(loop):
     
     # --- routes
     server.add_get('/status', handle_status)
+    server.add_get('/metrics', handle_metrics)
     try:
         await server.listen()
         logger.info("webserver connected")
@@ -101,12 +181,6 @@ async def main(loop):
         exit(1)
     
 
-    # ----------------------
-    # State Manager
-    # ----------------------
-    state_manager = StateManager()
-
-
     # ----------------------
     
     # --- add message handler
@@ -115,7 +189,9 @@ async def main(loop):
         storage=storage,
         docker=docker,
         server=server,
-        state_manager=state_manager
+        state_manager=state_manager,
+        build_pool=build_pool,
+        single_flight=BuildSingleFlight(state_manager) if env.BUILD_SINGLE_FLIGHT else None
     )
     
     mh.add_command_handler("build", build_command_handler)
@@ -127,14 +203,33 @@ async def main(loop):
     
     await rabbit.add_message_handler(mh.message_processor)
 
+    # builds interrupted by the last stop
+    if env.JOB_REQUEUE_ORPHANED:
+        for job in orphaned:
+            logger.info(f"requeueing orphaned build {job.build_id}")
+            reply = MessageHandler.reply_wrapper(rabbit, job.reply_to) if job.reply_to else MessageHandler.empty_reply
+            loop.create_task(build_command_handler(
+                data=job.data,
+                reply=reply,
+                state_manager=state_manager,
+                build_pool=build_pool,
+                reply_to=job.reply_to
+            ))
+
+    return job_store
+
 
 
 if __name__ == "__main__":
+    job_store = None
     try:
-        loop.run_until_complete(main(loop))
+        job_store = loop.run_until_complete(main(loop))
         loop.run_forever()
     except KeyboardInterrupt:
         pass
     finally:
         loop.run_until_complete(loop.shutdown_asyncgens())
         loop.close()
+        if job_store is not None:
+            # write the changes still queued
+            job_store.close()
@@ -0,0 +1,191 @@
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from src import metrics
+from src.logger import get_logger
+
+logger = get_logger(__name__)
+
+READ_SIZE = 1024 * 1024
+# leftovers of inserts that never finished, e.g. after a worker crash
+STALE_TMP_AGE = 24 * 60 * 60
+
+
+class _TeeReader:
+    """Reader copying everything read from `reader` into a cache insert"""
+
+    def __init__(self, cache, reader, key):
+        self.cache = cache
+        self.reader = reader
+        self.key = key
+        fd, self.tmp_path = tempfile.mkstemp(dir=cache.root, prefix=".tmp-")
+        self.out = os.fdopen(fd, "wb")
+        self.committed = False
+
+    def read(self, n=-1):
+        data = self.reader.read(n)
+        if data:
+            self.out.write(data)
+        return data
+
+    def commit(self):
+        """Read the rest of the source and insert the copy in the cache"""
+        while self.read(READ_SIZE):
+            pass
+        self.out.close()
+        self.cache._insert(self.tmp_path, self.key)
+        self.committed = True
+
+    def close(self):
+        self.reader.close()
+        if not self.committed:
+            self.out.close()
+            os.unlink(self.tmp_path)
+
+    def release_conn(self):
+        if hasattr(self.reader, "release_conn"):
+            self.reader.release_conn()
+
+
+class ArchiveCache:
+    """Node local LRU cache of downloaded team archives
+
+    Entries are keyed by (bucket, object, etag), so a re-uploaded archive
+    never hits a stale entry. Inserts are written to a temporary file and
+    renamed into place, and eviction runs under a file lock, so the build
+    workers of all processes can share the same cache folder.
+    """
+
+    def __init__(self, root, max_bytes):
+        """
+        Args:
+            root (str): folder of the cache
+            max_bytes (int): byte budget, least recently used archives are evicted beyond it
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(self.root, exist_ok=True)
+
+    @staticmethod
+    def _key(bucket_name, object_name, etag):
+        return hashlib.sha256(f"{bucket_name}/{object_name}/{etag}".encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, f"{key}.tar.gz")
+
+    def get(self, bucket_name, object_name, etag):
+        """Get the cached archive of an object
+
+        Returns:
+            str: path of the cached archive if found, else None
+        """
+        path = self._path(self._key(bucket_name, object_name, etag))
+        try:
+            # the modification time is the LRU clock
+            os.utime(path)
+        except FileNotFoundError:
+            metrics.incr("archive_cache_misses")
+            return None
+        metrics.incr("archive_cache_hits")
+        return path
+
+    def link(self, bucket_name, object_name, etag, file_path):
+        """Put the cached archive of an object at file_path
+
+        The archive is hard linked when possible, so an eviction while the
+        build is running does not pull the file from under it.
+
+        Returns:
+            bool: True on a cache hit
+        """
+        path = self.get(bucket_name, object_name, etag)
+        if path is None:
+            return False
+        try:
+            os.link(path, file_path)
+        except FileNotFoundError:
+            # evicted in between
+            return False
+        except OSError:
+            shutil.copyfile(path, file_path)
+        return True
+
+    def open(self, bucket_name, object_name, etag):
+        """Open the cached archive of an object
+
+        The open file stays readable when the archive is evicted meanwhile.
+
+        Returns:
+            file: the archive opened for reading on a cache hit, else None
+        """
+        path = self.get(bucket_name, object_name, etag)
+        if path is None:
+            return None
+        try:
+            return open(path, "rb")
+        except FileNotFoundError:
+            # evicted in between
+            return None
+
+    def insert(self, bucket_name, object_name, etag, file_path):
+        """Add a downloaded archive to the cache
+
+        Args:
+            file_path (str): path of the downloaded archive, left in place
+        """
+        tmp_path = os.path.join(self.root, f".tmp-{uuid.uuid4().hex}")
+        try:
+            os.link(file_path, tmp_path)
+        except OSError:
+            shutil.copyfile(file_path, tmp_path)
+        self._insert(tmp_path, self._key(bucket_name, object_name, etag))
+
+    def tee(self, bucket_name, object_name, etag, reader):
+        """Wrap a reader of an object so what is read gets cached
+
+        The returned reader must be committed once the consumer is done.
+        Closing it without a commit drops the partial copy.
+        """
+        return _TeeReader(self, reader, self._key(bucket_name, object_name, etag))
+
+    def _insert(self, tmp_path, key):
+        with self._locked():
+            os.replace(tmp_path, self._path(key))
+            self._evict()
+
+    def _locked(self):
+        lock_file = open(os.path.join(self.root, ".lock"), "w")
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def _evict(self):
+        entries = []
+        total = 0
+        now = time.time()
+        for entry in os.scandir(self.root):
+            if entry.name.startswith(".tmp-"):
+                if now - entry.stat().st_mtime > STALE_TMP_AGE:
+                    os.unlink(entry.path)
+                continue
+            if not entry.name.endswith(".tar.gz"):
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                continue
+            total -= size
+            metrics.incr("archive_cache_evictions")
+            logger.info(f"Evicted {path} from the archive cache")
+        metrics.set_gauge("archive_cache_bytes", total)
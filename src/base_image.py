@@ -0,0 +1,129 @@
+import fcntl
+import hashlib
+import io
+import json
+import os
+import re
+import tarfile
+import threading
+from src.docker import Docker
+from src.logger import get_logger
+
+logger = get_logger(__name__)
+
+# the instruction copying the team files, everything above it is team independent
+COPY_BIN = re.compile(r"^\s*COPY\s+(--\S+\s+)*bin\b", re.IGNORECASE)
+FROM = re.compile(r"^\s*FROM\s", re.IGNORECASE)
+
+
+class BaseImageManager:
+    """Shared "team runtime base" images of the team Dockerfiles
+
+    A team Dockerfile is split at its `COPY bin` instruction. The part above
+    it does not depend on the team, so it is built once into a base image
+    tagged with its hash and pushed to the registry, and team builds use a
+    derived Dockerfile starting `FROM` that base, so only the layers from the
+    copy on are built per team. A base is only rebuilt when the part above
+    the copy changes.
+
+    Build workers share the base images through the docker daemon and the
+    registry; a file lock keeps them from building the same base at once.
+    """
+
+    def __init__(self, docker: Docker, lock_path, image_name="team-runtime-base"):
+        """
+        Args:
+            docker (Docker): docker client of the registry the base is pushed to
+            lock_path (str): lock file shared by the processes building bases
+            image_name (str, optional): name of the base images
+        """
+        self.docker = docker
+        self.lock_path = lock_path
+        self.image_name = image_name
+        self._ready = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def split(dockerfile):
+        """Split a Dockerfile at its `COPY bin` instruction
+
+        Returns:
+            tuple[str, str]: base part and team part, None if the Dockerfile can't be split
+        """
+        lines = dockerfile.splitlines(keepends=True)
+        froms = [i for i, line in enumerate(lines) if FROM.match(line)]
+        # multi-stage Dockerfiles are built as they are
+        if len(froms) != 1:
+            return None
+        for i, line in enumerate(lines):
+            if COPY_BIN.match(line):
+                if froms[0] > i:
+                    return None
+                return "".join(lines[:i]), "".join(lines[i:])
+        return None
+
+    def ensure(self, dockerfile_path):
+        """Make sure the base image of a Dockerfile exists, building it if needed
+
+        Blocking, run it in a thread.
+
+        Args:
+            dockerfile_path (str): path of the team Dockerfile
+
+        Returns:
+            tuple[str, str]: reference of the base image and the derived Dockerfile, None if the Dockerfile has no base
+        """
+        with open(dockerfile_path) as f:
+            parts = self.split(f.read())
+        if parts is None:
+            return None
+        base, rest = parts
+        tag = hashlib.sha256(base.encode()).hexdigest()[:12]
+        ref = f"{self.docker.default_registry}/{self.image_name}:{tag}"
+
+        with self._lock:
+            if ref not in self._ready:
+                os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+                with open(self.lock_path, "w") as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    if not self._present(ref, tag):
+                        self._build(base, tag)
+                self._ready.add(ref)
+        return ref, f"FROM {ref}\n{rest}"
+
+    def _present(self, ref, tag):
+        local = self.docker.has_image(ref)
+        remote = self.docker.registry_digest(self.image_name, tag) is not None
+        if local and not remote:
+            logger.info(f"Pushing base image {ref}")
+            self._push(tag)
+        elif remote and not local:
+            logger.info(f"Pulling base image {ref}")
+            self.docker.api.pull(f"{self.docker.default_registry}/{self.image_name}", tag=tag)
+        return local or remote
+
+    def _build(self, base, tag):
+        logger.info(f"Building base image {self.image_name}:{tag}")
+        context = io.BytesIO()
+        with tarfile.open(fileobj=context, mode="w") as tar:
+            dockerfile = base.encode()
+            info = tarfile.TarInfo("Dockerfile")
+            info.size = len(dockerfile)
+            tar.addfile(info, io.BytesIO(dockerfile))
+        context.seek(0)
+        for line in self.docker.build_with_context(context=context, image_name=self.image_name, image_tag=tag):
+            self._check(line, "build")
+        self._push(tag)
+
+    def _push(self, tag):
+        for line in self.docker.push_to_registry(image_name=self.image_name, image_tag=tag):
+            self._check(line, "push")
+
+    def _check(self, line, action):
+        for part in line.splitlines():
+            try:
+                msg = json.loads(part)
+            except ValueError:
+                continue
+            if isinstance(msg, dict) and "error" in msg:
+                raise RuntimeError(f"Failed to {action} base image: {msg['error']}")
@@ -0,0 +1,75 @@
+import hashlib
+import json
+import os
+import tempfile
+from src.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class BuildCache:
+    """Content addressed index of built team images
+
+    Maps the team, the hash of its archive and the hash of the effective
+    Dockerfile to the id of the image it produced, and to the digests it was
+    pushed with. Every entry is its own json file and is replaced atomically,
+    so builds running in different processes can share the same index.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    @staticmethod
+    def make_key(source_hash, dockerfile_path, team_name):
+        """Build the cache key of a team build
+
+        The team is part of the key: an archive is only validated against
+        the team it was built for, so a hit must not cross teams.
+
+        Args:
+            source_hash (str): hash of the team archive (e.g. its storage ETag)
+            dockerfile_path (str): path of the Dockerfile used for the build
+            team_name (str): name of the team the archive is built for
+
+        Returns:
+            str: hex digest identifying the build
+        """
+        with open(dockerfile_path, "rb") as f:
+            dockerfile_hash = hashlib.sha256(f.read()).hexdigest()
+        return hashlib.sha256(json.dumps([team_name, source_hash, dockerfile_hash]).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, f"{key}.json")
+
+    def get(self, key):
+        """Get the cache entry of a key
+
+        Returns:
+            dict: entry with `image_id` and `pushed` ({tag: digest}) if found, else None
+        """
+        try:
+            with open(self._path(key)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.error(f"Failed to read build cache entry {key}: {e}")
+            return None
+
+    def put(self, key, entry):
+        """Store the cache entry of a key, replacing the previous one"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, self._path(key))
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def remove(self, key):
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
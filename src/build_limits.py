@@ -0,0 +1,152 @@
+from src import env
+
+# stages with a deadline, see stage_timeouts
+TIMEOUT_STAGES = ("download", "extract", "build", "push")
+
+
+class StageTimeout(Exception):
+    """A stage of a build did not finish within its deadline
+
+    The threads of the stage may still be running, so the worker running the
+    build is recycled once the build is reported.
+    """
+
+    def __init__(self, stage_id, timeout):
+        super().__init__(f"{stage_id} did not finish within {timeout} seconds")
+        self.stage_id = stage_id
+        self.timeout = timeout
+
+
+def parse_cpuset(cpuset):
+    """CPUs of a cpuset string, e.g. "0-2,4" -> {0, 1, 2, 4}"""
+    cpus = set()
+    for part in cpuset.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def _positive_int(value):
+    if isinstance(value, bool):
+        raise ValueError(f"{value!r} is not a positive integer")
+    value = int(value)
+    if value <= 0:
+        raise ValueError(f"{value!r} is not a positive integer")
+    return value
+
+
+def stage_timeouts(data):
+    """Deadlines of the stages of a build
+
+    The service defaults (STAGE_TIMEOUT_<STAGE>) can be overridden by the
+    `timeouts` field of the build message, up to STAGE_TIMEOUT_MAX seconds.
+
+    Args:
+        data (dict): body of the build message
+
+    Returns:
+        tuple[dict, list]: seconds by stage, and the warnings about the ignored or clamped overrides
+    """
+    timeouts = {
+        "download": env.STAGE_TIMEOUT_DOWNLOAD,
+        "extract": env.STAGE_TIMEOUT_EXTRACT,
+        "build": env.STAGE_TIMEOUT_BUILD,
+        "push": env.STAGE_TIMEOUT_PUSH,
+    }
+    warnings = []
+    overrides = data.get("timeouts") or {}
+    if not isinstance(overrides, dict):
+        return timeouts, [f"Invalid timeouts {overrides!r}, using the defaults"]
+    for stage, value in overrides.items():
+        if stage not in timeouts:
+            warnings.append(f"Unknown timeout stage {stage!r}, expected one of {', '.join(TIMEOUT_STAGES)}")
+            continue
+        try:
+            value = _positive_int(value)
+        except (TypeError, ValueError):
+            warnings.append(f"Invalid {stage} timeout {value!r}, using {timeouts[stage]} seconds")
+            continue
+        if value > env.STAGE_TIMEOUT_MAX:
+            warnings.append(f"{stage} timeout {value} is over the maximum, using {env.STAGE_TIMEOUT_MAX} seconds")
+            value = env.STAGE_TIMEOUT_MAX
+        timeouts[stage] = value
+    return timeouts, warnings
+
+
+def container_limits(data):
+    """Resource limits of the build containers of a build
+
+    The service defaults (BUILD_MEMORY, BUILD_CPU_SHARES, BUILD_CPU_QUOTA,
+    BUILD_CPUSET_CPUS) can be overridden by the `resources` field of the
+    build message, within BUILD_MEMORY_MAX, BUILD_CPU_SHARES_MAX,
+    BUILD_CPU_QUOTA_MAX and BUILD_CPUSET_CPUS_ALLOWED; a maximum of 0 (or no
+    allowed cpus) disables the override of that limit. The memory limit also
+    caps the swap, so a build can't swap, and the CPU quota is per
+    BUILD_CPU_PERIOD.
+
+    Args:
+        data (dict): body of the build message
+
+    Returns:
+        tuple[dict, list]: limits of the docker /build endpoint, and the warnings about the ignored or clamped overrides
+    """
+    limits = {}
+    if env.BUILD_MEMORY:
+        limits["memory"] = env.BUILD_MEMORY
+    if env.BUILD_CPU_SHARES:
+        limits["cpushares"] = env.BUILD_CPU_SHARES
+    if env.BUILD_CPU_QUOTA:
+        limits["cpuquota"] = env.BUILD_CPU_QUOTA
+    if env.BUILD_CPUSET_CPUS:
+        limits["cpusetcpus"] = env.BUILD_CPUSET_CPUS
+
+    warnings = []
+    resources = data.get("resources") or {}
+    if not isinstance(resources, dict):
+        resources = {}
+        warnings.append(f"Invalid resources {data.get('resources')!r}, using the defaults")
+
+    for key, maximum in (
+        ("memory", env.BUILD_MEMORY_MAX),
+        ("cpushares", env.BUILD_CPU_SHARES_MAX),
+        ("cpuquota", env.BUILD_CPU_QUOTA_MAX),
+    ):
+        if key not in resources:
+            continue
+        if not maximum:
+            warnings.append(f"{key} can't be overridden, using the default")
+            continue
+        try:
+            value = _positive_int(resources[key])
+        except (TypeError, ValueError):
+            warnings.append(f"Invalid {key} {resources[key]!r}, using the default")
+            continue
+        if value > maximum:
+            warnings.append(f"{key} {value} is over the maximum, using {maximum}")
+            value = maximum
+        limits[key] = value
+
+    if "cpusetcpus" in resources and not env.BUILD_CPUSET_CPUS_ALLOWED:
+        warnings.append("cpusetcpus can't be overridden, using the default")
+    elif "cpusetcpus" in resources:
+        cpuset = resources["cpusetcpus"]
+        try:
+            cpus = parse_cpuset(cpuset)
+            allowed = parse_cpuset(env.BUILD_CPUSET_CPUS_ALLOWED)
+            if not cpus:
+                raise ValueError("no cpu")
+            if not cpus <= allowed:
+                warnings.append(f"cpusetcpus {cpuset} is not within {env.BUILD_CPUSET_CPUS_ALLOWED}, using the default")
+            else:
+                limits["cpusetcpus"] = cpuset
+        except (AttributeError, ValueError):
+            warnings.append(f"Invalid cpusetcpus {cpuset!r}, using the default")
+
+    if "memory" in limits:
+        limits["memswap"] = limits["memory"]
+    if "cpuquota" in limits:
+        limits["cpuperiod"] = env.BUILD_CPU_PERIOD
+    return limits, warnings
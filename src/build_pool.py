@@ -0,0 +1,491 @@
+import asyncio
+import collections
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from src import env, metrics
+from src.build_limits import StageTimeout
+from src.docker import Docker
+from src.log_sink import BuildLogSink
+from src.logger import get_logger
+from src.reply_batcher import ReplyBatcher
+from src.scheduler import BuildScheduler
+from src.stage_limits import StageLimits
+from src.states import StateManager
+from src.storage import MinioClient
+
+logger = get_logger(__name__)
+
+
+class _StageSlot:
+    """Slot of a stage class held by the job of a worker, granted by the pool"""
+
+    def __init__(self, send, conn, build_id, stage_class):
+        self.send = send
+        self.conn = conn
+        self.build_id = build_id
+        self.stage_class = stage_class
+
+    async def __aenter__(self):
+        self.send(("acquire", self.build_id, self.stage_class))
+        # the job runs one stage at a time, so the grant is the only
+        # message on the pipe until it is released
+        message = await asyncio.to_thread(self.conn.recv)
+        if message != ("grant", self.stage_class):
+            raise RuntimeError(f"Unexpected message while waiting for a {self.stage_class} slot: {message}")
+        return self
+
+    async def __aexit__(self, *exc):
+        self.send(("release", self.build_id, self.stage_class))
+
+
+def _worker_main(index, conn, job_fn):
+    """Entry point of a build worker process
+
+    The worker owns its docker and storage clients for its whole life and
+    runs the jobs the pool sends over its pipe one after the other. Replies,
+    stage and state transitions of a job are pushed back over the same pipe.
+    The worker leads its own process group, so killing the group also stops
+    the processes a build started (e.g. docker buildx).
+    """
+    os.setsid()
+    docker = Docker(
+        default_registry=env.DOCKER_REGISTERY_ADDRESS + ":" + str(env.DOCKER_REGISTERY_PORT),
+        username=env.DOCKER_REGISTERY_USERNAME,
+        password=env.DOCKER_REGISTERY_PASSWORD
+    )
+    try:
+        docker.connect()
+    except Exception as e:
+        logger.error(f"worker {index}: docker connection failed: {e}")
+
+    MinioClient.configure_pool(
+        max_workers=env.STORAGE_MAX_WORKERS,
+        max_connections=env.STORAGE_MAX_CONNECTIONS,
+        range_threshold=env.STORAGE_RANGE_THRESHOLD,
+        range_chunk_size=env.STORAGE_RANGE_CHUNK_SIZE,
+        range_fanout=env.STORAGE_RANGE_FANOUT
+    )
+    storage = MinioClient(
+        endpoint=env.MINIO_ADDRESS + ":" + str(env.MINIO_PORT),
+        access_key=env.MINIO_USERNAME,
+        secret_key=env.MINIO_PASSWORD,
+        secure=False
+    )
+    storage.connect()
+
+    # replies come from the loop, metrics also from the stage threads
+    send_lock = threading.Lock()
+
+    def send(event):
+        with send_lock:
+            conn.send(event)
+
+    metrics.set_sink(lambda kind, name, value: send(("metric", None, (kind, name, value))))
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    logger.info(f"build worker {index} started")
+
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        build_id, data = job
+
+        async def send_reply(message):
+            send(("reply", build_id, message))
+
+        reply = batcher = ReplyBatcher(
+            send_reply,
+            max_lines=env.REPLY_BATCH_LINES,
+            max_delay=env.REPLY_BATCH_INTERVAL,
+            aggregate_progress=env.REPLY_PUSH_PROGRESS
+        )
+        log_sink = None
+        if env.BUILD_LOG_ENABLED:
+            reply = log_sink = BuildLogSink(
+                batcher,
+                storage,
+                bucket_name=env.BUILD_LOG_BUCKET,
+                object_name=f"{build_id}.log.gz",
+                tail_lines=env.BUILD_LOG_TAIL_LINES,
+                forward_lines=env.BUILD_LOG_REPLY_LINES,
+                max_queued_lines=env.BUILD_LOG_QUEUE_LINES
+            )
+            loop.run_until_complete(log_sink.start())
+
+        def update_state(state):
+            send(("update_state", build_id, state))
+
+        def stage_slot(stage_class, build_id=build_id):
+            return _StageSlot(send, conn, build_id, stage_class)
+
+        recycle = False
+        try:
+            loop.run_until_complete(job_fn(
+                data=data,
+                docker=docker,
+                storage=storage,
+                reply=reply,
+                update_state=update_state,
+                stage_slot=stage_slot,
+            ))
+        except StageTimeout as e:
+            # the threads of the stage may still hold the docker or storage
+            # streams, only a fresh process gets rid of them
+            logger.error(f"worker {index}: build {build_id} failed: {e}, recycling the worker")
+            recycle = True
+        except Exception as e:
+            logger.error(f"worker {index}: build {build_id} crashed: {e}")
+        finally:
+            if log_sink is not None:
+                loop.run_until_complete(log_sink.close())
+            loop.run_until_complete(batcher.close())
+            send(("done", build_id, recycle))
+        if recycle:
+            # stop what the build started (e.g. docker buildx) with the worker
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            os.killpg(0, signal.SIGTERM)
+            os._exit(0)
+
+    loop.close()
+    logger.info(f"build worker {index} stopped")
+
+
+class _Worker:
+    def __init__(self, index, process, conn, crashes=0):
+        self.index = index
+        self.process = process
+        self.conn = conn
+        self.build_id = None
+        # exits after its current build, gets no new one
+        self.retiring = False
+        # stopped by kill, its exit is not a crash
+        self.killed = False
+        self.started_at = time.monotonic()
+        # exits in a row within restart_min_uptime, see _restart
+        self.crashes = crashes
+
+
+class BuildWorkerPool:
+    """Pool of long lived build worker processes
+
+    The workers, including the ones replacing a dead worker, are forked by
+    a forkserver: a clean single threaded process started from the python
+    executable, so they never inherit the broker, storage, webserver or job
+    store connections and threads of the parent. A worker that dies again
+    within restart_min_uptime seconds is restarted after an exponential
+    backoff, up to restart_max_delay seconds. Every worker is connected to the pool by its own
+    pipe: jobs are sent to idle workers over it, and the events the worker
+    pushes back are read through the event loop (`add_reader`), so nothing
+    in the parent waits on or polls the workers. A worker runs one build at
+    a time, so the pool size is also the maximum number of builds in flight;
+    extra jobs wait in the scheduler, which decides which runs next. Inside a
+    job, the downloads, builds and pushes also wait for a slot of their own
+    stage class (see StageLimits), asked to the pool over the pipe.
+    """
+
+    def __init__(self, size, job_fn, state_manager: StateManager, scheduler: BuildScheduler = None, stage_limits: StageLimits = None, preempt_superseded=False):
+        """
+        Args:
+            size (int): number of worker processes
+            job_fn (callable): async function running a build, see run_build_job
+            state_manager (StateManager): state manager receiving the state updates
+            scheduler (BuildScheduler, optional): queue of the waiting builds. Defaults to a fair queue capped at size.
+            stage_limits (StageLimits, optional): limits per stage class. Defaults to no limits.
+            preempt_superseded (bool, optional): also stop the running build a newer one of the same image supersedes (debounce of the scheduler)
+        """
+        self.size = size
+        self.job_fn = job_fn
+        self.state_manager = state_manager
+        self.scheduler = scheduler if scheduler is not None else BuildScheduler(size)
+        self.stage_limits = stage_limits if stage_limits is not None else StageLimits({})
+        self.preempt_superseded = preempt_superseded
+        self.dispatch_timer = None
+        self.workers = []
+        self.jobs = {}
+        self.loop = None
+        self.events = None
+        self.stopped = False
+        # seconds of the team_build stages finished lately, see AdaptiveConcurrency
+        self.build_durations = collections.deque(maxlen=1000)
+        self.context = multiprocessing.get_context("forkserver")
+        # imported once by the forkserver instead of by every worker
+        self.context.set_forkserver_preload([__name__, job_fn.__module__])
+
+    restart_min_uptime = 10
+    restart_max_delay = 60
+
+    def _spawn(self, index, crashes=0):
+        conn, child_conn = self.context.Pipe()
+        process = self.context.Process(
+            target=_worker_main,
+            args=(index, child_conn, self.job_fn),
+            daemon=True,
+        )
+        process.start()
+        child_conn.close()
+        worker = _Worker(index, process, conn, crashes)
+        self.loop.add_reader(conn.fileno(), self._on_readable, worker)
+        self.loop.add_reader(process.sentinel, self._on_exit, worker)
+        return worker
+
+    def start(self, loop):
+        """Start the worker processes
+
+        Args:
+            loop (asyncio.AbstractEventLoop): loop the replies and state updates are handled on
+        """
+        self.loop = loop
+        self.events = asyncio.Queue()
+        self.workers = [self._spawn(i) for i in range(self.size)]
+        self.loop.create_task(self._handle_events())
+        logger.info(f"build pool started with {self.size} workers")
+
+    def stop(self):
+        self.stopped = True
+        for worker in self.workers:
+            if worker.conn.closed:
+                # waiting for its restart
+                continue
+            self.loop.remove_reader(worker.process.sentinel)
+            self.loop.remove_reader(worker.conn.fileno())
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+        for worker in self.workers:
+            worker.process.join(timeout=5)
+
+    async def run(self, build_id, data, reply):
+        """Queue a build and wait until it is done
+
+        Args:
+            build_id (str): ID of the build
+            data (dict): body of the build message
+            reply (callable): reply function of the build message
+        """
+        future = self.loop.create_future()
+        self.jobs[build_id] = {"reply": reply, "future": future, "worker": None}
+        running = self.scheduler.running_build(data)
+        for superseded in self.scheduler.push(build_id, data):
+            await self._supersede(superseded, build_id)
+        if self.preempt_superseded and running is not None:
+            self.loop.create_task(self._supersede(running, build_id))
+        self._dispatch()
+        try:
+            await future
+        finally:
+            self.jobs.pop(build_id, None)
+
+    def set_max_running(self, max_running):
+        """Change the number of builds running at once, see BuildScheduler"""
+        self.scheduler.max_running = max_running
+        self._dispatch()
+
+    def queue_info(self, build_id):
+        """Queue position and estimated wait of a build
+
+        Returns:
+            dict: `queue_position` (0 runs next) and `estimated_wait` in seconds, None if the build is not queued
+        """
+        planned = self.scheduler.plan().get(build_id)
+        if planned is None:
+            return None
+        position, start_at = planned
+        return {"queue_position": position, "estimated_wait": round(max(start_at - time.time(), 0), 1)}
+
+    def queue_infos(self):
+        """Queue position and estimated wait of all the queued builds, see queue_info
+
+        Returns:
+            dict: info by build_id
+        """
+        now = time.time()
+        return {
+            build_id: {"queue_position": position, "estimated_wait": round(max(start_at - now, 0), 1)}
+            for build_id, (position, start_at) in self.scheduler.plan().items()
+        }
+
+    def _dispatch(self):
+        for worker in self.workers:
+            if worker.build_id is not None or worker.retiring or not worker.process.is_alive():
+                continue
+            job = self.scheduler.pop()
+            if job is None:
+                break
+            build_id, data = job
+            worker.build_id = build_id
+            self.jobs[build_id]["worker"] = worker.index
+            worker.conn.send((build_id, data))
+
+        # builds held in their debounce window
+        wait = self.scheduler.next_ready_in()
+        if wait is not None:
+            if self.dispatch_timer is not None:
+                self.dispatch_timer.cancel()
+            self.dispatch_timer = self.loop.call_later(wait, self._dispatch)
+
+    def _on_readable(self, worker):
+        try:
+            while worker.conn.poll():
+                self.events.put_nowait(worker.conn.recv())
+        except (EOFError, OSError):
+            # the worker is gone, _on_exit takes care of it
+            self.loop.remove_reader(worker.conn.fileno())
+
+    def _on_exit(self, worker):
+        # pick up what the worker sent before it exited
+        self._on_readable(worker)
+        self.loop.remove_reader(worker.process.sentinel)
+        self.loop.remove_reader(worker.conn.fileno())
+        self.events.put_nowait(("exit", worker.build_id, worker.index))
+
+    async def _handle_events(self):
+        while True:
+            kind, build_id, payload = await self.events.get()
+            if kind == "exit":
+                await self._restart(self.workers[payload])
+                continue
+            if kind == "metric":
+                metrics.apply(*payload)
+                continue
+            job = self.jobs.get(build_id)
+            if job is None:
+                logger.error(f"Event {kind} for unknown build_id: {build_id}")
+                continue
+            try:
+                if kind == "reply":
+                    if isinstance(payload, dict) and "stage" in payload and "state" in payload:
+                        self.state_manager.update_stage(build_id, payload["stage"], payload["state"])
+                        if payload["stage"] == "team_build" and payload["state"] != "start":
+                            self._build_finished(build_id)
+                    await job["reply"](payload)
+                elif kind == "update_state":
+                    await self.state_manager.update_state(build_id, payload)
+                elif kind == "acquire":
+                    worker = self.workers[job["worker"]]
+                    self.stage_limits.acquire(build_id, payload, lambda worker=worker, stage_class=payload: worker.conn.send(("grant", stage_class)))
+                elif kind == "release":
+                    self.stage_limits.release(build_id, payload)
+                elif kind == "done":
+                    self.workers[job["worker"]].build_id = None
+                    self.workers[job["worker"]].retiring = payload
+                    self.scheduler.done(build_id)
+                    self.stage_limits.release_all(build_id)
+                    await self._finish(build_id, job)
+                    self._dispatch()
+            except Exception as e:
+                logger.error(f"Failed to handle {kind} of build_id: {build_id}: {e}")
+
+    async def kill(self, build_id, timeout=10):
+        """Stop a build, queued or running
+
+        A queued build is taken out of the queue. A running build is stopped
+        by killing the process group of its worker: the open docker build or
+        push stream and the storage downloads are aborted with it, and the
+        worker is restarted, which frees its slot.
+
+        Args:
+            build_id (str): ID of the build
+            timeout (float, optional): seconds to wait for the build to stop
+
+        Returns:
+            bool: True if the build is not running anymore
+        """
+        job = self.jobs.get(build_id)
+        if job is None:
+            return True
+        if self.scheduler.remove(build_id):
+            logger.info(f"Removed build_id: {build_id} from the queue")
+            await self._finish(build_id, job)
+            return True
+
+        worker = self.workers[job["worker"]] if job["worker"] is not None else None
+        if worker is not None and worker.build_id == build_id:
+            logger.info(f"Killing build worker {worker.index} running build_id: {build_id}")
+            metrics.incr("builds_killed")
+            worker.killed = True
+            try:
+                os.killpg(worker.process.pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                # the worker has not made its own group yet
+                worker.process.kill()
+        try:
+            await asyncio.wait_for(asyncio.shield(job["future"]), timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"build_id: {build_id} did not stop within {timeout} seconds")
+            return False
+        return True
+
+    async def _supersede(self, build_id, newer_build_id):
+        """End a build a newer one of the same image supersedes
+
+        A queued build is already out of the scheduler, a running one is
+        stopped (see kill).
+        """
+        job = self.jobs.get(build_id)
+        if job is None:
+            return
+        running = job["worker"] is not None
+        logger.info(f"build_id: {build_id} is superseded by build_id: {newer_build_id}")
+        metrics.incr("builds_preempted" if running else "builds_superseded")
+        await self.state_manager.update_state(build_id, "superseded")
+        try:
+            await job["reply"]({"status": "superseded", "superseded_by": newer_build_id})
+        except Exception as e:
+            logger.error(f"Failed to reply to superseded build_id: {build_id}: {e}")
+        if running:
+            await self.kill(build_id)
+        else:
+            await self._finish(build_id, job)
+
+    async def _finish(self, build_id, job):
+        state = self.state_manager.get_run_jobs_state(build_id)
+        if state is not None and state.status not in ("finished", "killed", "superseded"):
+            await self.state_manager.update_state(build_id, "failed")
+        if not job["future"].done():
+            job["future"].set_result(None)
+
+    def _build_finished(self, build_id):
+        job = self.state_manager.get_run_jobs_state(build_id)
+        if job is None or job.compacted:
+            return
+        _, started_at, finished_at = job.stages.get("team_build", (None, None, None))
+        if started_at and finished_at:
+            self.build_durations.append(finished_at - started_at)
+
+    def _respawn(self, index, crashes):
+        if self.stopped:
+            return
+        self.workers[index] = self._spawn(index, crashes)
+        self._dispatch()
+
+    async def _restart(self, worker):
+        worker.process.join()
+        if worker.process.exitcode == 0:
+            logger.info(f"build worker {worker.index} exited, restarting it")
+        else:
+            logger.error(f"build worker {worker.index} died with exit code {worker.process.exitcode}, restarting it")
+        worker.conn.close()
+        crashes = 0
+        if not worker.killed and time.monotonic() - worker.started_at < self.restart_min_uptime:
+            crashes = worker.crashes + 1
+        if crashes:
+            delay = min(2 ** (crashes - 1), self.restart_max_delay)
+            logger.error(f"build worker {worker.index} died {crashes} times in a row, restarting it in {delay} seconds")
+            self.loop.call_later(delay, self._respawn, worker.index, crashes)
+        else:
+            self._respawn(worker.index, crashes)
+        job = self.jobs.get(worker.build_id)
+        self.scheduler.done(worker.build_id)
+        self.stage_limits.release_all(worker.build_id)
+        if job is not None:
+            await self._finish(worker.build_id, job)
+        self._dispatch()
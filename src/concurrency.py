@@ -0,0 +1,183 @@
+import asyncio
+import os
+import shutil
+import time
+from src import metrics
+from src.logger import get_logger
+
+logger = get_logger(__name__)
+
+# inputs that can make the limit decrease
+OVERLOAD_REASONS = ("cpu_pressure", "io_pressure", "docker_latency", "free_disk", "build_seconds")
+
+
+def read_pressure(resource):
+    """Share of time (percent, last 10s) some tasks stalled on a resource, from /proc/pressure
+
+    Returns:
+        float: avg10 of the `some` line, 0 when the kernel does not report pressure
+    """
+    try:
+        with open(f"/proc/pressure/{resource}") as f:
+            for line in f:
+                if line.startswith("some"):
+                    fields = dict(item.split("=") for item in line.split()[1:])
+                    return float(fields["avg10"])
+    except (OSError, ValueError, KeyError):
+        pass
+    return 0.0
+
+
+class AdaptiveConcurrency:
+    """AIMD controller of the number of builds running at once
+
+    Every `interval` seconds it samples the CPU and IO pressure of the host,
+    the latency of the docker daemon API, the free disk of the upload folder
+    and the duration of the build stages that just finished. When any of
+    them is over its threshold the limit is halved (multiplicative
+    decrease), else it grows by one while builds are waiting (additive
+    increase), from the running limit of the scheduler up to `max_limit`.
+    The limit is applied to the scheduler, and to the build stage limit
+    never beyond its configured value. Inputs and decisions are
+    reported as metrics (`concurrency_...`, and `concurrency_overloaded_<input>`
+    set to 1 while an input is over its threshold).
+    """
+
+    def __init__(
+        self,
+        build_pool,
+        docker,
+        upload_folder,
+        min_limit=1,
+        max_limit=None,
+        interval=5.0,
+        cpu_pressure_max=50.0,
+        io_pressure_max=30.0,
+        docker_latency_max=1.0,
+        min_free_disk=5 * 1024 * 1024 * 1024,
+        slow_build_factor=2.0,
+    ):
+        """
+        Args:
+            build_pool (BuildWorkerPool): pool whose scheduler and stage limits are adjusted
+            docker (Docker): docker client used to measure the daemon latency
+            upload_folder (str): folder the builds are extracted to
+            min_limit (int, optional): lowest number of builds running at once
+            max_limit (int, optional): highest number of builds running at once, up to the pool size. Defaults to the pool size.
+            interval (float, optional): seconds between two decisions
+            cpu_pressure_max (float, optional): CPU pressure (percent) over which the limit decreases
+            io_pressure_max (float, optional): IO pressure (percent) over which the limit decreases
+            docker_latency_max (float, optional): daemon ping seconds over which the limit decreases
+            min_free_disk (int, optional): free bytes under which the limit decreases
+            slow_build_factor (float, optional): decrease when builds take this many times their usual duration
+        """
+        self.build_pool = build_pool
+        self.docker = docker
+        self.upload_folder = upload_folder
+        self.min_limit = min_limit
+        self.max_limit = min(max_limit, build_pool.size) if max_limit is not None else build_pool.size
+        self.max_build_limit = build_pool.stage_limits.limits.get("build")
+        self.interval = interval
+        self.cpu_pressure_max = cpu_pressure_max
+        self.io_pressure_max = io_pressure_max
+        self.docker_latency_max = docker_latency_max
+        self.min_free_disk = min_free_disk
+        self.slow_build_factor = slow_build_factor
+        self.limit = max(self.min_limit, min(build_pool.scheduler.max_running, self.max_limit))
+        self.build_duration = None
+        self.task = None
+
+    def start(self, loop):
+        try:
+            # the builds create it, but the free disk is sampled before
+            os.makedirs(self.upload_folder, exist_ok=True)
+        except OSError as e:
+            logger.warning(f"can't create {self.upload_folder}: {e}")
+        self.task = loop.create_task(self._run())
+        logger.info(f"adaptive concurrency started, limit between {self.min_limit} and {self.max_limit}")
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                inputs = await asyncio.to_thread(self._sample)
+                inputs["build_seconds"] = self._build_seconds()
+                self._decide(inputs)
+            except Exception as e:
+                logger.error(f"adaptive concurrency failed: {e}")
+
+    def _sample(self):
+        started = time.monotonic()
+        try:
+            self.docker.client.ping()
+            docker_latency = time.monotonic() - started
+        except Exception as e:
+            logger.warning(f"docker ping failed: {e}")
+            docker_latency = float("inf")
+        return {
+            "cpu_pressure": read_pressure("cpu"),
+            "io_pressure": read_pressure("io"),
+            "docker_latency": docker_latency,
+            "free_disk": self._free_disk(),
+        }
+
+    def _free_disk(self):
+        # of the upload folder, or of its nearest existing parent
+        path = os.path.abspath(self.upload_folder)
+        while not os.path.exists(path) and os.path.dirname(path) != path:
+            path = os.path.dirname(path)
+        return shutil.disk_usage(path).free
+
+    def _build_seconds(self):
+        # mean duration of the build stages finished since the last sample
+        durations = self.build_pool.build_durations
+        if not durations:
+            return None
+        mean = sum(durations) / len(durations)
+        durations.clear()
+        return mean
+
+    def _decide(self, inputs):
+        for name, value in inputs.items():
+            if value is not None and value != float("inf"):
+                metrics.set_gauge(f"concurrency_{name}", round(value, 3))
+
+        reasons = []
+        if inputs["cpu_pressure"] > self.cpu_pressure_max:
+            reasons.append("cpu_pressure")
+        if inputs["io_pressure"] > self.io_pressure_max:
+            reasons.append("io_pressure")
+        if inputs["docker_latency"] > self.docker_latency_max:
+            reasons.append("docker_latency")
+        if inputs["free_disk"] < self.min_free_disk:
+            reasons.append("free_disk")
+        build_seconds = inputs["build_seconds"]
+        if build_seconds is not None:
+            if self.build_duration is not None and build_seconds > self.build_duration * self.slow_build_factor:
+                reasons.append("build_seconds")
+            else:
+                # usual build duration, only learnt from the healthy samples
+                self.build_duration = build_seconds if self.build_duration is None \
+                    else 0.8 * self.build_duration + 0.2 * build_seconds
+
+        scheduler = self.build_pool.scheduler
+        limit = self.limit
+        if reasons:
+            limit = max(self.min_limit, self.limit // 2)
+        elif len(scheduler) > 0 and len(scheduler.running) >= self.limit:
+            limit = min(self.max_limit, self.limit + 1)
+
+        if limit != self.limit:
+            metrics.incr("concurrency_decreases" if limit < self.limit else "concurrency_increases")
+            logger.info(f"concurrency limit {self.limit} -> {limit} {reasons}")
+            self.limit = limit
+            if self.max_build_limit is not None:
+                self.build_pool.stage_limits.set_limit("build", min(self.max_build_limit, limit))
+            self.build_pool.set_max_running(limit)
+        metrics.set_gauge("concurrency_limit", self.limit)
+        for reason in OVERLOAD_REASONS:
+            metrics.set_gauge(f"concurrency_overloaded_{reason}", int(reason in reasons))
@@ -1,7 +1,18 @@
 import logging
+import os
+import subprocess
+import threading
 import docker
 logger = logging.getLogger("docker")
 
+# the engine /build endpoint also takes cpuquota and cpuperiod, but
+# APIClient.build only lets the container_limits keys of this list through
+# and passes them on as query parameters. Relies on docker-py 7.x, pinned in
+# the Pipfile
+for _key in ("cpuquota", "cpuperiod"):
+    if _key not in docker.constants.CONTAINER_LIMITS_KEYS:
+        docker.constants.CONTAINER_LIMITS_KEYS.append(_key)
+
 class Docker:
     client : docker.DockerClient
     api : docker.APIClient
@@ -16,6 +27,9 @@ class Docker:
         self.default_registry = default_registry
         self.username = username
         self.password = password
+        self._buildkit = None
+        self._buildx_drivers = {}
+        self._cli_logged_in = False
         self.init()
         
     def init(self):
@@ -41,7 +55,8 @@ class Docker:
         image_name,
         image_tag,
         rm=False,
-        timeout=12000
+        timeout=12000,
+        container_limits=None
     ):
         """build an image with the given data
 
@@ -51,6 +66,7 @@ class Docker:
             image_tag (str): tag of the image
             rm (bool, optional): remove the image after building. Defaults to False.
             timeout (int, optional): timeout for the build. Defaults to 1200.
+            container_limits (dict, optional): memory, memswap, cpushares, cpusetcpus, cpuquota and cpuperiod of the build containers
         """
         
         tag = f"{self.default_registry}/{image_name}:{image_tag}"
@@ -59,11 +75,157 @@ class Docker:
             rm=rm,
             tag=tag,
             timeout=timeout,
+            container_limits=container_limits,
         )
         for line in build_progress:
             yield line.decode('utf-8')          
     
+    def build_with_context(
+        self,
+        context,
+        image_name,
+        image_tag,
+        rm=False,
+        timeout=12000,
+        container_limits=None
+    ):
+        """build an image from a ready made build context
+
+        Args:
+            context (iterable): tar stream of the build context, including the Dockerfile
+            image_name (str): name of the image
+            image_tag (str): tag of the image
+            rm (bool, optional): remove the image after building. Defaults to False.
+            timeout (int, optional): timeout for the build. Defaults to 1200.
+            container_limits (dict, optional): memory, memswap, cpushares, cpusetcpus, cpuquota and cpuperiod of the build containers
+        """
         
+        tag = f"{self.default_registry}/{image_name}:{image_tag}"
+        build_progress = self.api.build(
+            fileobj=context,
+            custom_context=True,
+            rm=rm,
+            tag=tag,
+            timeout=timeout,
+            container_limits=container_limits,
+        )
+        for line in build_progress:
+            yield line.decode('utf-8')
+        
+        
+    def buildkit_available(self):
+        """check if the docker cli can build with BuildKit (buildx)
+        """
+        if self._buildkit is None:
+            try:
+                subprocess.run(["docker", "buildx", "version"], stdin=subprocess.DEVNULL, check=True, capture_output=True, timeout=30)
+                self._buildkit = True
+            except (OSError, subprocess.SubprocessError) as e:
+                logger.info(f"BuildKit is not available: {e}")
+                self._buildkit = False
+        return self._buildkit
+    
+    def _buildx_driver(self, builder=None):
+        if builder not in self._buildx_drivers:
+            cmd = ["docker", "buildx", "inspect"] + ([builder] if builder else [])
+            output = subprocess.run(cmd, check=True, capture_output=True, timeout=30).stdout.decode()
+            driver = next((line.split(":", 1)[1].strip() for line in output.splitlines() if line.startswith("Driver:")), "docker")
+            self._buildx_drivers[builder] = driver
+        return self._buildx_drivers[builder]
+    
+    def _cli_login(self):
+        # the docker cli keeps its own credentials, apart from the api client
+        if self._cli_logged_in or not self.username:
+            return
+        subprocess.run(
+            ["docker", "login", "--username", self.username, "--password-stdin", self.default_registry],
+            input=self.password.encode(),
+            check=True,
+            capture_output=True,
+            timeout=60
+        )
+        self._cli_logged_in = True
+    
+    def build_with_buildkit(
+        self,
+        image_name,
+        image_tag,
+        path=None,
+        context=None,
+        cache_ref=None,
+        builder=None,
+        timeout=12000
+    ):
+        """build an image with BuildKit, sharing the layer cache through the registry
+
+        The image is loaded into the local docker daemon, so it can be pushed
+        like the images of the legacy builder. Layers are imported from
+        cache_ref, and exported to it when the builder supports cache export
+        (not the default `docker` driver).
+
+        Args:
+            image_name (str): name of the image
+            image_tag (str): tag of the image
+            path (str, optional): path to the folder with the Dockerfile
+            context (iterable, optional): tar stream of the build context, used instead of path
+            cache_ref (str, optional): registry reference of the build cache
+            builder (str, optional): buildx builder instance. Defaults to the current one.
+            timeout (int, optional): timeout for the build. Defaults to 12000.
+        """
+        self._cli_login()
+        tag = f"{self.default_registry}/{image_name}:{image_tag}"
+        cmd = ["docker", "buildx", "build"]
+        if builder:
+            cmd += ["--builder", builder]
+        cmd += ["--progress=plain", "--load", "--tag", tag]
+        if cache_ref:
+            cmd += ["--cache-from", f"type=registry,ref={cache_ref}"]
+            if self._buildx_driver(builder) != "docker":
+                cmd += ["--cache-to", f"type=registry,ref={cache_ref},mode=max"]
+            else:
+                logger.info(f"buildx driver of {builder or 'the default builder'} can't export the build cache")
+        cmd.append("-" if context is not None else path)
+        
+        process = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE if context is not None else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            env={**os.environ, "DOCKER_BUILDKIT": "1"},
+        )
+        feed_error = []
+        
+        def feed():
+            try:
+                for chunk in context:
+                    process.stdin.write(chunk)
+            except Exception as e:
+                feed_error.append(e)
+            finally:
+                try:
+                    process.stdin.close()
+                except OSError:
+                    pass
+        
+        feeder = None
+        if context is not None:
+            feeder = threading.Thread(target=feed, daemon=True)
+            feeder.start()
+        try:
+            for line in process.stdout:
+                yield line.decode('utf-8', errors='replace').rstrip("\n")
+            process.wait(timeout=timeout)
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            if feeder is not None:
+                feeder.join()
+        if feed_error:
+            raise feed_error[0]
+        if process.returncode != 0:
+            raise docker.errors.BuildError(f"buildx exited with code {process.returncode}", [])
+    
     def push_to_registry(
         self,
         image_name,
@@ -86,4 +248,58 @@ class Docker:
             stream=True
         )
         for line in push_progress:
-            yield line.decode('utf-8')
\ No newline at end of file
+            yield line.decode('utf-8')
+    
+    def image_id(self, image_name, image_tag):
+        """get the id of a local image
+
+        Args:
+            image_name (str): name of the image
+            image_tag (str): tag of the image
+        """
+        tag = f"{self.default_registry}/{image_name}:{image_tag}"
+        return self.api.inspect_image(tag)["Id"]
+    
+    def has_image(self, image_id):
+        """check if an image exists in the local docker daemon
+
+        Args:
+            image_id (str): id of the image
+        """
+        try:
+            self.api.inspect_image(image_id)
+            return True
+        except docker.errors.ImageNotFound:
+            return False
+    
+    def tag_image(self, image_id, image_name, image_tag):
+        """tag a local image for the registry
+
+        Args:
+            image_id (str): id of the image
+            image_name (str): name of the image
+            image_tag (str): tag of the image
+        """
+        return self.api.tag(
+            image_id,
+            repository=f"{self.default_registry}/{image_name}",
+            tag=image_tag,
+            force=True
+        )
+    
+    def registry_digest(self, image_name, image_tag):
+        """get the digest of an image in the registry
+
+        Args:
+            image_name (str): name of the image
+            image_tag (str): tag of the image
+
+        Returns:
+            str: digest of the manifest, None if the registry does not have it
+        """
+        tag = f"{self.default_registry}/{image_name}:{image_tag}"
+        try:
+            return self.api.inspect_distribution(tag)["Descriptor"]["digest"]
+        except docker.errors.APIError as e:
+            logger.debug(f"{tag} not found in the registry: {e}")
+            return None
@@ -25,6 +25,14 @@ MINIO_USERNAME = os.environ.get('MINIO_USERNAME')
 MINIO_PASSWORD = os.environ.get('MINIO_PASSWORD')
 MINIO_ADDRESS = os.environ.get('MINIO_ADDRESS')
 MINIO_PORT = int(os.environ.get('MINIO_PORT'))
+# blocking storage calls running at once, and pooled connections per endpoint
+STORAGE_MAX_WORKERS = int(os.environ.get('STORAGE_MAX_WORKERS', 8))
+STORAGE_MAX_CONNECTIONS = int(os.environ.get('STORAGE_MAX_CONNECTIONS', 16))
+# objects of at least STORAGE_RANGE_THRESHOLD bytes are downloaded in parallel
+# ranges of STORAGE_RANGE_CHUNK_SIZE bytes, STORAGE_RANGE_FANOUT at a time
+STORAGE_RANGE_THRESHOLD = int(os.environ.get('STORAGE_RANGE_THRESHOLD', 32 * 1024 * 1024))
+STORAGE_RANGE_CHUNK_SIZE = int(os.environ.get('STORAGE_RANGE_CHUNK_SIZE', 8 * 1024 * 1024))
+STORAGE_RANGE_FANOUT = int(os.environ.get('STORAGE_RANGE_FANOUT', 4))
 
 #WEBSERVER variables 
 WEBSERVER_ADDRESS = os.environ.get('WEBSERVER_ADDRESS')
@@ -52,6 +60,134 @@ DEFAULT_UPLOAD_FOLDER = os.path.join(
 
 USE_TMP_UPLOAD_FOLDER = False
 
+# how the team archive gets from storage to the extracted folder:
+#   download - fget the archive to disk, then extract it (default)
+#   stream   - extract the archive while it is being downloaded
+#   context  - download the archive and generate the docker context from it
+#              in memory, without extracting it
+# e.g. TEAM_FILE_MODE=stream to overlap the download and the extraction
+TEAM_FILE_MODE = os.environ.get('TEAM_FILE_MODE', 'download')
+
 REMOVE_AFTER_BUILD = False
 
+# builder used when the build message has no "builder" field:
+#   legacy   - the classic docker daemon builder
+#   buildkit - docker buildx, importing and exporting the layer cache from
+#              BUILDKIT_CACHE_IMAGE in the registry; falls back to legacy
+#              when buildx is not available
+#   oci      - assemble the image from the base image (BASE_IMAGE_ENABLED)
+#              and the team archive, and push it over the registry API,
+#              without the docker daemon; falls back to legacy when the
+#              Dockerfile has more than a COPY bin and config instructions
+BUILDER_BACKEND = os.environ.get('BUILDER_BACKEND', 'legacy')
+BUILDERS = ("legacy", "buildkit", "oci")
+# buildx builder instance, a docker-container builder is needed to export the cache
+BUILDKIT_BUILDER = os.environ.get('BUILDKIT_BUILDER', '')
+BUILDKIT_CACHE_IMAGE = os.environ.get('BUILDKIT_CACHE_IMAGE', 'team-build-cache:buildcache')
+
+# number of build worker processes, i.e. builds in flight at once
+BUILD_WORKERS = int(os.environ.get('BUILD_WORKERS', 8))
+# global cap of the builds running at once, waiting builds are fair queued
+# by priority, tournament and team
+BUILD_MAX_RUNNING = int(os.environ.get('BUILD_MAX_RUNNING', BUILD_WORKERS))
+# deadline in seconds of the stages of a build, the build message can
+# override them (`timeouts`) up to STAGE_TIMEOUT_MAX
+STAGE_TIMEOUT_DOWNLOAD = int(os.environ.get('STAGE_TIMEOUT_DOWNLOAD', 600))
+STAGE_TIMEOUT_EXTRACT = int(os.environ.get('STAGE_TIMEOUT_EXTRACT', 300))
+STAGE_TIMEOUT_BUILD = int(os.environ.get('STAGE_TIMEOUT_BUILD', 1800))
+STAGE_TIMEOUT_PUSH = int(os.environ.get('STAGE_TIMEOUT_PUSH', 900))
+STAGE_TIMEOUT_MAX = int(os.environ.get('STAGE_TIMEOUT_MAX', 3600))
+# resource limits of the build containers, 0 or empty for none; the build
+# message can override them (`resources`) within the maximums, a maximum of 0
+# (or an empty BUILD_CPUSET_CPUS_ALLOWED) keeps the default. BUILD_CPU_QUOTA
+# is a hard limit, in microseconds of CPU time per BUILD_CPU_PERIOD. BuildKit
+# can't apply them, builds with limits run on the legacy builder
+BUILD_MEMORY = int(os.environ.get('BUILD_MEMORY', 0))
+BUILD_MEMORY_MAX = int(os.environ.get('BUILD_MEMORY_MAX', 0))
+BUILD_CPU_SHARES = int(os.environ.get('BUILD_CPU_SHARES', 0))
+BUILD_CPU_SHARES_MAX = int(os.environ.get('BUILD_CPU_SHARES_MAX', 0))
+BUILD_CPU_QUOTA = int(os.environ.get('BUILD_CPU_QUOTA', 0))
+BUILD_CPU_QUOTA_MAX = int(os.environ.get('BUILD_CPU_QUOTA_MAX', 0))
+BUILD_CPU_PERIOD = int(os.environ.get('BUILD_CPU_PERIOD', 100000))
+BUILD_CPUSET_CPUS = os.environ.get('BUILD_CPUSET_CPUS', '')
+BUILD_CPUSET_CPUS_ALLOWED = os.environ.get('BUILD_CPUSET_CPUS_ALLOWED', '')
+# jobs that are over are compacted to a summary (status, timings, team,
+# image) after JOB_COMPACT_AFTER seconds, the oldest ones are dropped beyond
+# JOB_HISTORY_MAX jobs
+JOB_COMPACT_AFTER = float(os.environ.get('JOB_COMPACT_AFTER', 600))
+JOB_HISTORY_MAX = int(os.environ.get('JOB_HISTORY_MAX', 10000))
+# copy the jobs to a SQLite database, so they survive a restart; builds that
+# were running when the service stopped are requeued if JOB_REQUEUE_ORPHANED
+JOB_STORE_ENABLED = os.environ.get('JOB_STORE_ENABLED', 'false').lower() == 'true'
+JOB_STORE_PATH = os.environ.get('JOB_STORE_PATH', os.path.join(DEFAULT_UPLOAD_FOLDER, '.jobs.sqlite'))
+# days the jobs that are over are kept in the database
+JOB_STORE_RETENTION_DAYS = float(os.environ.get('JOB_STORE_RETENTION_DAYS', 30))
+JOB_REQUEUE_ORPHANED = os.environ.get('JOB_REQUEUE_ORPHANED', 'true').lower() == 'true'
+# identical builds in flight (same image, registry, team file ETag and
+# options) run once, the later ones follow the first one
+BUILD_SINGLE_FLIGHT = os.environ.get('BUILD_SINGLE_FLIGHT', 'true').lower() == 'true'
+# hold the queued builds BUILD_DEBOUNCE_WINDOW seconds, a newer build of the
+# same team and image supersedes the queued one, and with
+# BUILD_DEBOUNCE_PREEMPT also the running one
+BUILD_DEBOUNCE = os.environ.get('BUILD_DEBOUNCE', 'false').lower() == 'true'
+BUILD_DEBOUNCE_WINDOW = float(os.environ.get('BUILD_DEBOUNCE_WINDOW', 10))
+BUILD_DEBOUNCE_PREEMPT = os.environ.get('BUILD_DEBOUNCE_PREEMPT', 'false').lower() == 'true'
+# seconds kill_build waits for a build to stop before replying
+KILL_TIMEOUT = float(os.environ.get('KILL_TIMEOUT', 10))
+# stages of the builds in flight running at once, by stage class, so the
+# download of a build overlaps with the build of another (at least 1 each,
+# the downloads below the workers so the limit binds)
+STAGE_LIMIT_DOWNLOAD = int(os.environ.get('STAGE_LIMIT_DOWNLOAD', max(1, BUILD_WORKERS // 2)))
+STAGE_LIMIT_BUILD = int(os.environ.get('STAGE_LIMIT_BUILD', 4))
+STAGE_LIMIT_PUSH = int(os.environ.get('STAGE_LIMIT_PUSH', 4))
+
+# adapt the builds running at once to the load of the host and of the
+# docker daemon: the pool then has CONCURRENCY_MAX workers (instead of
+# BUILD_WORKERS), and the limit starts at CONCURRENCY_INITIAL and moves
+# between CONCURRENCY_MIN and CONCURRENCY_MAX
+CONCURRENCY_ADAPTIVE = os.environ.get('CONCURRENCY_ADAPTIVE', 'true').lower() == 'true'
+CONCURRENCY_MIN = int(os.environ.get('CONCURRENCY_MIN', 1))
+CONCURRENCY_MAX = int(os.environ.get('CONCURRENCY_MAX', max(BUILD_WORKERS, os.cpu_count() or 1)))
+CONCURRENCY_INITIAL = int(os.environ.get('CONCURRENCY_INITIAL', BUILD_MAX_RUNNING))
+CONCURRENCY_INTERVAL = float(os.environ.get('CONCURRENCY_INTERVAL', 5))
+CONCURRENCY_CPU_PRESSURE_MAX = float(os.environ.get('CONCURRENCY_CPU_PRESSURE_MAX', 50))
+CONCURRENCY_IO_PRESSURE_MAX = float(os.environ.get('CONCURRENCY_IO_PRESSURE_MAX', 30))
+CONCURRENCY_DOCKER_LATENCY_MAX = float(os.environ.get('CONCURRENCY_DOCKER_LATENCY_MAX', 1.0))
+CONCURRENCY_MIN_FREE_DISK = int(os.environ.get('CONCURRENCY_MIN_FREE_DISK', 5 * 1024 * 1024 * 1024))
+
+# stage log lines are sent in batches of up to REPLY_BATCH_LINES lines, at
+# least every REPLY_BATCH_INTERVAL seconds
+REPLY_BATCH_LINES = int(os.environ.get('REPLY_BATCH_LINES', 50))
+REPLY_BATCH_INTERVAL = float(os.environ.get('REPLY_BATCH_INTERVAL', 0.5))
+# send the push progress of all layers as a single percentage
+REPLY_PUSH_PROGRESS = os.environ.get('REPLY_PUSH_PROGRESS', 'true').lower() == 'true'
+
+# build the team independent part of the team Dockerfile (everything above
+# `COPY bin`) once into a shared base image, team builds only add the copy.
+# Off by default; BASE_IMAGE_ENABLED=true builds the base image at startup
+# (and the oci builder needs it)
+BASE_IMAGE_ENABLED = os.environ.get('BASE_IMAGE_ENABLED', 'false').lower() == 'true'
+BASE_IMAGE_NAME = os.environ.get('BASE_IMAGE_NAME', 'team-runtime-base')
+BASE_IMAGE_LOCK = os.path.join(DEFAULT_UPLOAD_FOLDER, '.base-image.lock')
+
+# skip the build when the same archive was already built with the same Dockerfile
+BUILD_CACHE_ENABLED = os.environ.get('BUILD_CACHE_ENABLED', 'true').lower() == 'true'
+BUILD_CACHE_FOLDER = os.path.join(DEFAULT_UPLOAD_FOLDER, '.build-cache')
+
+# node local LRU cache of downloaded team archives
+ARCHIVE_CACHE_ENABLED = os.environ.get('ARCHIVE_CACHE_ENABLED', 'true').lower() == 'true'
+ARCHIVE_CACHE_MAX_BYTES = int(os.environ.get('ARCHIVE_CACHE_MAX_BYTES', 10 * 1024 * 1024 * 1024))
+ARCHIVE_CACHE_FOLDER = os.path.join(DEFAULT_UPLOAD_FOLDER, '.archive-cache')
+
+# full build logs are streamed, gzip compressed, to BUILD_LOG_BUCKET; with
+# BUILD_LOG_REPLY_LINES disabled the log lines are not sent over the broker
+# anymore, the final reply only carries the object and the last BUILD_LOG_TAIL_LINES lines.
+# At most BUILD_LOG_QUEUE_LINES lines wait for the upload, the next ones are
+# left out of the object
+BUILD_LOG_ENABLED = os.environ.get('BUILD_LOG_ENABLED', 'true').lower() == 'true'
+BUILD_LOG_BUCKET = os.environ.get('BUILD_LOG_BUCKET', 'build-logs')
+BUILD_LOG_REPLY_LINES = os.environ.get('BUILD_LOG_REPLY_LINES', 'true').lower() == 'true'
+BUILD_LOG_TAIL_LINES = int(os.environ.get('BUILD_LOG_TAIL_LINES', 50))
+BUILD_LOG_QUEUE_LINES = int(os.environ.get('BUILD_LOG_QUEUE_LINES', 10000))
+
 docker_i: Docker = None
\ No newline at end of file
@@ -0,0 +1,204 @@
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from src.logger import get_logger
+
+logger = get_logger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    build_id TEXT PRIMARY KEY,
+    team_name TEXT,
+    image TEXT,
+    status TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    finished_at REAL,
+    stage TEXT,
+    stages TEXT,
+    data TEXT,
+    reply_to TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_team_name ON jobs (team_name, created_at);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+CREATE INDEX IF NOT EXISTS jobs_created_at ON jobs (created_at);
+"""
+
+# the request data of a job is kept while it can be requeued
+_UPSERT = """
+INSERT INTO jobs (build_id, team_name, image, status, created_at, finished_at, stage, stages, data, reply_to)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (build_id) DO UPDATE SET
+    team_name = excluded.team_name,
+    image = excluded.image,
+    status = excluded.status,
+    created_at = excluded.created_at,
+    finished_at = excluded.finished_at,
+    stage = excluded.stage,
+    stages = excluded.stages,
+    data = COALESCE(excluded.data, jobs.data),
+    reply_to = COALESCE(excluded.reply_to, jobs.reply_to)
+"""
+
+_COLUMNS = ("build_id", "team_name", "image", "status", "created_at", "finished_at", "stage", "stages", "data", "reply_to")
+
+
+class JobStore:
+    """SQLite copy of the job states, kept across restarts
+
+    The database runs in WAL mode. Job changes are queued by the event loop
+    and written by a background thread, in one transaction per batch, where
+    only the last change of a job in a batch is written. Jobs that are over
+    are deleted after `retention` seconds.
+    """
+
+    def __init__(self, path, batch_interval=0.2, batch_size=500, retention=30 * 24 * 3600):
+        """
+        Args:
+            path (str): path of the database file
+            batch_interval (float, optional): seconds the writer waits for more changes before writing a batch
+            batch_size (int, optional): maximum number of changes written at once
+            retention (float, optional): seconds the jobs that are over are kept
+        """
+        self.path = path
+        self.batch_interval = batch_interval
+        self.batch_size = batch_size
+        self.retention = retention
+        self.changes = queue.SimpleQueue()
+        self.writer = None
+        self.reader = None
+        self.read_lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def open(self):
+        """Create the database if needed and start the writer"""
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.reader = self._connect()
+        self.reader.executescript(_SCHEMA)
+        self.writer = threading.Thread(target=self._write_loop, name="job-store-writer", daemon=True)
+        self.writer.start()
+        logger.info(f"job store {self.path} opened")
+
+    def close(self):
+        """Write the queued changes and stop the writer"""
+        if self.writer is not None:
+            self.changes.put(None)
+            self.writer.join()
+            self.writer = None
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+    def save(self, row):
+        """Queue the change of a job
+
+        Args:
+            row (tuple): values of the job in the order of the columns, stages and data not encoded yet
+        """
+        self.changes.put(row)
+
+    def load(self, limit, final_states):
+        """Latest jobs and every job not over, newest first
+
+        Args:
+            limit (int): maximum number of jobs over
+            final_states (iterable): states of the jobs that are over, loaded without their request data
+
+        Returns:
+            list[dict]: jobs by column name
+        """
+        final_states = tuple(final_states)
+        marks = ",".join("?" * len(final_states))
+        with self.read_lock:
+            rows = self.reader.execute(
+                f"SELECT build_id, team_name, image, status, created_at, finished_at, stage, stages, "
+                f"CASE WHEN status IN ({marks}) THEN NULL ELSE data END, reply_to "
+                f"FROM jobs WHERE status NOT IN ({marks}) "
+                f"OR build_id IN (SELECT build_id FROM jobs ORDER BY created_at DESC LIMIT ?) "
+                f"ORDER BY created_at DESC",
+                (*final_states, *final_states, limit),
+            ).fetchall()
+        return [self._decode(row) for row in rows]
+
+    def history(self, team_name=None, status=None, since=None, limit=100):
+        """Jobs matching the given filters, newest first
+
+        Args:
+            team_name (str, optional): team of the jobs
+            status (str, optional): status of the jobs
+            since (float, optional): only jobs created after this timestamp
+            limit (int, optional): maximum number of jobs
+
+        Returns:
+            list[dict]: jobs by column name, without their request data
+        """
+        where, params = [], []
+        for column, value in (("team_name", team_name), ("status", status)):
+            if value is not None:
+                where.append(f"{column} = ?")
+                params.append(value)
+        if since is not None:
+            where.append("created_at >= ?")
+            params.append(since)
+        query = "SELECT build_id, team_name, image, status, created_at, finished_at, stage, stages, NULL, NULL FROM jobs"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY created_at DESC LIMIT ?"
+        with self.read_lock:
+            rows = self.reader.execute(query, (*params, limit)).fetchall()
+        out = []
+        for row in rows:
+            job = self._decode(row)
+            del job["data"], job["reply_to"]
+            out.append(job)
+        return out
+
+    @staticmethod
+    def _decode(row):
+        job = dict(zip(_COLUMNS, row))
+        job["stages"] = json.loads(job["stages"]) if job["stages"] else {}
+        job["data"] = json.loads(job["data"]) if job["data"] else None
+        return job
+
+    def _write_loop(self):
+        conn = self._connect()
+        last_cleanup = 0
+        stop = False
+        while not stop:
+            row = self.changes.get()
+            if row is None:
+                break
+            batch = {row[0]: row}
+            deadline = time.monotonic() + self.batch_interval
+            while len(batch) < self.batch_size:
+                try:
+                    row = self.changes.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if row is None:
+                    stop = True
+                    break
+                batch[row[0]] = row
+            try:
+                with conn:
+                    conn.executemany(_UPSERT, [self._encode(row) for row in batch.values()])
+                    if time.time() - last_cleanup > 3600:
+                        last_cleanup = time.time()
+                        conn.execute("DELETE FROM jobs WHERE finished_at < ?", (last_cleanup - self.retention,))
+            except Exception as e:
+                logger.error(f"Failed to write {len(batch)} jobs to the job store: {e}")
+        conn.close()
+
+    @staticmethod
+    def _encode(row):
+        row = list(row)
+        row[7] = json.dumps(row[7])
+        row[8] = json.dumps(row[8]) if row[8] is not None else None
+        return row
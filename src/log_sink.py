@@ -0,0 +1,149 @@
+import asyncio
+import collections
+import gzip
+import json
+import os
+import queue
+import threading
+from src import metrics
+from src.logger import get_logger
+from src.storage import MinioClient
+
+logger = get_logger(__name__)
+
+# smallest part size of a multipart upload, also the most the upload buffers
+PART_SIZE = 5 * 1024 * 1024
+
+
+class _CountingWriter:
+    def __init__(self, out):
+        self.out = out
+        self.size = 0
+
+    def write(self, data):
+        self.out.write(data)
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        self.out.flush()
+
+
+class BuildLogSink:
+    """Reply function keeping the full log of a build in the storage
+
+    Every reply of the build is written as a JSON line to a gzip stream that
+    is uploaded to `bucket_name/object_name` while the build runs, with a
+    multipart upload of unknown length, so memory stays bounded by a part.
+    Compression and upload run on their own threads, the event loop only
+    queues the lines, at most `max_queued_lines` of them: when the upload
+    falls behind, the next lines are dropped from the object and counted.
+
+    Log replies (`{"stage": ..., "data": ...}`) are passed on to `reply` only
+    with `forward_lines`; the other replies always are. Closing the sink
+    sends a final `{"log": {...}}` reply with the object, its size and the
+    last `tail_lines` log lines. When the upload fails, the log lines are
+    forwarded again so they are not lost.
+    """
+
+    def __init__(self, reply, storage: MinioClient, bucket_name, object_name, tail_lines=50, forward_lines=False, max_queued_lines=10000):
+        self.reply = reply
+        self.storage = storage
+        self.bucket_name = bucket_name
+        self.object_name = object_name
+        self.forward_lines = forward_lines
+        self.tail = collections.deque(maxlen=tail_lines)
+        self.lines = queue.Queue(maxsize=max_queued_lines)
+        self.dropped = 0
+        self.counter = None
+        self.reader = None
+        self.writer = None
+        self.upload = None
+        self.failed = False
+
+    async def start(self):
+        try:
+            await self.storage.ensure_bucket(self.bucket_name)
+        except Exception as e:
+            self._fail(e)
+            return
+        read_fd, write_fd = os.pipe()
+        self.reader = os.fdopen(read_fd, "rb")
+        self.counter = _CountingWriter(os.fdopen(write_fd, "wb"))
+        self.writer = threading.Thread(target=self._write, daemon=True)
+        self.writer.start()
+        self.upload = asyncio.ensure_future(self.storage.put_object(
+            self.bucket_name, self.object_name, self.reader, length=-1,
+            content_type="application/gzip", part_size=PART_SIZE
+        ))
+        self.upload.add_done_callback(self._on_upload_done)
+
+    def _on_upload_done(self, task):
+        # a failed upload stops reading, unblock the writer
+        if task.cancelled() or task.exception() is not None:
+            self.reader.close()
+
+    def _fail(self, e):
+        if not self.failed:
+            logger.error(f"Build log upload to {self.bucket_name}/{self.object_name} failed: {e}")
+            metrics.incr("build_log_upload_failures")
+        self.failed = True
+
+    def _write(self):
+        try:
+            with gzip.GzipFile(fileobj=self.counter, mode="wb") as gz:
+                while True:
+                    line = self.lines.get()
+                    if line is None:
+                        break
+                    gz.write(line)
+        except (OSError, ValueError):
+            # the upload failed, drop the rest of the log
+            while self.lines.get() is not None:
+                pass
+        finally:
+            try:
+                self.counter.out.close()
+            except OSError:
+                pass
+
+    async def __call__(self, message):
+        is_line = isinstance(message, dict) and set(message.keys()) == {"stage", "data"}
+        if self.writer is not None:
+            try:
+                self.lines.put_nowait(json.dumps(message, default=str).encode() + b"\n")
+            except queue.Full:
+                self.dropped += 1
+        if is_line:
+            self.tail.append(message)
+        if not is_line or self.forward_lines or self.failed or (self.upload is not None and self.upload.done()):
+            await self.reply(message)
+
+    async def close(self):
+        """Finish the upload and send the summary of the log"""
+        if self.writer is None:
+            if self.failed:
+                await self.reply({"log": {"error": "upload failed", "tail": list(self.tail)}})
+            return
+        # the writer may be behind, wait for room for the end of the log
+        await asyncio.to_thread(self.lines.put, None)
+        await asyncio.to_thread(self.writer.join)
+        try:
+            await self.upload
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self.reader.close()
+        self.writer = None
+        if self.failed:
+            # the lines sent before the failure only made it to the object
+            await self.reply({"log": {"error": "upload failed", "tail": list(self.tail)}})
+            return
+        metrics.incr("build_log_bytes", self.counter.size)
+        log = {"bucket": self.bucket_name, "object": self.object_name, "size": self.counter.size}
+        if self.dropped:
+            logger.warning(f"{self.dropped} lines were left out of the build log {self.bucket_name}/{self.object_name}")
+            metrics.incr("build_log_lines_dropped", self.dropped)
+            log["dropped"] = self.dropped
+        log["tail"] = list(self.tail)
+        await self.reply({"log": log})
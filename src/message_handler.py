@@ -77,6 +77,7 @@ class MessageHandler:
             function_input = {
                 "data": body, 
                 "reply": reply, 
+                "reply_to": frame.headers.get('reply-to'),
                 **self.singletons
             }
 
@@ -1,21 +1,44 @@
 import logging
-import multiprocessing
 import os
 import shutil
 import tarfile
 import tempfile
 from src import env
+from src.build_pool import BuildWorkerPool
 from src.docker import Docker
 from src.states import StateManager
 from src.storage import MinioClient
 from src.decorators import required_fields
 from src.utils.client_initializer import initialize_clients
+from src.utils.build_context import TeamContextStream, validate_team_archive
+from src.build_cache import BuildCache
+from src.archive_cache import ArchiveCache
+from src.base_image import BaseImageManager
+from src.build_limits import StageTimeout, container_limits, stage_timeouts
+from src.oci import build_team_layer, parse_team_instructions, team_image
+from src.registry import RegistryClient, file_sender
+from src.single_flight import BuildSingleFlight
 from src.env import (
+    ARCHIVE_CACHE_ENABLED,
+    ARCHIVE_CACHE_FOLDER,
+    ARCHIVE_CACHE_MAX_BYTES,
+    BASE_IMAGE_ENABLED,
+    BASE_IMAGE_LOCK,
+    BASE_IMAGE_NAME,
+    BUILD_CACHE_ENABLED,
+    BUILD_CACHE_FOLDER,
+    BUILDER_BACKEND,
+    BUILDERS,
+    BUILDKIT_BUILDER,
+    BUILDKIT_CACHE_IMAGE,
     DEFAULT_TEAM_BUILD_DOCKERFILE,
     DEFAULT_UPLOAD_FOLDER,
     REMOVE_AFTER_BUILD,
+    TEAM_FILE_MODE,
     USE_TMP_UPLOAD_FOLDER,
 )
+import contextlib
+import hashlib
 import json
 import asyncio
 
@@ -33,7 +56,7 @@ async def reply_stage(reply, stage_id, message):
 
 
 async def reply_stage_state(reply, stages, current_stage, stage_id, stage_state):
-    if stage_state == "success":
+    if stage_state in ("success", "skipped"):
         # find index of the current stage
         current = stages.index(next(filter(lambda x: x["id"] == stage_id, stages)))
         current_stage["i"] = current + 1 if current < len(stages) - 1 else current
@@ -45,6 +68,33 @@ async def log_reply(reply, stages, current_stage, message, log_fn=logger.info, e
     await reply_stage(reply, stages[current_stage["i"]]["id"], message)
 
 
+async def run_stage(reply, stages, current_stage, stage_id, timeout, coro):
+    """Await a stage, failing it when it is not done within its deadline
+
+    Raises:
+        StageTimeout: the stage did not finish in time
+    """
+    try:
+        return await asyncio.wait_for(coro, timeout)
+    except asyncio.TimeoutError:
+        error = StageTimeout(stage_id, timeout)
+        await log_reply(reply, stages, current_stage, str(error), logger.error)
+        await reply_stage_state(reply, stages, current_stage, stage_id, "timeout")
+        raise error
+
+
+def build_workspace(data):
+    """Folder a build downloads and extracts the team archive to"""
+    return os.path.join(DEFAULT_UPLOAD_FOLDER, f"{data['build_id']}_{data['team_name']}")
+
+
+def remove_build_workspace(data):
+    """Remove the folder of a build, e.g. after it has been killed"""
+    if USE_TMP_UPLOAD_FOLDER:
+        return
+    shutil.rmtree(build_workspace(data), ignore_errors=True)
+
+
 async def input_validation(data, docker, storage, reply, stages, current_stage, **kwargs):
     await reply_stage_state(reply, stages, current_stage, "input_validation", "start")
     
@@ -60,6 +110,11 @@ async def input_validation(data, docker, storage, reply, stages, current_stage,
     tmp_folder = None
     tmp_file = None
 
+    builder = data.get("builder", BUILDER_BACKEND)
+    if builder not in BUILDERS:
+        await log_reply(reply, stages, current_stage, f"Invalid builder {builder!r}, expected one of {', '.join(BUILDERS)}", logger.error)
+        return build_id, team_name, image_name, image_tag, file_name, bucket, tmp_folder, tmp_file, None, None
+
     if "registry" not in data:
         data["registry"] = {"_type": "docker", "_config": "default"}
 
@@ -73,7 +128,7 @@ async def input_validation(data, docker, storage, reply, stages, current_stage,
         tmp_file = os.path.join(tmp_folder, file_name)
         await log_reply(reply, stages, current_stage, f"Using tmp folder for build")
     else:
-        tmp_folder = os.path.join(DEFAULT_UPLOAD_FOLDER, f"{build_id}_{team_name}")
+        tmp_folder = build_workspace(data)
         await log_reply(reply, stages, current_stage, f"Using pre-defined folder for build")
         os.makedirs(tmp_folder, exist_ok=True)
         tmp_file = os.path.join(tmp_folder, file_name)
@@ -100,11 +155,13 @@ async def input_validation(data, docker, storage, reply, stages, current_stage,
     return build_id, team_name, image_name, image_tag, file_name, bucket, tmp_folder, tmp_file, team_dockerfile_path, extracted_data
 
 
-async def file_download(reply, stages, current_stage, extracted_data, bucket, file_name, tmp_file):
+async def file_download(reply, stages, current_stage, extracted_data, bucket, file_name, tmp_file, archive_cache=None):
     await reply_stage_state(reply, stages, current_stage, "file_download", "start")
 
+    client = extracted_data["file"]["_client"]
     try:
-        if await extracted_data["file"]["_client"].has_object(bucket_name=bucket, object_name=file_name):
+        stat = await client.has_object(bucket_name=bucket, object_name=file_name)
+        if stat:
             logger.info("File found in S3")
         else:
             await log_reply(reply, stages, current_stage, "File not found in S3", logger.error)
@@ -113,20 +170,33 @@ async def file_download(reply, stages, current_stage, extracted_data, bucket, fi
         await log_reply(reply, stages, current_stage, "Failed to check if file exists in S3", logger.error, e)
         return False
 
+    if archive_cache is not None and await asyncio.to_thread(archive_cache.link, bucket, file_name, stat.etag, tmp_file):
+        await log_reply(reply, stages, current_stage, "Team file found in the archive cache")
+        await reply_stage_state(reply, stages, current_stage, "file_download", "success")
+        return True
+
     try:
-        await extracted_data["file"]["_client"].download_file(extracted_data["file"]["bucket"], file_name, tmp_file)
+        if stat.size >= client.range_threshold:
+            await log_reply(reply, stages, current_stage, f"Downloading {stat.size} bytes in parallel ranges")
+            await client.download_file_ranged(bucket, file_name, tmp_file, size=stat.size, etag=stat.etag)
+        else:
+            await client.download_file(bucket, file_name, tmp_file)
         logger.info(f"Team File Download Successful {tmp_file}")
     except Exception as e:
         await log_reply(reply, stages, current_stage, "Failed to download file from S3", logger.error, e)
         return False
 
+    if archive_cache is not None:
+        try:
+            await asyncio.to_thread(archive_cache.insert, bucket, file_name, stat.etag, tmp_file)
+        except Exception as e:
+            logger.error(f"Failed to add {file_name} to the archive cache: {e}")
+
     await reply_stage_state(reply, stages, current_stage, "file_download", "success")
     return True
 
 
-async def file_extract(reply, stages, current_stage, tmp_file, tmp_folder):
-    await reply_stage_state(reply, stages, current_stage, "file_extract", "start")
-
+async def make_build_folders(reply, stages, current_stage, tmp_folder):
     extracted_folder_path = os.path.join(tmp_folder, "extracted")
     docker_folder_path = os.path.join(tmp_folder, "docker")
     try:
@@ -135,6 +205,83 @@ async def file_extract(reply, stages, current_stage, tmp_file, tmp_folder):
     except Exception as e:
         await log_reply(reply, stages, current_stage, "Failed to create extracted and docker folders", logger.error, e)
         return None, None
+    return extracted_folder_path, docker_folder_path
+
+
+async def file_download_stream(reply, stages, current_stage, extracted_data, bucket, file_name, tmp_folder, archive_cache=None):
+    """Download the team archive and extract it on the fly
+
+    The storage response is fed straight into a streaming tar reader, so the
+    archive is decompressed and written to the extracted folder as the bytes
+    arrive, and the .tar.gz itself never touches the disk.
+    Reports both the file_download and the file_extract stages.
+    """
+    await reply_stage_state(reply, stages, current_stage, "file_download", "start")
+
+    client = extracted_data["file"]["_client"]
+    try:
+        stat = await client.has_object(bucket_name=bucket, object_name=file_name)
+        if stat:
+            logger.info("File found in S3")
+        else:
+            await log_reply(reply, stages, current_stage, "File not found in S3", logger.error)
+            return None, None
+    except Exception as e:
+        await log_reply(reply, stages, current_stage, "Failed to check if file exists in S3", logger.error, e)
+        return None, None
+
+    extracted_folder_path, docker_folder_path = await make_build_folders(reply, stages, current_stage, tmp_folder)
+    if not extracted_folder_path or not docker_folder_path:
+        return None, None
+
+    try:
+        tee = None
+        cached = None
+        if archive_cache is not None:
+            cached = await asyncio.to_thread(archive_cache.open, bucket, file_name, stat.etag)
+        if cached is not None:
+            await log_reply(reply, stages, current_stage, "Team file found in the archive cache")
+            response = cached
+        elif stat.size >= client.range_threshold:
+            await log_reply(reply, stages, current_stage, f"Downloading {stat.size} bytes in parallel ranges")
+            response = client.open_object_ranged(bucket, file_name, size=stat.size, etag=stat.etag)
+        else:
+            response = await client.get_object(bucket, file_name)
+        if cached is None and archive_cache is not None:
+            response = tee = archive_cache.tee(bucket, file_name, stat.etag, response)
+
+        def extract():
+            try:
+                with tarfile.open(fileobj=response, mode="r|*") as tar:
+                    tar.extractall(path=extracted_folder_path)
+                if tee is not None:
+                    try:
+                        tee.commit()
+                    except Exception as e:
+                        logger.error(f"Failed to add {file_name} to the archive cache: {e}")
+            finally:
+                response.close()
+                if hasattr(response, "release_conn"):
+                    response.release_conn()
+            logger.info(f"Tar file streamed and extracted successfully to {extracted_folder_path}")
+        await asyncio.to_thread(extract)
+    except Exception as e:
+        await log_reply(reply, stages, current_stage, "Failed to download and extract file from S3", logger.error, e)
+        return None, None
+
+    await reply_stage_state(reply, stages, current_stage, "file_download", "success")
+    await reply_stage_state(reply, stages, current_stage, "file_extract", "start")
+    await log_reply(reply, stages, current_stage, "Tar file has been extracted while downloading")
+    await reply_stage_state(reply, stages, current_stage, "file_extract", "success")
+    return extracted_folder_path, docker_folder_path
+
+
+async def file_extract(reply, stages, current_stage, tmp_file, tmp_folder):
+    await reply_stage_state(reply, stages, current_stage, "file_extract", "start")
+
+    extracted_folder_path, docker_folder_path = await make_build_folders(reply, stages, current_stage, tmp_folder)
+    if not extracted_folder_path or not docker_folder_path:
+        return None, None
 
     try:
         def extract():
@@ -233,21 +380,282 @@ async def file_validate(reply, stages, current_stage, extracted_folder_path, doc
     return True
 
 
-async def team_build(reply, stages, current_stage, extracted_data, docker_folder_path, image_name, image_tag):
+async def file_validate_archive(reply, stages, current_stage, tmp_file, team_name, team_dockerfile_path):
+    """Validate the team archive and prepare an in-memory docker context from it
+
+    Used instead of file_extract/file_validate when the docker context is
+    generated straight from the uploaded archive.
+    """
+    await reply_stage_state(reply, stages, current_stage, "file_extract", "start")
+    await log_reply(reply, stages, current_stage, "Build context will be generated from the archive")
+    await reply_stage_state(reply, stages, current_stage, "file_extract", "skipped")
+
+    await reply_stage_state(reply, stages, current_stage, "file_validate", "start")
+    try:
+        errors, dropped = await asyncio.to_thread(validate_team_archive, tmp_file, team_name)
+    except Exception as e:
+        await log_reply(reply, stages, current_stage, "Failed to read tar file", logger.error, e)
+        return None
+
+    for error in errors:
+        await log_reply(reply, stages, current_stage, error, logger.error)
+    if len(errors) > 0:
+        return None
+    await log_reply(reply, stages, current_stage, "All required files found")
+
+    for dockerfile in dropped:
+        await log_reply(reply, stages, current_stage, f"{dockerfile} has been found and will be left out of the build context")
+
+    if not os.path.isfile(team_dockerfile_path):
+        await log_reply(reply, stages, current_stage, "Team Dockerfile not found, using the default Dockerfile", logger.error)
+        team_dockerfile_path = DEFAULT_TEAM_BUILD_DOCKERFILE
+
+    context = TeamContextStream(tmp_file, team_name, team_dockerfile_path)
+    await reply_stage_state(reply, stages, current_stage, "file_validate", "success")
+    return context
+
+
+# base image managers of the worker, by registry
+base_images = {}
+
+
+async def prepare_base_image(reply, stages, current_stage, extracted_data, tmp_folder, team_dockerfile_path):
+    """Derive the team Dockerfile from its shared base image
+
+    Builds the base image first if the registry does not have it yet.
+
+    Returns:
+        tuple[str, str]: path of the Dockerfile to build the team with and the base image, None if there is none
+    """
+    registry_client = extracted_data["registry"]["_client"]
+    manager = base_images.get(registry_client.default_registry)
+    if manager is None:
+        manager = base_images[registry_client.default_registry] = BaseImageManager(registry_client, BASE_IMAGE_LOCK, BASE_IMAGE_NAME)
+    try:
+        base = await asyncio.to_thread(manager.ensure, team_dockerfile_path)
+    except Exception as e:
+        await log_reply(reply, stages, current_stage, "Failed to prepare the base image, building the full Dockerfile", logger.error, e)
+        return team_dockerfile_path, None
+    if base is None:
+        return team_dockerfile_path, None
+
+    base_ref, dockerfile = base
+    derived_dockerfile_path = os.path.join(tmp_folder, "Dockerfile.derived")
+    with open(derived_dockerfile_path, "w") as f:
+        f.write(dockerfile)
+    await log_reply(reply, stages, current_stage, f"Building on base image {base_ref}")
+    return derived_dockerfile_path, base_ref
+
+
+def base_repository(base_ref, registry):
+    """Repository and tag of a base image ref of the given registry
+
+    Returns:
+        tuple[str, str]: name and tag, None if the ref is not a tagged image of the registry
+    """
+    if not base_ref.startswith(f"{registry}/"):
+        return None
+    name, _, tag = base_ref[len(registry) + 1:].rpartition(":")
+    if not name or not tag or "/" in tag or "@" in name:
+        return None
+    return name, tag
+
+
+async def prepare_oci_build(reply, stages, current_stage, team_dockerfile_path, registry):
+    """Check if the team image can be assembled without the docker daemon
+
+    The base image is read over the registry API, so it has to be in the
+    registry the team image is pushed to.
+
+    Returns:
+        dict: plan of the image, see parse_team_instructions, None to use the daemon
+    """
+    with open(team_dockerfile_path) as f:
+        plan = parse_team_instructions(f.read())
+    if plan is None:
+        await log_reply(reply, stages, current_stage, "Dockerfile can't be assembled without the docker daemon, falling back to the legacy builder", logger.warning)
+    elif base_repository(plan["base"], registry) is None:
+        await log_reply(reply, stages, current_stage, f"Base image {plan['base']} is not in {registry}, falling back to the legacy builder", logger.warning)
+        plan = None
+    return plan
+
+
+def registry_api(registry_client: Docker):
+    return RegistryClient(registry_client.default_registry, registry_client.username, registry_client.password)
+
+
+async def build_cache_lookup(reply, stages, current_stage, extracted_data, bucket, file_name, team_name, team_dockerfile_path, build_cache):
+    """Look the build up in the build cache
+
+    The ETag of the team archive in storage identifies its content, so the
+    lookup happens before anything is downloaded. Entries are per team, the
+    archive of a hit has been validated for the same team.
+
+    Returns:
+        tuple[str, dict]: cache key (None if the cache can't be used) and the cache entry on a hit
+    """
+    if build_cache is None:
+        return None, None
+    try:
+        stat = await extracted_data["file"]["_client"].has_object(bucket_name=bucket, object_name=file_name)
+        if not stat or not stat.etag:
+            return None, None
+        key = BuildCache.make_key(f"{bucket}/{stat.etag}", team_dockerfile_path, team_name)
+    except Exception as e:
+        logger.error(f"Failed to compute build cache key: {e}")
+        return None, None
+
+    entry = build_cache.get(key)
+    if entry is None:
+        return key, None
+    if not extracted_data["registry"]["_client"].has_image(entry["image_id"]):
+        logger.info(f"Cached image {entry['image_id']} is gone, removing the cache entry")
+        build_cache.remove(key)
+        return key, None
+    return key, entry
+
+
+async def team_build_cached(reply, stages, current_stage, extracted_data, image_name, image_tag, cache_entry):
+    for stage_id in ["file_download", "file_extract", "file_validate"]:
+        await reply_stage_state(reply, stages, current_stage, stage_id, "skipped")
+
     await reply_stage_state(reply, stages, current_stage, "team_build", "start")
+    await reply({"stage": "team_build", "cache": "hit"})
+    try:
+        extracted_data["registry"]["_client"].tag_image(cache_entry["image_id"], image_name, image_tag)
+        await log_reply(reply, stages, current_stage, f"Reusing cached image {cache_entry['image_id']}")
+    except Exception as e:
+        await log_reply(reply, stages, current_stage, "Failed to tag cached image", logger.error, e)
+        return False
+    await reply_stage_state(reply, stages, current_stage, "team_build", "success")
+    return True
+
+
+async def team_push_cached(reply, stages, current_stage, extracted_data, image_name, image_tag, cache_entry):
+    """Skip the push if the registry already has the cached image under the tag
+
+    Returns:
+        bool: True if the push has been skipped
+    """
+    registry_client = extracted_data["registry"]["_client"]
+    target = f"{registry_client.default_registry}/{image_name}:{image_tag}"
+    pushed_digest = cache_entry.get("pushed", {}).get(target)
+    if pushed_digest is None:
+        return False
+    registry_digest = await asyncio.to_thread(registry_client.registry_digest, image_name, image_tag)
+    if registry_digest != pushed_digest:
+        return False
+
+    await reply_stage_state(reply, stages, current_stage, "team_push", "start")
+    await log_reply(reply, stages, current_stage, f"Registry already has {target} ({registry_digest})")
+    await reply_stage_state(reply, stages, current_stage, "team_push", "skipped")
+    return True
+
+
+async def team_push_present(reply, stages, current_stage, extracted_data, image_name, image_tag, cache_entry=None):
+    """Skip the push if the registry already has the local image
+
+    The registry has it when the manifest under the tag is one the image was
+    pushed or pulled with (its RepoDigests), or points to the same image
+    config. A manifest of the image that is in the repository under another
+    tag only gets tagged, without uploading any blob.
+
+    Returns:
+        bool: True if the push has been skipped
+    """
+    registry_client = extracted_data["registry"]["_client"]
+    repository = f"{registry_client.default_registry}/{image_name}"
+    tagged = False
+    try:
+        image = await asyncio.to_thread(registry_client.api.inspect_image, f"{repository}:{image_tag}")
+        digests = [
+            repo_digest.split("@", 1)[1] for repo_digest in image.get("RepoDigests") or []
+            if repo_digest.split("@", 1)[0] == repository
+        ]
+        async with registry_api(registry_client) as registry:
+            digest = await registry.head_manifest(image_name, image_tag)
+            present = digest is not None and digest in digests
+            if digest is not None and not present:
+                _, _, body = await registry.get_manifest(image_name, image_tag)
+                present = json.loads(body).get("config", {}).get("digest") == image["Id"]
+            if not present:
+                for repo_digest in digests:
+                    if await registry.head_manifest(image_name, repo_digest) is None:
+                        continue
+                    _, media_type, body = await registry.get_manifest(image_name, repo_digest)
+                    digest = await registry.put_manifest(image_name, image_tag, body, media_type)
+                    present = tagged = True
+                    break
+    except Exception as e:
+        logger.warning(f"Failed to check if the registry has {repository}:{image_tag}: {e}")
+        return False
+    if not present:
+        return False
+
+    await reply_stage_state(reply, stages, current_stage, "team_push", "start")
+    await reply({"stage": "team_push", "push": "already present"})
+    if tagged:
+        await log_reply(reply, stages, current_stage, f"Registry already has the image, {repository}:{image_tag} has been tagged to {digest}")
+    else:
+        await log_reply(reply, stages, current_stage, f"Registry already has {repository}:{image_tag} ({digest})")
+    if cache_entry is not None:
+        cache_entry.setdefault("pushed", {})[f"{repository}:{image_tag}"] = digest
+    await reply_stage_state(reply, stages, current_stage, "team_push", "skipped")
+    return True
+
+
+async def team_build(reply, stages, current_stage, extracted_data, docker_folder_path, image_name, image_tag, context=None, cache_entry=None, builder="legacy", limits=None, timeout=12000):
+    await reply_stage_state(reply, stages, current_stage, "team_build", "start")
+    if cache_entry is not None:
+        await reply({"stage": "team_build", "cache": "miss"})
+    registry_client = extracted_data["registry"]["_client"]
+    if builder == "buildkit" and limits:
+        # buildx has no per build memory or cpu limits
+        await log_reply(reply, stages, current_stage, "BuildKit can't apply the resource limits, falling back to the legacy builder", logger.warning)
+        builder = "legacy"
+    if builder == "buildkit" and not await asyncio.to_thread(registry_client.buildkit_available):
+        await log_reply(reply, stages, current_stage, "BuildKit is not available, falling back to the legacy builder", logger.warning)
+        builder = "legacy"
+    await reply({"stage": "team_build", "builder": builder})
     try:
         loop = asyncio.get_running_loop()
         build_q = asyncio.Queue()
+        build_error = []
 
         def build():
-            build_result = extracted_data["registry"]["_client"].build_with_path(
-                path=docker_folder_path,
-                image_name=image_name,
-                image_tag=image_tag,
-            )
-            for line in build_result:
-                asyncio.run_coroutine_threadsafe(build_q.put(line), loop)
-            asyncio.run_coroutine_threadsafe(build_q.put(None), loop)
+            try:
+                if builder == "buildkit":
+                    build_result = registry_client.build_with_buildkit(
+                        image_name=image_name,
+                        image_tag=image_tag,
+                        path=docker_folder_path,
+                        context=context,
+                        cache_ref=f"{registry_client.default_registry}/{BUILDKIT_CACHE_IMAGE}",
+                        builder=BUILDKIT_BUILDER or None,
+                        timeout=timeout,
+                    )
+                elif context is not None:
+                    build_result = extracted_data["registry"]["_client"].build_with_context(
+                        context=context,
+                        image_name=image_name,
+                        image_tag=image_tag,
+                        timeout=timeout,
+                        container_limits=limits,
+                    )
+                else:
+                    build_result = extracted_data["registry"]["_client"].build_with_path(
+                        path=docker_folder_path,
+                        image_name=image_name,
+                        image_tag=image_tag,
+                        timeout=timeout,
+                        container_limits=limits,
+                    )
+                for line in build_result:
+                    asyncio.run_coroutine_threadsafe(build_q.put(line), loop)
+            except Exception as e:
+                build_error.append(e)
+            finally:
+                asyncio.run_coroutine_threadsafe(build_q.put(None), loop)
 
         asyncio.create_task(asyncio.to_thread(build))
 
@@ -264,28 +672,132 @@ async def team_build(reply, stages, current_stage, extracted_data, docker_folder
 
             logger.debug(msg)
             await log_reply(reply, stages, current_stage, msg, logger.debug)
+            if isinstance(msg, dict) and "error" in msg:
+                error = msg["error"]
+                if limits and "memory" in limits and "non-zero code: 137" in error:
+                    error += f" (killed, the build is limited to {limits['memory']} bytes of memory)"
+                build_error.append(Exception(error))
+
+        if build_error:
+            raise build_error[0]
+
+        if cache_entry is not None:
+            cache_entry["image_id"] = extracted_data["registry"]["_client"].image_id(image_name, image_tag)
 
     except Exception as e:
-        logger.error("Failed to build image", e)
+        await log_reply(reply, stages, current_stage, "Failed to build image", logger.error, e)
         return False
     await reply_stage_state(reply, stages, current_stage, "team_build", "success")
     return True
 
 
-async def team_push(reply, stages, current_stage, extracted_data, image_name, image_tag):
+async def team_build_oci(reply, stages, current_stage, extracted_data, tmp_file, tmp_folder, team_name, plan):
+    """Assemble the team image from its base image and the uploaded archive
+
+    Returns:
+        dict: layer, config and manifest of the image to push, None on failure
+    """
+    await reply_stage_state(reply, stages, current_stage, "team_build", "start")
+    await reply({"stage": "team_build", "builder": "oci"})
+    registry_client = extracted_data["registry"]["_client"]
+    try:
+        base_name, base_tag = base_repository(plan["base"], registry_client.default_registry)
+        layer_path = os.path.join(tmp_folder, "layer.tar.gz")
+        layer = await asyncio.to_thread(build_team_layer, tmp_file, team_name, plan["dest"], layer_path)
+        await log_reply(reply, stages, current_stage, f"Team layer {layer['digest']} ({layer['size']} bytes) has been created")
+
+        async with registry_api(registry_client) as registry:
+            _, _, body = await registry.get_manifest(base_name, base_tag)
+            base_manifest = json.loads(body)
+            base_config = await registry.get_blob_json(base_name, base_manifest["config"]["digest"])
+        config, manifest, media_type = team_image(base_manifest, base_config, layer, plan)
+        await log_reply(reply, stages, current_stage, f"Image assembled on base image {plan['base']}")
+    except Exception as e:
+        await log_reply(reply, stages, current_stage, "Failed to build image", logger.error, e)
+        return None
+    await reply_stage_state(reply, stages, current_stage, "team_build", "success")
+    return {
+        "base_name": base_name,
+        "base_layers": base_manifest["layers"],
+        "layer": layer,
+        "layer_path": layer_path,
+        "config": config,
+        "manifest": manifest,
+        "media_type": media_type,
+    }
+
+
+async def team_push_oci(reply, stages, current_stage, extracted_data, image_name, image_tag, image):
+    """Push an image assembled by team_build_oci straight to the registry"""
+    await reply_stage_state(reply, stages, current_stage, "team_push", "start")
+    try:
+        async with registry_api(extracted_data["registry"]["_client"]) as registry:
+            for base_layer in image["base_layers"]:
+                copied = await registry.copy_blob(image["base_name"], image_name, base_layer["digest"], base_layer["size"])
+                status = {"exists": "Layer already exists", "mounted": f"Mounted from {image['base_name']}", "pushed": "Pushed"}[copied]
+                await log_reply(reply, stages, current_stage, {"status": status, "id": base_layer["digest"][7:19]}, logger.debug)
+
+            layer = image["layer"]
+            pushed = await registry.push_blob(image_name, layer["digest"], layer["size"], lambda: file_sender(image["layer_path"]))
+            await log_reply(reply, stages, current_stage, {"status": "Pushed" if pushed else "Layer already exists", "id": layer["digest"][7:19]}, logger.debug)
+
+            config = image["config"]
+            config_digest = "sha256:" + hashlib.sha256(config).hexdigest()
+            await registry.push_blob(image_name, config_digest, len(config), config)
+            digest = await registry.put_manifest(image_name, image_tag, image["manifest"], image["media_type"])
+            await log_reply(reply, stages, current_stage, {"status": f"{image_tag}: digest: {digest} size: {len(image['manifest'])}"}, logger.debug)
+    except Exception as e:
+        await log_reply(reply, stages, current_stage, "Failed to push image to registry", logger.error, e)
+        return False
+    await reply_stage_state(reply, stages, current_stage, "team_push", "success")
+    return True
+
+
+async def mount_base_layers(reply, stages, current_stage, extracted_data, image_name, base_ref):
+    """Mount the layers of the base image into the repository of the team
+
+    The registry links the blobs the base repository has instead of getting
+    them uploaded again for every team repository, the daemon push then
+    finds them already there.
+    """
+    registry_client = extracted_data["registry"]["_client"]
+    base_name, base_tag = base_ref[len(registry_client.default_registry) + 1:].rsplit(":", 1)
+    try:
+        async with registry_api(registry_client) as registry:
+            _, _, body = await registry.get_manifest(base_name, base_tag)
+            mounted = 0
+            for layer in json.loads(body)["layers"]:
+                if not await registry.has_blob(image_name, layer["digest"]) \
+                        and await registry.mount_blob(base_name, image_name, layer["digest"]):
+                    mounted += 1
+    except Exception as e:
+        logger.warning(f"Failed to mount the layers of {base_ref}: {e}")
+        return
+    if mounted:
+        await log_reply(reply, stages, current_stage, f"{mounted} base layers have been mounted from {base_name}")
+
+
+async def team_push(reply, stages, current_stage, extracted_data, image_name, image_tag, cache_entry=None, base_ref=None):
     await reply_stage_state(reply, stages, current_stage, "team_push", "start")
+    if base_ref is not None:
+        await mount_base_layers(reply, stages, current_stage, extracted_data, image_name, base_ref)
     try:
         loop = asyncio.get_running_loop()
         push_q = asyncio.Queue()
+        push_error = []
 
         def push():
-            push_result = extracted_data["registry"]["_client"].push_to_registry(
-                image_name=image_name,
-                image_tag=image_tag,
-            )
-            for line in push_result:
-                asyncio.run_coroutine_threadsafe(push_q.put(line), loop)
-            asyncio.run_coroutine_threadsafe(push_q.put(None), loop)
+            try:
+                push_result = extracted_data["registry"]["_client"].push_to_registry(
+                    image_name=image_name,
+                    image_tag=image_tag,
+                )
+                for line in push_result:
+                    asyncio.run_coroutine_threadsafe(push_q.put(line), loop)
+            except Exception as e:
+                push_error.append(e)
+            finally:
+                asyncio.run_coroutine_threadsafe(push_q.put(None), loop)
 
         asyncio.create_task(asyncio.to_thread(push))
 
@@ -302,6 +814,14 @@ async def team_push(reply, stages, current_stage, extracted_data, image_name, im
 
             logger.debug(msg)
             await log_reply(reply, stages, current_stage, msg, logger.debug)
+            if isinstance(msg, dict) and "error" in msg:
+                push_error.append(Exception(msg["error"]))
+            elif isinstance(msg, dict) and cache_entry is not None and "Digest" in msg.get("aux", {}):
+                target = f'{extracted_data["registry"]["_client"].default_registry}/{image_name}:{image_tag}'
+                cache_entry.setdefault("pushed", {})[target] = msg["aux"]["Digest"]
+
+        if push_error:
+            raise push_error[0]
 
     except Exception as e:
         await log_reply(reply, stages, current_stage, "Failed to push image to registry", logger.error, e)
@@ -314,8 +834,9 @@ async def cleanup(reply, stages, current_stage, extracted_folder_path, docker_fo
     await reply_stage_state(reply, stages, current_stage, "cleanup", "start")
     if REMOVE_AFTER_BUILD:
         try:
-            shutil.rmtree(extracted_folder_path)
-            shutil.rmtree(docker_folder_path)
+            for folder_path in (extracted_folder_path, docker_folder_path):
+                if folder_path is not None:
+                    shutil.rmtree(folder_path)
         except Exception as e:
             await log_reply(reply, stages, current_stage, "Failed to remove the extracted folder", logger.error, e)
             return False
@@ -323,85 +844,200 @@ async def cleanup(reply, stages, current_stage, extracted_folder_path, docker_fo
     return True
 
 
-@required_fields(
-    fields=[
-        "build_id",
-        "team_name",
-        "image_name",
-        "image_tag",
-        "file.file_id",
-        "file.bucket",
-        "file._type",
+@contextlib.asynccontextmanager
+async def no_stage_slot(stage_class):
+    yield
+
+
+async def run_build_job(data: dict, docker: Docker, storage: MinioClient, reply, update_state, stage_slot=no_stage_slot, **kwargs):
+    """Run all the stages of a build
+
+    Runs inside a build worker process, see src/build_pool.py.
+
+    Args:
+        data (dict): body of the build message
+        docker (Docker): default docker client of the worker
+        storage (MinioClient): default storage client of the worker
+        reply (callable): async function sending a reply for the build
+        update_state (callable): function reporting a new state of the build
+        stage_slot (callable, optional): async context manager holding a slot of a stage class (download, build, push)
+
+    Raises:
+        StageTimeout: a stage did not finish within its deadline, see stage_timeouts
+    """
+    update_state("progress")
+    stages = [
+        {"id": "input_validation", "name": "Input Validation"},
+        {"id": "file_download", "name": "File Download"},
+        {"id": "file_extract", "name": "File Extract"},
+        {"id": "file_validate", "name": "File Validate"},
+        {"id": "team_build", "name": "Team Build"},
+        {"id": "team_push", "name": "Team Push"},
+        {"id": "cleanup", "name": "Cleanup"},
     ]
-)
-async def build_command_handler(
-    data: dict, docker: Docker, storage: MinioClient, reply, state_manager: StateManager,
-    **kwargs
-):
-    async def async_run_job(queue: asyncio.Queue):
-        queue.put(("update_state", data["build_id"], "progress"))
-        stages = [
-            {"id": "input_validation", "name": "Input Validation"},
-            {"id": "file_download", "name": "File Download"},
-            {"id": "file_extract", "name": "File Extract"},
-            {"id": "file_validate", "name": "File Validate"},
-            {"id": "team_build", "name": "Team Build"},
-            {"id": "team_push", "name": "Team Push"},
-            {"id": "cleanup", "name": "Cleanup"},
-        ]
-
-        current_stage = {"i": 0}
 
-        await reply({"stages": stages})
-
-        build_id, team_name, image_name, image_tag, file_name, bucket, tmp_folder, tmp_file, team_dockerfile_path, extracted_data = \
-            await input_validation(data, docker, storage, reply, stages, current_stage, **kwargs)
-            
-        if not extracted_data:
+    current_stage = {"i": 0}
+
+    await reply({"stages": stages})
+
+    build_id, team_name, image_name, image_tag, file_name, bucket, tmp_folder, tmp_file, team_dockerfile_path, extracted_data = \
+        await input_validation(data, docker, storage, reply, stages, current_stage, **kwargs)
+        
+    if not extracted_data:
+        return
+
+    timeouts, warnings = stage_timeouts(data)
+    limits, limit_warnings = container_limits(data)
+    for warning in warnings + limit_warnings:
+        await log_reply(reply, stages, current_stage, warning, logger.warning)
+
+    base_ref = None
+    if BASE_IMAGE_ENABLED:
+        team_dockerfile_path, base_ref = await prepare_base_image(reply, stages, current_stage, extracted_data, tmp_folder, team_dockerfile_path)
+
+    builder = data.get("builder", BUILDER_BACKEND)
+    oci_plan = None
+    if builder == "oci":
+        oci_plan = await prepare_oci_build(reply, stages, current_stage, team_dockerfile_path, extracted_data["registry"]["_client"].default_registry)
+        if oci_plan is None:
+            builder = "legacy"
+
+    # images assembled without the daemon can't be reused from it
+    build_cache = BuildCache(BUILD_CACHE_FOLDER) if BUILD_CACHE_ENABLED and oci_plan is None else None
+    archive_cache = ArchiveCache(ARCHIVE_CACHE_FOLDER, ARCHIVE_CACHE_MAX_BYTES) if ARCHIVE_CACHE_ENABLED else None
+    cache_key, cache_entry = await build_cache_lookup(reply, stages, current_stage, extracted_data, bucket, file_name, team_name, team_dockerfile_path, build_cache)
+
+    extracted_folder_path, docker_folder_path = None, None
+    image = None
+    if cache_entry is not None:
+        if not await team_build_cached(reply, stages, current_stage, extracted_data, image_name, image_tag, cache_entry):
             return
-
-        if not await file_download(reply, stages, current_stage, extracted_data, bucket, file_name, tmp_file):
+    else:
+        cache_entry = {"image_id": None, "pushed": {}} if cache_key is not None else None
+        context = None
+        if TEAM_FILE_MODE == "context" or oci_plan is not None:
+            async with stage_slot("download"):
+                downloaded = await run_stage(reply, stages, current_stage, "file_download", timeouts["download"],
+                    file_download(reply, stages, current_stage, extracted_data, bucket, file_name, tmp_file, archive_cache))
+            if not downloaded:
+                return
+
+            context = await run_stage(reply, stages, current_stage, "file_validate", timeouts["extract"],
+                file_validate_archive(reply, stages, current_stage, tmp_file, team_name, team_dockerfile_path))
+            if context is None:
+                return
+        else:
+            if TEAM_FILE_MODE == "stream":
+                async with stage_slot("download"):
+                    extracted_folder_path, docker_folder_path = await run_stage(reply, stages, current_stage, "file_download", timeouts["download"],
+                        file_download_stream(reply, stages, current_stage, extracted_data, bucket, file_name, tmp_folder, archive_cache))
+                if not extracted_folder_path or not docker_folder_path:
+                    return
+            else:
+                async with stage_slot("download"):
+                    downloaded = await run_stage(reply, stages, current_stage, "file_download", timeouts["download"],
+                        file_download(reply, stages, current_stage, extracted_data, bucket, file_name, tmp_file, archive_cache))
+                if not downloaded:
+                    return
+
+                extracted_folder_path, docker_folder_path = await run_stage(reply, stages, current_stage, "file_extract", timeouts["extract"],
+                    file_extract(reply, stages, current_stage, tmp_file, tmp_folder))
+                if not extracted_folder_path or not docker_folder_path:
+                    return
+
+            if not await file_validate(reply, stages, current_stage, extracted_folder_path, docker_folder_path, team_name, team_dockerfile_path):
+                return
+
+        async with stage_slot("build"):
+            if oci_plan is not None:
+                image = await run_stage(reply, stages, current_stage, "team_build", timeouts["build"],
+                    team_build_oci(reply, stages, current_stage, extracted_data, tmp_file, tmp_folder, team_name, oci_plan))
+                built = image is not None
+            else:
+                built = await run_stage(reply, stages, current_stage, "team_build", timeouts["build"],
+                    team_build(reply, stages, current_stage, extracted_data, docker_folder_path, image_name, image_tag, context, cache_entry, builder, limits, timeouts["build"]))
+        if not built:
             return
 
-        extracted_folder_path, docker_folder_path = await file_extract(reply, stages, current_stage, tmp_file, tmp_folder)
-        if not extracted_folder_path or not docker_folder_path:
+    if image is not None:
+        async with stage_slot("push"):
+            pushed = await run_stage(reply, stages, current_stage, "team_push", timeouts["push"],
+                team_push_oci(reply, stages, current_stage, extracted_data, image_name, image_tag, image))
+        if not pushed:
             return
-
-        if not await file_validate(reply, stages, current_stage, extracted_folder_path, docker_folder_path, team_name, team_dockerfile_path):
+    else:
+        # the registry checks before the push are push stage traffic too
+        async with stage_slot("push"):
+            pushed = (
+                cache_entry is not None and await team_push_cached(reply, stages, current_stage, extracted_data, image_name, image_tag, cache_entry)
+                or await team_push_present(reply, stages, current_stage, extracted_data, image_name, image_tag, cache_entry)
+                or await run_stage(reply, stages, current_stage, "team_push", timeouts["push"],
+                    team_push(reply, stages, current_stage, extracted_data, image_name, image_tag, cache_entry, base_ref))
+            )
+        if not pushed:
             return
 
-        if not await team_build(reply, stages, current_stage, extracted_data, docker_folder_path, image_name, image_tag):
-            return
+    if cache_entry is not None and cache_entry["image_id"] is not None:
+        try:
+            build_cache.put(cache_key, cache_entry)
+        except Exception as e:
+            logger.error(f"Failed to store build cache entry: {e}")
 
-        if not await team_push(reply, stages, current_stage, extracted_data, image_name, image_tag):
-            return
+    if not await cleanup(reply, stages, current_stage, extracted_folder_path, docker_folder_path):
+        return
 
-        if not await cleanup(reply, stages, current_stage, extracted_folder_path, docker_folder_path):
-            return
+    await log_reply(reply, stages, current_stage, f"Image {image_name}:{image_tag} has been built and pushed successfully", logger.info)
+    update_state("finished")
 
-        await log_reply(reply, stages, current_stage, f"Image {image_name}:{image_tag} has been built and pushed successfully", logger.info)
-        queue.put(("update_state", data["build_id"], "finished"))
-    
-    def run_job(queue: asyncio.Queue):
-        asyncio.run(async_run_job(queue))
 
-    queue = multiprocessing.Queue()
-    task = multiprocessing.Process(target=run_job, args=(queue,))
-    state_manager.add_run_job(data["build_id"], task, data)
-    task.start()
+async def single_flight_key(data, storage: MinioClient):
+    """Identity of a build for BuildSingleFlight
 
-    async def state_updater(loop):
-        while True:
-            try:
-                msg = queue.get_nowait()
-                if msg[0] == "update_state":
-                    asyncio.run_coroutine_threadsafe(state_manager.update_state(msg[1], msg[2]), loop)
-            except Exception as e:
-                pass
+    Builds pushing the same image to the same registry from the same team
+    file, with the same options, are identical. The file is identified by
+    its ETag, so only files of the default storage can be compared.
 
-            if not task.is_alive():
-                break
-    t = asyncio.create_task(asyncio.to_thread(state_updater, asyncio.get_running_loop()))
-    await t
-    task.join()
-    return
\ No newline at end of file
+    Returns:
+        str: key of the build, None if it can't be compared
+    """
+    file = data["file"]
+    if file.get("_config", "default") != "default" or storage is None:
+        return None
+    try:
+        stat = await storage.has_object(bucket_name=file["bucket"], object_name=f'{file["file_id"]}.tar.gz')
+    except Exception as e:
+        logger.debug(f"Can't stat the team file of build_id: {data['build_id']}: {e}")
+        return None
+    if not stat:
+        return None
+    identity = [
+        data.get("registry", {}).get("_config", "default"),
+        data["team_name"],
+        f'{data["image_name"]}:{data["image_tag"]}',
+        f'{file["bucket"]}/{file["file_id"]}',
+        stat.etag,
+    ] + [data.get(option) for option in ("team_dockerfile", "builder", "resources", "timeouts")]
+    return hashlib.sha256(json.dumps(identity, sort_keys=True, default=str).encode()).hexdigest()
+
+
+@required_fields(
+    fields=[
+        "build_id",
+        "team_name",
+        "image_name",
+        "image_tag",
+        "file.file_id",
+        "file.bucket",
+        "file._type",
+    ]
+)
+async def build_command_handler(
+    data: dict, reply, state_manager: StateManager, build_pool: BuildWorkerPool,
+    reply_to=None, storage: MinioClient = None, single_flight: BuildSingleFlight = None, **kwargs
+):
+    state_manager.add_run_job(data["build_id"], None, data, reply_to)
+    if single_flight is None:
+        await build_pool.run(data["build_id"], data, reply)
+        return
+    key = await single_flight_key(data, storage)
+    await single_flight.run(key, data["build_id"], reply, lambda reply: build_pool.run(data["build_id"], data, reply))
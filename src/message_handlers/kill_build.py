@@ -1,22 +1,32 @@
-import logging
-import os
-import shutil
-import tarfile
-import tempfile
+import asyncio
 from src import env
-from src.docker import Docker
+from src.build_pool import BuildWorkerPool
+from src.logger import get_logger
+from src.message_handlers.build import remove_build_workspace
 from src.states import StateManager
-from src.storage import MinioClient
 from src.decorators import required_fields
 
-logger = logging.getLogger("builder")
+logger = get_logger(__name__)
 
 
 @required_fields(fields=["build_id"])
-async def kill_build_command_handler(
-    data: dict, state_manager: StateManager, reply, **kwargs
-):
+async def kill_build_command_handler(data: dict, state_manager: StateManager, reply, build_pool: BuildWorkerPool, **kwargs):
     build_id = data.get("build_id")
-    state_manager.kill_run_job(build_id)
-    await reply({"status": "killed"})
-    
+    job = state_manager.get_run_jobs_state(build_id)
+    if job is None:
+        await reply({"build_id": build_id, "status": "not found"})
+        return
+    if job.status in state_manager.final_states:
+        await reply({"build_id": build_id, "status": job.status})
+        return
+
+    # the job may be compacted once it is killed
+    data = job.data
+    await state_manager.kill_run_job(build_id)
+    stopped = await build_pool.kill(build_id, timeout=env.KILL_TIMEOUT)
+    if stopped:
+        try:
+            await asyncio.to_thread(remove_build_workspace, data)
+        except Exception as e:
+            logger.error(f"Failed to remove the workspace of build_id: {build_id}: {e}")
+    await reply({"build_id": build_id, "status": "killed" if stopped else "kill timed out"})
@@ -1,64 +1,127 @@
 import asyncio
+import time
+from src.build_pool import BuildWorkerPool
 from src.states import StateManager
 from src.logger import get_logger
 
 logger = get_logger(__name__)
 
+# seconds a subscription lasts
 subscribe_timeout = 10
 
 
-async def status_command_handler(
-    data: dict, state_manager: StateManager, reply, **kwargs
-):
+def job_status(build_id, job, queue_info=None):
+    out = {
+        "build_id": build_id,
+        "status": job.status,
+        "stage": job.stage,
+        "created_at": job.created_at,
+        "finished_at": job.finished_at,
+        "stages": {
+            stage: {"state": state, "started_at": started_at, "finished_at": finished_at}
+            for stage, (state, started_at, finished_at) in job.stages.items()
+        },
+    }
+    # queue position and estimated wait of the builds waiting to run
+    if queue_info:
+        out.update(queue_info)
+    return out
+
+
+def jobs_status(state_manager: StateManager, build_pool: BuildWorkerPool, build_ids=None):
+    """Status of the given jobs, or of all of them
+
+    A single build is looked up by its build_id, only listing all the jobs
+    orders the whole queue.
+    """
     jobs = state_manager.get_all_jobs()
+    if build_ids is None:
+        queue = build_pool.queue_infos() if build_pool is not None else {}
+        return [job_status(build_id, job, queue.get(build_id)) for build_id, job in jobs.items()]
+    out = []
+    for build_id in build_ids:
+        job = jobs.get(build_id)
+        if job is None:
+            continue
+        queue_info = build_pool.queue_info(build_id) if build_pool is not None and job.status == "started" else None
+        out.append(job_status(build_id, job, queue_info))
+    return out
 
-    mode = data.get("mode", "subscribe")
-    fetch = data.get("fetch", "all")
 
-    if mode == "subscribe" and fetch == "all":
-        # subscription time
+async def subscribe(state_manager: StateManager, build_pool: BuildWorkerPool, reply, build_ids=None):
+    """Send a snapshot of the jobs, then the jobs whose state or stage changed
+
+    Changes coming in while a delta is sent are merged into the next one.
+    The subscription ends after subscribe_timeout seconds or when the reply
+    fails.
+    """
+    changed = asyncio.Queue()
+
+    def on_change(build_id):
+        if build_ids is None or build_id in build_ids:
+            changed.put_nowait(build_id)
+
+    state_manager.add_listener(on_change)
+    deadline = time.monotonic() + subscribe_timeout
+    try:
+        await reply({"jobs": jobs_status(state_manager, build_pool, build_ids)})
         while True:
-            jobs = state_manager.get_all_jobs()
-            out = []
-            counter = 0
-            for build_id, job in jobs.items():
-                out.append(
-                    {
-                        "build_id": build_id,
-                        "status": job["status"],
-                    }
-                )
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
             try:
-                await reply({"jobs": out})
-                await asyncio.sleep(1)
-                counter += 1
-                if counter > subscribe_timeout:
-                    break
-            except:
-                logger.info("Connection closed")
+                build_id = await asyncio.wait_for(changed.get(), remaining)
+            except asyncio.TimeoutError:
                 break
-    if mode == "fetch" and fetch == "all":
-        out = []
-        for build_id, job in jobs.items():
-            out.append(
-                {
-                    "build_id": build_id,
-                    "status": job["status"],
-                }
-            )
-
-        await reply({"jobs": out})
+            delta = {build_id}
+            while not changed.empty():
+                delta.add(changed.get_nowait())
+            await reply({"delta": jobs_status(state_manager, build_pool, sorted(delta))})
+    except Exception:
+        logger.info("Connection closed")
+    finally:
+        state_manager.remove_listener(on_change)
+
+
+async def history(state_manager: StateManager, data: dict):
+    """Jobs of the job store, including the ones not in memory anymore"""
+    if state_manager.store is None:
+        return {"jobs": [], "error": "job history is not enabled"}
+    try:
+        limit = min(int(data.get("limit", 100)), 1000)
+    except (TypeError, ValueError):
+        limit = 100
+    jobs = await asyncio.to_thread(
+        state_manager.store.history,
+        team_name=data.get("team_name"),
+        status=data.get("status"),
+        since=data.get("since"),
+        limit=limit,
+    )
+    for job in jobs:
+        job["stages"] = {
+            stage: {"state": state, "started_at": started_at, "finished_at": finished_at}
+            for stage, (state, started_at, finished_at) in job["stages"].items()
+        }
+    return {"jobs": jobs}
+
+
+async def status_command_handler(
+    data: dict, state_manager: StateManager, reply, build_pool: BuildWorkerPool = None, **kwargs
+):
+    mode = data.get("mode", "subscribe")
+    fetch = data.get("fetch", "all")
+    build_ids = None if fetch == "all" else [fetch]
+
+    if fetch == "history":
+        await reply(await history(state_manager, data))
         return
 
-    # jobs is dict which key is build_id
-    out = []
-    for build_id, job in jobs.items():
-        out.append(
-            {
-                "build_id": build_id,
-                "status": job["status"],
-            }
-        )
-
-    await reply({"jobs": out})
-    return
+    if mode == "subscribe":
+        await subscribe(state_manager, build_pool, reply, build_ids)
+        return
+
+    out = {"jobs": jobs_status(state_manager, build_pool, build_ids)}
+    if build_ids is not None and not out["jobs"]:
+        out["error"] = f"build_id {fetch} not found"
+    await reply(out)
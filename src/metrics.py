@@ -0,0 +1,57 @@
+import collections
+import threading
+
+# counters and gauges of the service, served on the /metrics route.
+# Build workers run in their own processes, so they forward their updates
+# to the pool (see set_sink) instead of keeping them locally.
+_counters = collections.Counter()
+_gauges = {}
+_lock = threading.Lock()
+_sink = None
+
+
+def set_sink(sink):
+    """Forward all the metric updates of this process to `sink(kind, name, value)`"""
+    global _sink
+    _sink = sink
+
+
+def incr(name, value=1):
+    """Increase a counter
+
+    Args:
+        name (str): name of the counter
+        value (int, optional): amount to add. Defaults to 1.
+    """
+    if _sink is not None:
+        _sink("incr", name, value)
+        return
+    with _lock:
+        _counters[name] += value
+
+
+def set_gauge(name, value):
+    """Set the current value of a gauge
+
+    Args:
+        name (str): name of the gauge
+        value (float): current value
+    """
+    if _sink is not None:
+        _sink("gauge", name, value)
+        return
+    with _lock:
+        _gauges[name] = value
+
+
+def apply(kind, name, value):
+    """Apply a metric update forwarded by another process"""
+    if kind == "incr":
+        incr(name, value)
+    elif kind == "gauge":
+        set_gauge(name, value)
+
+
+def get_all():
+    with _lock:
+        return {"counters": dict(_counters), "gauges": dict(_gauges)}
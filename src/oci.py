@@ -0,0 +1,210 @@
+import copy
+import datetime
+import gzip
+import hashlib
+import json
+import shlex
+import tarfile
+from src.logger import get_logger
+from src.registry import DOCKER_MANIFEST
+from src.utils.build_context import DROPPED_FILES, _split_member_name
+
+logger = get_logger(__name__)
+
+LAYER_TYPES = {
+    DOCKER_MANIFEST: "application/vnd.docker.image.rootfs.diff.tar.gzip",
+    "application/vnd.oci.image.manifest.v1+json": "application/vnd.oci.image.layer.v1.tar+gzip",
+}
+CONFIG_TYPES = {
+    DOCKER_MANIFEST: "application/vnd.docker.container.image.v1+json",
+    "application/vnd.oci.image.manifest.v1+json": "application/vnd.oci.image.config.v1+json",
+}
+
+
+class _DigestWriter:
+    def __init__(self, out):
+        self.out = out
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        self.out.write(data)
+        return len(data)
+
+    def flush(self):
+        self.out.flush()
+
+    @property
+    def digest(self):
+        return "sha256:" + self.sha256.hexdigest()
+
+
+def _exec_form(value):
+    try:
+        parsed = json.loads(value)
+        if isinstance(parsed, list):
+            return parsed
+    except ValueError:
+        pass
+    return ["/bin/sh", "-c", value]
+
+
+def parse_team_instructions(dockerfile):
+    """Parse the team part of a derived Dockerfile, see BaseImageManager
+
+    Only a single `COPY bin <folder>/` followed by instructions that change
+    the image config (USER, WORKDIR, ENV, CMD, ENTRYPOINT) can be assembled
+    without the docker daemon.
+
+    Args:
+        dockerfile (str): derived Dockerfile, `FROM <base>` then the team part
+
+    Returns:
+        dict: `base`, `dest` folder of the copy, `config` changes and `history`, None if not supported
+    """
+    plan = {"base": None, "dest": None, "config": {}, "history": []}
+    for line in dockerfile.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        instruction, _, value = line.partition(" ")
+        instruction = instruction.upper()
+        value = value.strip()
+        config = plan["config"]
+        if instruction == "FROM" and plan["base"] is None:
+            plan["base"] = value
+            continue
+        if instruction == "COPY" and plan["dest"] is None:
+            args = value.split()
+            if len(args) != 2 or args[0] != "bin" or not args[1].startswith("/") or not args[1].endswith("/"):
+                return None
+            plan["dest"] = args[1]
+        elif instruction == "USER":
+            config["User"] = value
+        elif instruction == "WORKDIR" and value.startswith("/"):
+            config["WorkingDir"] = value
+        elif instruction == "ENV" and "=" in value:
+            env = dict(item.split("=", 1) for item in config.get("Env", []))
+            for item in shlex.split(value):
+                key, _, item_value = item.partition("=")
+                env[key] = item_value
+            config["Env"] = [f"{key}={item_value}" for key, item_value in env.items()]
+        elif instruction in ("CMD", "ENTRYPOINT"):
+            config["Cmd" if instruction == "CMD" else "Entrypoint"] = _exec_form(value)
+        else:
+            return None
+        plan["history"].append(f"{instruction} {value}")
+    if plan["base"] is None or plan["dest"] is None:
+        return None
+    return plan
+
+
+def _dir_member(name, mtime):
+    info = tarfile.TarInfo(name)
+    info.type = tarfile.DIRTYPE
+    info.mode = 0o755
+    info.mtime = mtime
+    return info
+
+
+def build_team_layer(archive_path, team_name, dest, layer_path):
+    """Write the layer `COPY bin <dest>` adds, straight from the team archive
+
+    Members of `<team_name>/...` are put under `dest` the way the daemon
+    copies them: owned by root, embedded Dockerfile/.dockerignore files
+    dropped and `start` executable, like file_validate does. The team folder
+    itself becomes `dest`, and like in the daemon's layer every directory
+    above a member has its entry: the ones the archive has no entry for are
+    0755, with the mtime of the first member under them.
+
+    Returns:
+        dict: `digest` and `size` of the compressed layer, `diff_id` of the uncompressed one
+    """
+    prefix = dest.strip("/")
+    written = set()
+
+    def add_parents(dst, name, mtime):
+        parts = name.split("/")[:-1]
+        for i in range(1, len(parts) + 1):
+            parent = "/".join(parts[:i])
+            if parent not in written:
+                written.add(parent)
+                dst.addfile(_dir_member(parent, mtime))
+
+    with open(layer_path, "wb") as out:
+        compressed = _DigestWriter(out)
+        with gzip.GzipFile(fileobj=compressed, mode="wb", mtime=0) as gz:
+            uncompressed = _DigestWriter(gz)
+            with tarfile.open(archive_path, mode="r|*") as src, \
+                    tarfile.open(fileobj=uncompressed, mode="w|", format=tarfile.PAX_FORMAT) as dst:
+                for member in src:
+                    top, rest = _split_member_name(member.name)
+                    if top != team_name or rest in DROPPED_FILES:
+                        continue
+                    if not rest and not member.isdir():
+                        continue
+                    member.name = f"{prefix}/{rest}" if rest else prefix
+                    if member.islnk():
+                        link_top, link_rest = _split_member_name(member.linkname)
+                        if link_top != team_name:
+                            continue
+                        member.linkname = f"{prefix}/{link_rest}"
+                    member.uid = member.gid = 0
+                    member.uname = member.gname = ""
+                    if rest == "start" and member.isfile():
+                        member.mode = 0o755
+                    add_parents(dst, member.name, member.mtime)
+                    if member.isdir():
+                        # an entry written for a member under it is replaced by the archive's own
+                        written.add(member.name)
+                    if member.isfile():
+                        dst.addfile(member, src.extractfile(member))
+                    else:
+                        dst.addfile(member)
+    return {"digest": compressed.digest, "size": compressed.size, "diff_id": uncompressed.digest}
+
+
+def team_image(base_manifest, base_config, layer, plan):
+    """Derive the config and manifest of a team image from its base
+
+    Args:
+        base_manifest (dict): manifest of the base image
+        base_config (dict): config of the base image
+        layer (dict): the team layer, see build_team_layer
+        plan (dict): see parse_team_instructions
+
+    Returns:
+        tuple[bytes, bytes, str]: config, manifest and media type of the manifest
+    """
+    media_type = base_manifest.get("mediaType", DOCKER_MANIFEST)
+    created = datetime.datetime.now(datetime.timezone.utc).isoformat().replace("+00:00", "Z")
+
+    config = copy.deepcopy(base_config)
+    config["created"] = created
+    config.setdefault("config", {}).update(plan["config"])
+    config.setdefault("rootfs", {"type": "layers", "diff_ids": []})["diff_ids"].append(layer["diff_id"])
+    history = config.setdefault("history", [])
+    for instruction in plan["history"]:
+        entry = {"created": created, "created_by": f"/bin/sh -c #(nop) {instruction}"}
+        if not instruction.startswith("COPY"):
+            entry["empty_layer"] = True
+        history.append(entry)
+    config_body = json.dumps(config, separators=(",", ":")).encode()
+
+    manifest = {
+        "schemaVersion": 2,
+        "mediaType": media_type,
+        "config": {
+            "mediaType": CONFIG_TYPES.get(media_type, CONFIG_TYPES[DOCKER_MANIFEST]),
+            "size": len(config_body),
+            "digest": "sha256:" + hashlib.sha256(config_body).hexdigest(),
+        },
+        "layers": base_manifest["layers"] + [{
+            "mediaType": LAYER_TYPES.get(media_type, LAYER_TYPES[DOCKER_MANIFEST]),
+            "size": layer["size"],
+            "digest": layer["digest"],
+        }],
+    }
+    return config_body, json.dumps(manifest, separators=(",", ":")).encode(), media_type
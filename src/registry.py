@@ -0,0 +1,235 @@
+import asyncio
+import hashlib
+import json
+import re
+import aiohttp
+from src.logger import get_logger
+
+logger = get_logger(__name__)
+
+READ_SIZE = 1024 * 1024
+
+DOCKER_MANIFEST = "application/vnd.docker.distribution.manifest.v2+json"
+OCI_MANIFEST = "application/vnd.oci.image.manifest.v1+json"
+MANIFEST_TYPES = [DOCKER_MANIFEST, OCI_MANIFEST]
+
+
+async def file_sender(path):
+    """Body streaming a file, for push_blob"""
+    with open(path, "rb") as f:
+        while True:
+            chunk = await asyncio.to_thread(f.read, READ_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+class RegistryError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+
+
+class RegistryClient:
+    """Client of the registry HTTP API (distribution spec v2)
+
+    Authenticates with basic auth, or with a bearer token when the registry
+    asks for one (`WWW-Authenticate: Bearer realm=...`). Tokens are kept per
+    scope for the life of the client.
+    """
+
+    def __init__(self, registry, username="", password="", secure=False):
+        """
+        Args:
+            registry (str): host:port of the registry
+            username (str, optional): registry username
+            password (str, optional): registry password
+            secure (bool, optional): use https. Defaults to False.
+        """
+        self.registry = registry
+        self.base_url = f"{'https' if secure else 'http'}://{registry}/v2"
+        self.auth = aiohttp.BasicAuth(username, password) if username else None
+        self.tokens = {}
+        self.session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _session(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None, sock_read=300))
+        return self.session
+
+    async def _token(self, challenge, scope):
+        params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+        realm = params.pop("realm")
+        params.pop("scope", None)
+        # a token for several repositories asks for every scope
+        params = list(params.items()) + [("scope", item) for item in (scope if isinstance(scope, tuple) else (scope,))]
+        async with self._session().get(realm, params=params, auth=self.auth) as response:
+            if response.status != 200:
+                raise RegistryError(response.status, await response.text())
+            body = await response.json()
+        return body.get("token") or body.get("access_token")
+
+    async def _request(self, method, url, scope, expected, headers=None, data=None, **kwargs):
+        """Send a request, authenticating if the registry asks for it
+
+        The body must be replayable (bytes, or a callable returning a fresh
+        body), as the request is sent again after the auth challenge.
+        """
+        if not url.startswith("http"):
+            url = self.base_url + url
+        for attempt in range(2):
+            request_headers = dict(headers or {})
+            auth = None
+            if scope in self.tokens:
+                request_headers["Authorization"] = f"Bearer {self.tokens[scope]}"
+            else:
+                auth = self.auth
+            body = data() if callable(data) else data
+            response = await self._session().request(method, url, headers=request_headers, data=body, auth=auth, **kwargs)
+            if response.status == 401 and attempt == 0:
+                challenge = response.headers.get("WWW-Authenticate", "")
+                response.release()
+                if challenge.lower().startswith("bearer"):
+                    self.tokens[scope] = await self._token(challenge, scope)
+                continue
+            if response.status not in expected:
+                message = await response.text()
+                response.release()
+                raise RegistryError(response.status, f"{method} {url}: {message}")
+            return response
+        raise RegistryError(401, f"{method} {url}: unauthorized")
+
+    @staticmethod
+    def _scope(name, actions="pull"):
+        return f"repository:{name}:{actions}"
+
+    async def get_manifest(self, name, reference):
+        """
+        Returns:
+            tuple[str, str, bytes]: digest, media type and body of the manifest
+        """
+        response = await self._request(
+            "GET", f"/{name}/manifests/{reference}", self._scope(name), (200,),
+            headers={"Accept": ", ".join(MANIFEST_TYPES)}
+        )
+        async with response:
+            body = await response.read()
+            digest = response.headers.get("Docker-Content-Digest") or "sha256:" + hashlib.sha256(body).hexdigest()
+            return digest, response.headers.get("Content-Type"), body
+
+    async def head_manifest(self, name, reference):
+        """
+        Returns:
+            str: digest of the manifest, None if the registry does not have it
+        """
+        response = await self._request(
+            "HEAD", f"/{name}/manifests/{reference}", self._scope(name), (200, 404),
+            headers={"Accept": ", ".join(MANIFEST_TYPES)}
+        )
+        async with response:
+            if response.status == 404:
+                return None
+            return response.headers.get("Docker-Content-Digest")
+
+    async def get_blob_json(self, name, digest):
+        response = await self._request("GET", f"/{name}/blobs/{digest}", self._scope(name), (200,))
+        async with response:
+            return json.loads(await response.read())
+
+    async def has_blob(self, name, digest):
+        response = await self._request("HEAD", f"/{name}/blobs/{digest}", self._scope(name), (200, 404))
+        async with response:
+            return response.status == 200
+
+    async def mount_blob(self, source_name, name, digest):
+        """Link a blob of another repository of the registry into a repository
+
+        Returns:
+            bool: True if the blob has been mounted, False if the registry
+            can't mount it (e.g. it does not have it)
+        """
+        scope = (self._scope(name, "pull,push"), self._scope(source_name))
+        response = await self._request(
+            "POST", f"/{name}/blobs/uploads/?mount={digest}&from={source_name}", scope, (201, 202)
+        )
+        mounted = response.status == 201
+        location = response.headers.get("Location")
+        response.release()
+        if not mounted and location:
+            # the registry opened an upload instead, drop it
+            if location.startswith("/"):
+                location = self.base_url[:-len("/v2")] + location
+            try:
+                response = await self._request("DELETE", location, scope, (204, 404))
+                response.release()
+            except RegistryError as e:
+                logger.debug(f"Failed to cancel upload of {digest}: {e}")
+        return mounted
+
+    async def copy_blob(self, source_name, name, digest, size):
+        """Copy a blob between two repositories of the registry
+
+        The blob is mounted when the registry supports it, else streamed
+        through the client.
+
+        Returns:
+            str: "exists", "mounted" or "pushed"
+        """
+        if await self.has_blob(name, digest):
+            return "exists"
+        if await self.mount_blob(source_name, name, digest):
+            return "mounted"
+        response = await self._request("GET", f"/{source_name}/blobs/{digest}", self._scope(source_name), (200,))
+        async with response:
+            await self.push_blob(name, digest, size, response.content.iter_chunked(READ_SIZE))
+        return "pushed"
+
+    async def push_blob(self, name, digest, size, data):
+        """Upload a blob in a single request, unless the registry has it already
+
+        Args:
+            name (str): repository
+            digest (str): digest of the blob
+            size (int): size of the blob
+            data (bytes | callable | async iterable): body, a callable returns a fresh body
+        """
+        scope = self._scope(name, "pull,push")
+        if await self.has_blob(name, digest):
+            return False
+        response = await self._request("POST", f"/{name}/blobs/uploads/", scope, (202,))
+        location = response.headers["Location"]
+        response.release()
+        if location.startswith("/"):
+            location = self.base_url[:-len("/v2")] + location
+        separator = "&" if "?" in location else "?"
+        # the token of the scope is known by now, so the body is only sent once
+        response = await self._request(
+            "PUT", f"{location}{separator}digest={digest}", scope, (201,),
+            headers={"Content-Type": "application/octet-stream", "Content-Length": str(size)},
+            data=data
+        )
+        response.release()
+        return True
+
+    async def put_manifest(self, name, reference, body, media_type):
+        """
+        Returns:
+            str: digest of the manifest
+        """
+        response = await self._request(
+            "PUT", f"/{name}/manifests/{reference}", self._scope(name, "pull,push"), (201,),
+            headers={"Content-Type": media_type}, data=body
+        )
+        response.release()
+        return response.headers.get("Docker-Content-Digest") or "sha256:" + hashlib.sha256(body).hexdigest()
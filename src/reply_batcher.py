@@ -0,0 +1,86 @@
+import asyncio
+from src.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class ReplyBatcher:
+    """Reply function coalescing stage log lines into batched frames
+
+    Log replies (`{"stage": ..., "data": ...}`) are buffered and sent as one
+    `{"stage": ..., "logs": [...]}` frame once `max_lines` lines are waiting
+    or `max_delay` seconds after the first one. Any other reply, like a stage
+    state transition, flushes the buffer and is sent right away, so the order
+    of the replies is kept.
+
+    With `aggregate_progress`, the per-layer byte progress lines of the push
+    are folded into a single `{"stage": ..., "progress": percent}` frame.
+    """
+
+    def __init__(self, reply, max_lines=50, max_delay=0.5, aggregate_progress=True, progress_stages=("team_push",)):
+        self.reply = reply
+        self.max_lines = max_lines
+        self.max_delay = max_delay
+        self.aggregate_progress = aggregate_progress
+        self.progress_stages = progress_stages
+        self.stage = None
+        self.lines = []
+        self.layers = {}
+        self.progress = None
+        self.timer = None
+
+    async def __call__(self, message):
+        if not isinstance(message, dict) or set(message.keys()) != {"stage", "data"}:
+            await self.flush()
+            await self.reply(message)
+            return
+
+        if message["stage"] != self.stage:
+            await self.flush()
+            self.stage = message["stage"]
+            self.layers = {}
+
+        if not self._add_progress(message["data"]):
+            self.lines.append(message["data"])
+        if len(self.lines) >= self.max_lines:
+            await self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.create_task(self._flush_later())
+
+    def _add_progress(self, data):
+        if not self.aggregate_progress or self.stage not in self.progress_stages:
+            return False
+        if not isinstance(data, dict) or "id" not in data or "progressDetail" not in data:
+            return False
+        detail = data["progressDetail"] or {}
+        if "total" in detail:
+            self.layers[data["id"]] = (detail.get("current", 0), detail["total"])
+        elif data.get("status") in ("Pushed", "Layer already exists") and data["id"] in self.layers:
+            total = self.layers[data["id"]][1]
+            self.layers[data["id"]] = (total, total)
+        else:
+            return False
+        current = sum(layer[0] for layer in self.layers.values())
+        total = sum(layer[1] for layer in self.layers.values())
+        self.progress = round(100 * current / total, 1) if total else None
+        return True
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.max_delay)
+        self.timer = None
+        await self.flush()
+
+    async def flush(self):
+        """Send the buffered lines and progress of the current stage"""
+        if self.timer is not None and self.timer is not asyncio.current_task():
+            self.timer.cancel()
+        self.timer = None
+        lines, self.lines = self.lines, []
+        progress, self.progress = self.progress, None
+        if progress is not None:
+            await self.reply({"stage": self.stage, "progress": progress})
+        if lines:
+            await self.reply({"stage": self.stage, "logs": lines})
+
+    async def close(self):
+        await self.flush()
@@ -0,0 +1,5 @@
+from aiohttp import web
+from src import metrics
+
+async def handle_metrics(request):
+    return web.json_response(metrics.get_all())
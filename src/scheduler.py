@@ -0,0 +1,269 @@
+import collections
+import heapq
+import time
+from src.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class _Entry:
+    __slots__ = ("build_id", "data", "priority", "tournament", "team", "image", "queued_at", "ready_at")
+
+    def __init__(self, build_id, data, priority, tournament, team, image, debounce=0):
+        self.build_id = build_id
+        self.data = data
+        self.priority = priority
+        self.tournament = tournament
+        self.team = team
+        self.image = image
+        self.queued_at = time.time()
+        self.ready_at = self.queued_at + debounce
+
+
+class BuildScheduler:
+    """Orders the builds waiting to run
+
+    Builds of a higher `priority` (field of the build body, 0 by default) run
+    first. Inside a priority the builds are fair queued: the tournaments
+    (`tournament_id`) take turns, and so do the teams of a tournament, so a
+    team uploading over and over only delays its own builds. At most
+    `max_running` builds run at once.
+
+    With a `debounce` window, a build waits at least that many seconds in
+    the queue, and a newer build of the same team and image supersedes the
+    queued one (last write wins), so a team uploading several times in a row
+    gets only its last upload built.
+    """
+
+    def __init__(self, max_running, default_duration=60.0, debounce=None):
+        """
+        Args:
+            max_running (int): maximum number of builds running at once
+            default_duration (float, optional): build duration assumed until builds finished
+            debounce (float, optional): seconds a build waits for a newer one of the same image, None to run every build
+        """
+        self._plan = None
+        self.max_running = max_running
+        self.debounce = debounce
+        # priority -> tournament -> team -> deque of entries
+        self.queues = {}
+        self.entries = {}
+        self.running = {}
+        # image -> build_id of the queued and of the running builds
+        self.queued_images = {}
+        self.running_images = {}
+        self.average_duration = default_duration
+
+    @staticmethod
+    def _priority(data):
+        try:
+            return int(data.get("priority", 0))
+        except (TypeError, ValueError):
+            return 0
+
+    @staticmethod
+    def image_key(data):
+        return (data.get("team_name"), data.get("image_name"), data.get("image_tag"))
+
+    def push(self, build_id, data):
+        """Queue a build
+
+        Returns:
+            list[str]: build_ids of the queued builds it supersedes, see debounce
+        """
+        image = self.image_key(data)
+        superseded = []
+        if self.debounce is not None:
+            older = self.queued_images.get(image)
+            if older is not None and self.remove(older):
+                superseded.append(older)
+            self.queued_images[image] = build_id
+        entry = _Entry(build_id, data, self._priority(data), data.get("tournament_id"), data.get("team_name"), image, self.debounce or 0)
+        tournaments = self.queues.setdefault(entry.priority, collections.OrderedDict())
+        teams = tournaments.setdefault(entry.tournament, collections.OrderedDict())
+        teams.setdefault(entry.team, collections.deque()).append(entry)
+        self.entries[build_id] = entry
+        self._plan = None
+        return superseded
+
+    def running_build(self, data):
+        """
+        Returns:
+            str: build_id of the running build of the same team and image, None if there is none
+        """
+        return self.running_images.get(self.image_key(data))
+
+    def pop(self):
+        """Take the next build to run
+
+        Returns:
+            tuple[str, dict]: build_id and data of the build, None if nothing can run now
+        """
+        if len(self.running) >= self.max_running or not self.queues:
+            return None
+        found = self._next_ready()
+        if found is None:
+            return None
+        priority, tournament, team = found
+        tournaments = self.queues[priority]
+        teams = tournaments[tournament]
+        entries = teams[team]
+        entry = entries.popleft()
+
+        # the next turn goes to the next team and tournament
+        if entries:
+            teams.move_to_end(team)
+        else:
+            del teams[team]
+        if teams:
+            tournaments.move_to_end(tournament)
+        else:
+            del tournaments[tournament]
+        if not tournaments:
+            del self.queues[priority]
+
+        del self.entries[entry.build_id]
+        self._plan = None
+        self._forget_image(self.queued_images, entry)
+        self.running[entry.build_id] = time.time()
+        if self.debounce is not None:
+            self.running_images[entry.image] = entry.build_id
+        return entry.build_id, entry.data
+
+    def _next_ready(self):
+        # first team in turn whose next build waited its debounce window,
+        # the builds of a team are queued in order so only the first counts
+        now = time.time()
+        for priority in sorted(self.queues, reverse=True):
+            for tournament, teams in self.queues[priority].items():
+                for team, entries in teams.items():
+                    if entries[0].ready_at <= now:
+                        return priority, tournament, team
+        return None
+
+    def next_ready_in(self):
+        """
+        Returns:
+            float: seconds until a queued build is out of its debounce window, None if none is waiting for it
+        """
+        now = time.time()
+        waits = [
+            entries[0].ready_at - now
+            for tournaments in self.queues.values()
+            for teams in tournaments.values()
+            for entries in teams.values()
+        ]
+        waits = [wait for wait in waits if wait > 0]
+        return min(waits) if waits else None
+
+    @staticmethod
+    def _forget_image(images, entry):
+        if images.get(entry.image) == entry.build_id:
+            del images[entry.image]
+
+    def remove(self, build_id):
+        """Drop a queued build
+
+        Returns:
+            bool: True if the build was queued
+        """
+        entry = self.entries.pop(build_id, None)
+        if entry is None:
+            return False
+        self._plan = None
+        self._forget_image(self.queued_images, entry)
+        tournaments = self.queues[entry.priority]
+        teams = tournaments[entry.tournament]
+        teams[entry.team].remove(entry)
+        if not teams[entry.team]:
+            del teams[entry.team]
+        if not teams:
+            del tournaments[entry.tournament]
+        if not tournaments:
+            del self.queues[entry.priority]
+        return True
+
+    def done(self, build_id):
+        """Mark a running build as done"""
+        started_at = self.running.pop(build_id, None)
+        self._plan = None
+        for image, running_id in list(self.running_images.items()):
+            if running_id == build_id:
+                del self.running_images[image]
+        if started_at is not None:
+            # moving average of the build durations, for the wait estimates
+            self.average_duration = 0.8 * self.average_duration + 0.2 * (time.time() - started_at)
+
+    @property
+    def max_running(self):
+        return self._max_running
+
+    @max_running.setter
+    def max_running(self, max_running):
+        self._max_running = max_running
+        self._plan = None
+
+    def plan(self):
+        """Queued builds in the order they will run, with their estimated start
+
+        Replays pop on a copy of the queues: a running build frees its slot
+        average_duration after it started (or now if it is overdue), a
+        queued build average_duration after its estimated start, and the
+        slot freeing first takes the first team in turn whose next build is
+        out of its debounce window by then, or else the build coming out of
+        it first. The plan is kept until the queue, the running builds or
+        max_running change.
+
+        Returns:
+            dict: build_id -> queue position (0 runs next) and estimated start time
+        """
+        if self._plan is not None:
+            return self._plan
+        now = time.time()
+        max_running = max(self.max_running, 1)
+        # times the slots free, the latest max_running ones when more builds
+        # run than max_running (it was lowered)
+        slots = sorted(max(started_at + self.average_duration, now) for started_at in self.running.values())
+        slots = ([now] * max(max_running - len(slots), 0) + slots)[-max_running:]
+        heapq.heapify(slots)
+        plan = {}
+        for priority in sorted(self.queues, reverse=True):
+            tournaments = collections.OrderedDict(
+                (tournament, collections.OrderedDict((team, collections.deque(entries)) for team, entries in teams.items()))
+                for tournament, teams in self.queues[priority].items()
+            )
+            while tournaments:
+                slot_at = heapq.heappop(slots)
+                tournament, team = self._first_ready(tournaments, slot_at)
+                teams = tournaments[tournament]
+                entries = teams[team]
+                entry = entries.popleft()
+                start_at = max(slot_at, entry.ready_at)
+                plan[entry.build_id] = (len(plan), start_at)
+                heapq.heappush(slots, start_at + self.average_duration)
+                if entries:
+                    teams.move_to_end(team)
+                else:
+                    del teams[team]
+                if teams:
+                    tournaments.move_to_end(tournament)
+                else:
+                    del tournaments[tournament]
+        self._plan = plan
+        return plan
+
+    @staticmethod
+    def _first_ready(tournaments, at):
+        # first team in turn whose next build is ready at `at`, else the one
+        # whose next build is ready first
+        first = None
+        for tournament, teams in tournaments.items():
+            for team, entries in teams.items():
+                if entries[0].ready_at <= at:
+                    return tournament, team
+                if first is None or entries[0].ready_at < first[0]:
+                    first = (entries[0].ready_at, tournament, team)
+        return first[1:]
+
+    def __len__(self):
+        return len(self.entries)
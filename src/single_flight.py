@@ -0,0 +1,95 @@
+import asyncio
+from src import metrics
+from src.logger import get_logger
+from src.states import StateManager
+
+logger = get_logger(__name__)
+
+
+class _Flight:
+    __slots__ = ("build_id", "followers", "stages", "done")
+
+    def __init__(self, build_id, done):
+        self.build_id = build_id
+        # build_id -> reply of the identical builds attached to this one
+        self.followers = {}
+        # stage list reply, for the builds attaching late
+        self.stages = None
+        self.done = done
+
+
+class BuildSingleFlight:
+    """Runs identical builds in flight only once
+
+    The first build of a key runs; identical builds coming in while it runs
+    attach to it instead of running again. They get its replies from then
+    on, on their own reply function, with their stages tracked under their
+    own build_id, and end with its final status.
+    """
+
+    def __init__(self, state_manager: StateManager):
+        self.state_manager = state_manager
+        self.flights = {}
+
+    async def run(self, key, build_id, reply, run_fn):
+        """Run a build, or attach it to the identical build in flight
+
+        Args:
+            key (hashable): identity of the build, None to always run it
+            build_id (str): ID of the build
+            reply (callable): reply function of the build
+            run_fn (callable): async function taking the reply function and running the build
+        """
+        if key is None:
+            await run_fn(reply)
+            return
+        flight = self.flights.get(key)
+        if flight is not None:
+            await self._follow(flight, build_id, reply)
+            return
+
+        flight = self.flights[key] = _Flight(build_id, asyncio.get_running_loop().create_future())
+
+        async def fan_out(message):
+            if isinstance(message, dict) and "stages" in message:
+                flight.stages = message
+            for follower_id, follower_reply in list(flight.followers.items()):
+                job = self.state_manager.get_run_jobs_state(follower_id)
+                if job is None or job.status == "killed":
+                    # detached by kill_build
+                    flight.followers.pop(follower_id, None)
+                    continue
+                if job.status == "started":
+                    await self.state_manager.update_state(follower_id, "progress")
+                if isinstance(message, dict) and "stage" in message and "state" in message:
+                    self.state_manager.update_stage(follower_id, message["stage"], message["state"])
+                try:
+                    await follower_reply(message)
+                except Exception as e:
+                    logger.error(f"Failed to reply to build_id: {follower_id} following {build_id}: {e}")
+            await reply(message)
+
+        try:
+            await run_fn(fan_out)
+        finally:
+            del self.flights[key]
+            flight.done.set_result(None)
+
+    async def _follow(self, flight, build_id, reply):
+        logger.info(f"build_id: {build_id} is identical to build_id: {flight.build_id} in flight, attaching to it")
+        metrics.incr("builds_coalesced")
+        flight.followers[build_id] = reply
+        await reply({"coalesced_with": flight.build_id})
+        if flight.stages is not None:
+            await reply(flight.stages)
+        await flight.done
+
+        job = self.state_manager.get_run_jobs_state(build_id)
+        if job is None or job.status == "killed":
+            return
+        primary = self.state_manager.get_run_jobs_state(flight.build_id)
+        status = primary.status if primary is not None else "failed"
+        if status not in ("finished", "failed", "superseded"):
+            await reply({"coalesced_with": flight.build_id, "error": f"the build ended as {status}"})
+            status = "failed"
+        await self.state_manager.update_state(build_id, status)
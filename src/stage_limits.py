@@ -0,0 +1,90 @@
+import collections
+import time
+from src import metrics
+from src.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class StageLimits:
+    """Concurrency limits per stage class of the builds
+
+    The network bound stages (downloads, pushes) and the daemon bound ones
+    (builds) of different jobs get their own limits, so the download of a
+    job goes on while another job builds. A job asks for a slot of a class
+    before its stage and gives it back after it; jobs over the limit wait in
+    line. The queue depth, running count and wait time of every class are
+    reported as metrics (`stage_<class>_...`).
+    """
+
+    def __init__(self, limits):
+        """
+        Args:
+            limits (dict): maximum number of stages running at once, by stage class
+
+        Raises:
+            ValueError: if a limit is below 1, the stages of its class would never run
+        """
+        for stage_class, limit in limits.items():
+            self._check_limit(stage_class, limit)
+        self.limits = dict(limits)
+        self.running = {stage_class: set() for stage_class in self.limits}
+        self.waiting = {stage_class: collections.deque() for stage_class in self.limits}
+
+    def acquire(self, build_id, stage_class, grant):
+        """Ask for a slot of a stage class
+
+        Args:
+            build_id (str): ID of the build
+            stage_class (str): e.g. download, build, push
+            grant (callable): called once the slot is granted
+        """
+        if stage_class not in self.limits:
+            # no limit for this class
+            grant()
+            return
+        self.waiting[stage_class].append((build_id, grant, time.time()))
+        self._grant(stage_class)
+
+    def release(self, build_id, stage_class):
+        if stage_class not in self.limits:
+            return
+        self.running[stage_class].discard(build_id)
+        self._grant(stage_class)
+
+    def release_all(self, build_id):
+        """Drop all the slots held and asked for by a build, e.g. when its worker died"""
+        for stage_class in self.limits:
+            self.waiting[stage_class] = collections.deque(
+                waiter for waiter in self.waiting[stage_class] if waiter[0] != build_id
+            )
+            self.running[stage_class].discard(build_id)
+            self._grant(stage_class)
+
+    def set_limit(self, stage_class, limit):
+        self._check_limit(stage_class, limit)
+        self.limits[stage_class] = limit
+        self._grant(stage_class)
+
+    @staticmethod
+    def _check_limit(stage_class, limit):
+        if limit < 1:
+            raise ValueError(f"The {stage_class} stage limit must be at least 1, got {limit}")
+
+    def _grant(self, stage_class):
+        running = self.running[stage_class]
+        waiting = self.waiting[stage_class]
+        while waiting and len(running) < self.limits[stage_class]:
+            build_id, grant, queued_at = waiting.popleft()
+            running.add(build_id)
+            wait = time.time() - queued_at
+            metrics.incr(f"stage_{stage_class}_waits")
+            metrics.incr(f"stage_{stage_class}_wait_seconds", wait)
+            metrics.set_gauge(f"stage_{stage_class}_last_wait_seconds", round(wait, 3))
+            try:
+                grant()
+            except Exception as e:
+                logger.error(f"Failed to grant a {stage_class} slot to build_id: {build_id}: {e}")
+                running.discard(build_id)
+        metrics.set_gauge(f"stage_{stage_class}_queue_depth", len(waiting))
+        metrics.set_gauge(f"stage_{stage_class}_running", len(running))
@@ -1,9 +1,55 @@
 import logging
 import asyncio
+import collections
+import time
 
 logger = logging.getLogger("state")
 
 
+class JobRecord:
+    """State of a build job
+
+    Events and hooks are only created when someone asks for them. Once the
+    job is over and compacted (see StateManager), only its summary is left:
+    status, timings, team and image.
+    """
+    __slots__ = (
+        "build_id", "task", "status", "data", "reply_to", "team_name", "image",
+        "created_at", "finished_at", "stage", "stages", "states", "events", "hooks",
+    )
+
+    def __init__(self, build_id, task, data, reply_to=None):
+        self.build_id = build_id
+        self.task = task
+        self.status = "started"
+        self.data = data
+        # queue the replies of the build go to, to requeue it after a restart
+        self.reply_to = reply_to
+        self.team_name = data.get("team_name")
+        self.image = f"{data['image_name']}:{data.get('image_tag', 'latest')}" if data.get("image_name") else None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.stage = None
+        # stage -> [state, started_at, finished_at]
+        self.stages = {}
+        self.states = []
+        self.events = None
+        self.hooks = None
+
+    @property
+    def compacted(self):
+        return self.data is None
+
+    def compact(self):
+        """Drop everything but the summary of the job"""
+        self.task = None
+        self.data = None
+        self.reply_to = None
+        self.states = None
+        self.events = None
+        self.hooks = None
+
+
 class StateManager:
     run_jobs = None
 
@@ -13,56 +59,86 @@ class StateManager:
         "finished",
         "killed",
         "failed",
+        # was running when the service stopped
+        "orphaned",
+        # replaced by a newer build of the same image, see BuildScheduler
+        "superseded",
     ]
 
-    def __init__(self):
+    final_states = ("finished", "killed", "failed", "orphaned", "superseded")
+
+    def __init__(self, compact_after=600, max_jobs=10000, store=None):
+        """
+        Args:
+            compact_after (float, optional): seconds after which a job that is over is compacted to its summary
+            max_jobs (int, optional): jobs kept, the oldest jobs that are over are dropped beyond it
+            store (JobStore, optional): database the jobs are copied to, see restore
+        """
         self.run_jobs = {}
+        self.store = store
+        self.listeners = []
+        self.compact_after = compact_after
+        self.max_jobs = max_jobs
+        # build_ids of the jobs that are over, oldest first, and of the ones
+        # not compacted yet
+        self.over = collections.OrderedDict()
+        self.to_compact = collections.OrderedDict()
 
-    def add_run_job(self, build_id, task, data):
+    def add_run_job(self, build_id, task, data, reply_to=None):
         """Add a run job to the state
 
         Args:
             build_id (str): ID of the build
             task (str): Task to be run
             data (dict): Additional data related to the job
+            reply_to (str, optional): queue the replies of the job are sent to
         """
-        self.run_jobs[build_id] = {
-            "task": task,
-            "status": "started",
-            "data": data,
-            "states": [],
-            "events": {},
-            "hooks": {state: [] for state in self.build_states}
-        }
-        for state in self.build_states:
-            event = asyncio.Event()
-            self.run_jobs[build_id]["events"][state] = event
+        self.over.pop(build_id, None)
+        self.to_compact.pop(build_id, None)
+        job = self.run_jobs[build_id] = JobRecord(build_id, task, data, reply_to)
+        self._notify(job)
+        self._prune()
         logger.info(f"Added run job for build_id: {build_id}")
 
     async def kill_run_job(self, build_id):
         """Kill a running job
 
+        Only marks the job as killed, stopping the build itself is up to
+        the runner of the job (see BuildWorkerPool.kill). A job that is
+        already over keeps its status.
+
         Args:
             build_id (str): ID of the build to kill
+
+        Returns:
+            bool: True if the job has been found
         """
-        if build_id in self.run_jobs:
-            self.run_jobs[build_id]["status"] = "killed"
-            self.run_jobs[build_id]["states"].append("killed")
-            self.run_jobs[build_id]["events"]["killed"].set()
+        job = self.run_jobs.get(build_id)
+        if job is not None and job.status in self.final_states:
+            logger.info(f"Run job for build_id: {build_id} is already {job.status}, not killing it")
+            return True
+        if job is not None and not job.compacted:
+            self._set_status(job, "killed")
+            self._notify(job)
             await self._execute_hooks(build_id, "killed")
             logger.info(f"Killed run job for build_id: {build_id}")
-            await self.run_jobs[build_id].task.cancel()
+            if isinstance(job.task, asyncio.Task):
+                job.task.cancel()
+            # only once the hooks had the whole job
+            self._prune()
+            return True
         else:
             logger.error(f"Run job for build_id: {build_id} not found")
+            return False
 
     def get_run_jobs_state(self, build_id):
         """Get the state of a running job
 
         Args:
             build_id (str): ID of the build to get the state for
-        
+
         Returns:
-            dict: State of the run job if found, else None
+            JobRecord: State of the run job if found, else None
         """
         if build_id in self.run_jobs:
             return self.run_jobs[build_id]
@@ -80,15 +156,25 @@ class StateManager:
         Returns:
             asyncio.Event: Event associated with the state if found, else None
         """
-        if build_id in self.run_jobs and state in self.run_jobs[build_id]["events"]:
-            return self.run_jobs[build_id]["events"][state]
+        job = self.run_jobs.get(build_id)
+        if job is not None and not job.compacted and state in self.build_states:
+            if job.events is None:
+                job.events = {}
+            if state not in job.events:
+                job.events[state] = asyncio.Event()
+                if state in job.states:
+                    job.events[state].set()
+            return job.events[state]
         else:
             logger.error(f"Event for state: {state} in build_id: {build_id} not found")
             return None
-        
+
     async def update_state(self, build_id, new_state):
         """Update the state of a run job
 
+        A job that is over (see final_states) keeps its status, so a late
+        update from its runner can't replace e.g. superseded or killed.
+
         Args:
             build_id (str): ID of the build
             new_state (str): New state to update to
@@ -96,17 +182,64 @@ class StateManager:
         Returns:
             bool: True if state updated successfully, else False
         """
-        if build_id in self.run_jobs and new_state in self.build_states:
-            self.run_jobs[build_id]["status"] = new_state
-            self.run_jobs[build_id]["states"].append(new_state)
-            self.run_jobs[build_id]["events"][new_state].set()
+        job = self.run_jobs.get(build_id)
+        if job is not None and job.status in self.final_states:
+            logger.info(f"Not updating state to {new_state} for build_id: {build_id}, it is already {job.status}")
+            return False
+        if job is not None and not job.compacted and new_state in self.build_states:
+            self._set_status(job, new_state)
+            self._notify(job)
             await self._execute_hooks(build_id, new_state)
             logger.info(f"Updated state to {new_state} for build_id: {build_id}")
+            # only once the hooks had the whole job
+            self._prune()
             return True
         else:
             logger.error(f"Failed to update state to {new_state} for build_id: {build_id}")
             return False
 
+    def _set_status(self, job, status):
+        job.status = status
+        job.states.append(status)
+        if job.events is not None and status in job.events:
+            job.events[status].set()
+        if status in self.final_states:
+            job.finished_at = time.time()
+            self.over[job.build_id] = None
+            self.over.move_to_end(job.build_id)
+            self.to_compact[job.build_id] = None
+            self.to_compact.move_to_end(job.build_id)
+        else:
+            self.over.pop(job.build_id, None)
+            self.to_compact.pop(job.build_id, None)
+
+    def update_stage(self, build_id, stage, stage_state):
+        """Update the current stage of a run job
+
+        Args:
+            build_id (str): ID of the build
+            stage (str): ID of the stage
+            stage_state (str): state of the stage (start, success, skipped, ...)
+
+        Returns:
+            bool: True if stage updated successfully, else False
+        """
+        job = self.run_jobs.get(build_id)
+        if job is None or job.compacted:
+            logger.error(f"Failed to update stage {stage} for build_id: {build_id}")
+            return False
+        now = time.time()
+        stage_info = job.stages.setdefault(stage, [None, None, None])
+        stage_info[0] = stage_state
+        if stage_state == "start":
+            stage_info[1] = now
+            job.stage = stage
+        else:
+            stage_info[2] = now
+        self._notify(job)
+        logger.debug(f"Updated stage {stage} to {stage_state} for build_id: {build_id}")
+        return True
+
     def register_hook(self, build_id, state, hook_fn):
         """Register a hook for a specific state of a run job
 
@@ -115,8 +248,11 @@ class StateManager:
             state (str): State to register the hook for
             hook_fn (callable): Function to call when the state is reached
         """
-        if build_id in self.run_jobs and state in self.run_jobs[build_id]["hooks"]:
-            self.run_jobs[build_id]["hooks"][state].append(hook_fn)
+        job = self.run_jobs.get(build_id)
+        if job is not None and not job.compacted and state in self.build_states:
+            if job.hooks is None:
+                job.hooks = {}
+            job.hooks.setdefault(state, []).append(hook_fn)
             logger.info(f"Registered hook for state: {state} for build_id: {build_id}")
         else:
             logger.error(f"State: {state} or build_id: {build_id} not found for hook registration")
@@ -128,15 +264,99 @@ class StateManager:
             build_id (str): ID of the build
             state (str): State to execute hooks for
         """
-        if build_id in self.run_jobs and state in self.run_jobs[build_id]["hooks"]:
-            for hook_fn in self.run_jobs[build_id]["hooks"][state]:
-                if asyncio.iscoroutinefunction(hook_fn):
-                    await hook_fn(build_id)
-                else:
-                    hook_fn(build_id)
-            logger.info(f"Executed hooks for state: {state} for build_id: {build_id}")
-        else:
+        job = self.run_jobs.get(build_id)
+        if job is None or state not in self.build_states:
             logger.error(f"State: {state} or build_id: {build_id} not found for hook execution")
-            
+            return
+        hooks = job.hooks.get(state, []) if job.hooks is not None else []
+        for hook_fn in hooks:
+            if asyncio.iscoroutinefunction(hook_fn):
+                await hook_fn(build_id)
+            else:
+                hook_fn(build_id)
+        if hooks:
+            logger.info(f"Executed hooks for state: {state} for build_id: {build_id}")
+
+    def _prune(self):
+        # compact the jobs over for compact_after seconds, then drop the
+        # oldest ones beyond max_jobs
+        deadline = time.time() - self.compact_after
+        while self.to_compact:
+            build_id = next(iter(self.to_compact))
+            job = self.run_jobs.get(build_id)
+            if job is not None and job.finished_at > deadline:
+                break
+            del self.to_compact[build_id]
+            if job is not None:
+                job.compact()
+        while len(self.run_jobs) > self.max_jobs and self.over:
+            build_id, _ = self.over.popitem(last=False)
+            self.to_compact.pop(build_id, None)
+            self.run_jobs.pop(build_id, None)
+            logger.debug(f"Dropped run job for build_id: {build_id}")
+
+    def add_listener(self, listener_fn):
+        """Register a function called with the build_id of every job whose state or stage changed
+
+        Args:
+            listener_fn (callable): function taking a build_id, must not block
+        """
+        self.listeners.append(listener_fn)
+
+    def remove_listener(self, listener_fn):
+        if listener_fn in self.listeners:
+            self.listeners.remove(listener_fn)
+
+    def restore(self):
+        """Rebuild the jobs from the store, after a restart
+
+        Jobs that were not over are marked as orphaned and keep their
+        request data, so they can be requeued.
+
+        Returns:
+            list[JobRecord]: the orphaned jobs
+        """
+        orphaned = []
+        now = time.time()
+        for row in reversed(self.store.load(self.max_jobs, self.final_states)):
+            job = JobRecord(row["build_id"], None, row["data"] or {}, row["reply_to"])
+            job.team_name = row["team_name"]
+            job.image = row["image"]
+            job.status = row["status"]
+            job.created_at = row["created_at"]
+            job.finished_at = row["finished_at"]
+            job.stage = row["stage"]
+            job.stages = row["stages"]
+            self.run_jobs[job.build_id] = job
+            self.over[job.build_id] = None
+            if job.status in self.final_states:
+                job.compact()
+            else:
+                job.status = "orphaned"
+                job.states = ["orphaned"]
+                job.finished_at = now
+                self.to_compact[job.build_id] = None
+                orphaned.append(job)
+                self._notify(job)
+        logger.info(f"Restored {len(self.run_jobs)} run jobs, {len(orphaned)} orphaned")
+        return orphaned
+
+    def _save(self, job):
+        # from the record itself, the job may be dropped right after
+        self.store.save((
+            job.build_id, job.team_name, job.image, job.status, job.created_at, job.finished_at,
+            job.stage, {stage: list(info) for stage, info in job.stages.items()}, job.data, job.reply_to,
+        ))
+
+    def _notify(self, job):
+        if self.store is not None:
+            self._save(job)
+        for listener_fn in list(self.listeners):
+            try:
+                listener_fn(job.build_id)
+            except Exception as e:
+                logger.error(f"State listener failed for build_id: {job.build_id}: {e}")
+
     def get_all_jobs(self):
-        return self.run_jobs
\ No newline at end of file
+        self._prune()
+        return self.run_jobs
@@ -1,6 +1,101 @@
+import asyncio
+import collections
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import urllib3
 from minio import Minio
+from src.logger import get_logger
+
+logger = get_logger(__name__)
+
+READ_SIZE = 1024 * 1024
+
+
+class RangedObjectReader:
+    """Read-only file-like object fetching an object in parallel byte ranges
+
+    Up to `fanout` ranges of `chunk_size` bytes are fetched ahead on the
+    storage executor while the consumer reads them in order, so memory stays
+    bounded by fanout * chunk_size. A range that fails half way is resumed
+    from the last byte received.
+    """
+
+    def __init__(self, client, bucket_name, object_name, size, etag=None,
+                 chunk_size=8 * 1024 * 1024, fanout=4, retries=3):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.object_name = object_name
+        self.etag = etag
+        self.retries = retries
+        self.ranges = collections.deque(
+            (offset, min(chunk_size, size - offset))
+            for offset in range(0, size, chunk_size)
+        )
+        self.fanout = fanout
+        self.inflight = collections.deque()
+        self.buffer = memoryview(b"")
+        self.closed = False
+
+    def _fill(self):
+        executor, _ = MinioClient._shared()
+        while self.ranges and len(self.inflight) < self.fanout:
+            offset, length = self.ranges.popleft()
+            self.inflight.append(executor.submit(self._fetch, offset, length))
+
+    def _fetch(self, offset, length):
+        data = bytearray()
+        self.client._fetch_range(
+            self.bucket_name, self.object_name, offset, length, data.extend,
+            etag=self.etag, retries=self.retries
+        )
+        return data
+
+    def read(self, n=-1):
+        if self.closed:
+            raise ValueError("I/O operation on closed reader")
+        if not self.buffer:
+            self._fill()
+            if not self.inflight:
+                return b""
+            self.buffer = memoryview(self.inflight.popleft().result())
+            self._fill()
+        if n is None or n < 0:
+            n = len(self.buffer)
+        out = self.buffer[:n].tobytes()
+        self.buffer = self.buffer[n:]
+        return out
+
+    def close(self):
+        self.closed = True
+        for future in self.inflight:
+            future.cancel()
+        self.inflight.clear()
+        self.ranges.clear()
+
+    def release_conn(self):
+        # connections are released by every range fetch, kept for
+        # compatibility with the urllib3 response returned by get_object
+        pass
+
 
 class MinioClient:
+    # the minio SDK is blocking, so every call runs on a bounded executor
+    # shared by all the clients of the process, over a shared connection pool
+    max_workers = 8
+    max_connections = 16
+    # objects of at least range_threshold bytes are fetched in parallel
+    # ranges of range_chunk_size bytes, range_fanout at a time
+    range_threshold = 32 * 1024 * 1024
+    range_chunk_size = 8 * 1024 * 1024
+    range_fanout = 4
+    _executor = None
+    _http_client = None
+    _shared_pid = None
+
     def __init__(self, endpoint, access_key, secret_key, secure=True):
         self.endpoint = endpoint
         self.access_key = access_key
@@ -8,34 +103,97 @@ class MinioClient:
         self.secure = secure
         self.client = None
 
+    @classmethod
+    def configure_pool(cls, max_workers=None, max_connections=None,
+                       range_threshold=None, range_chunk_size=None, range_fanout=None):
+        """Tune the executor and connection pool shared by all storage clients
+
+        Must be called before the first client connects.
+
+        Args:
+            max_workers (int, optional): maximum number of blocking storage calls running at once
+            max_connections (int, optional): maximum number of pooled connections per endpoint
+            range_threshold (int, optional): minimum object size downloaded in ranges
+            range_chunk_size (int, optional): size of a range
+            range_fanout (int, optional): number of ranges fetched at once per download
+        """
+        if max_workers is not None:
+            cls.max_workers = max_workers
+        if max_connections is not None:
+            cls.max_connections = max_connections
+        if range_threshold is not None:
+            cls.range_threshold = range_threshold
+        if range_chunk_size is not None:
+            cls.range_chunk_size = range_chunk_size
+        if range_fanout is not None:
+            cls.range_fanout = range_fanout
+
+    @classmethod
+    def _shared(cls):
+        # executors and connection pools don't survive a fork, so every
+        # process creates its own
+        if cls._shared_pid != os.getpid():
+            cls._executor = ThreadPoolExecutor(
+                max_workers=cls.max_workers,
+                thread_name_prefix="storage"
+            )
+            cls._http_client = urllib3.PoolManager(
+                num_pools=10,
+                maxsize=cls.max_connections,
+                block=True,
+                timeout=urllib3.Timeout(connect=10, read=300),
+                retries=urllib3.Retry(total=3, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504]),
+            )
+            cls._shared_pid = os.getpid()
+        return cls._executor, cls._http_client
+
     def connect(self):
+        _, http_client = self._shared()
         self.client = Minio(
             self.endpoint,
             access_key=self.access_key,
             secret_key=self.secret_key,
-            secure=self.secure
+            secure=self.secure,
+            http_client=http_client
         )
-        
+
+    async def _run(self, fn, *args, **kwargs):
+        if not self.client:
+            self.connect()
+        executor, _ = self._shared()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, partial(fn, *args, **kwargs))
+
     async def close(self):
         # Minio client does not need explicit closure for the connection
-        pass  
-        
-    async def put_object(self, bucket_name, object_name, data, length, content_type="application/octet-stream"):
+        pass
+
+    async def put_object(self, bucket_name, object_name, data, length, content_type="application/octet-stream", part_size=0):
         if not self.client:
             self.connect()
-            
-        self.client.put_object(bucket_name, object_name, data, length, content_type=content_type)
-        
+
+        await self._run(
+            self.client.put_object, bucket_name, object_name, data, length,
+            content_type=content_type, part_size=part_size, num_parallel_uploads=1
+        )
+
+    async def ensure_bucket(self, bucket_name):
+        if not self.client:
+            self.connect()
+
+        if not await self._run(self.client.bucket_exists, bucket_name):
+            await self._run(self.client.make_bucket, bucket_name)
+
     async def get_object(self, bucket_name, object_name):
         if not self.client:
             self.connect()
-            
-        return self.client.get_object(bucket_name, object_name)
-    
+
+        return await self._run(self.client.get_object, bucket_name, object_name)
+
     async def upload_file(
-        self, 
-        bucket_name, 
-        object_name, 
+        self,
+        bucket_name,
+        object_name,
         file_path
     ):
         """Upload an file to the minio storage
@@ -47,21 +205,21 @@ class MinioClient:
         """
         if not self.client:
             self.connect()
-            
-        if not self.client.bucket_exists(bucket_name):
-            self.client.make_bucket(bucket_name)
-        self.client.fput_object(bucket_name, object_name, file_path)
-        
+
+        await self.ensure_bucket(bucket_name)
+        await self._run(self.client.fput_object, bucket_name, object_name, file_path)
+
     async def has_object(self, bucket_name, object_name):
         if not self.client:
             self.connect()
-            
-        return self.client.bucket_exists(bucket_name) and self.client.stat_object(bucket_name, object_name)
-    
+
+        return await self._run(self.client.bucket_exists, bucket_name) and \
+            await self._run(self.client.stat_object, bucket_name, object_name)
+
     async def download_file(
-        self, 
-        bucket_name, 
-        object_name, 
+        self,
+        bucket_name,
+        object_name,
         file_path
     ):
         """Download an file to the minio storage
@@ -73,4 +231,147 @@ class MinioClient:
         """
         if not self.client:
             self.connect()
-        self.client.fget_object(bucket_name, object_name, file_path)
\ No newline at end of file
+        await self._run(self.client.fget_object, bucket_name, object_name, file_path)
+
+    def _fetch_range(self, bucket_name, object_name, offset, length, write, etag=None, retries=3):
+        """Fetch a byte range of an object, resuming it after failures
+
+        Blocking, runs on the storage executor.
+
+        Args:
+            write (callable): called with every chunk received, in order
+            etag (str, optional): fail instead of mixing bytes of another version of the object
+        """
+        received = 0
+        headers = {"If-Match": etag} if etag else None
+        for attempt in range(retries + 1):
+            response = None
+            try:
+                response = self.client.get_object(
+                    bucket_name, object_name,
+                    offset=offset + received,
+                    length=length - received,
+                    request_headers=headers
+                )
+                for chunk in response.stream(READ_SIZE):
+                    write(chunk)
+                    received += len(chunk)
+                if received != length:
+                    raise IOError(f"range {offset}+{length} ended after {received} bytes")
+                return None
+            except Exception as e:
+                if attempt == retries:
+                    raise
+                logger.warning(f"Resuming range {offset}+{length} of {object_name} at {received}: {e}")
+            finally:
+                if response is not None:
+                    response.close()
+                    response.release_conn()
+
+    def open_object_ranged(self, bucket_name, object_name, size, etag=None):
+        """Open an object for reading, fetching it in parallel ranges
+
+        Args:
+            bucket_name (str): name of the minio bucket
+            object_name (str): name of the file
+            size (int): size of the object, from stat_object
+            etag (str, optional): ETag of the object, from stat_object
+
+        Returns:
+            RangedObjectReader: blocking file-like object to read from a thread
+        """
+        if not self.client:
+            self.connect()
+        return RangedObjectReader(
+            self, bucket_name, object_name, size, etag,
+            chunk_size=self.range_chunk_size, fanout=self.range_fanout
+        )
+
+    async def download_file_ranged(
+        self,
+        bucket_name,
+        object_name,
+        file_path,
+        size,
+        etag=None
+    ):
+        """Download an file from the minio storage in parallel byte ranges
+
+        The ranges are written in place into `<file_path>.part`, and the
+        progress of every range is kept in `<file_path>.part.json`, so a
+        download interrupted by a crash resumes where it stopped as long as
+        the object (ETag) did not change.
+
+        Args:
+            bucket_name (str): name of the minio bucket you want to download your file
+            object_name (str): name of the file
+            file_path (str): os path of the downloaded file you want to store
+            size (int): size of the object, from stat_object
+            etag (str, optional): ETag of the object, from stat_object
+        """
+        if not self.client:
+            self.connect()
+        part_path = f"{file_path}.part"
+        state_path = f"{file_path}.part.json"
+        chunk_size = self.range_chunk_size
+
+        state = {"etag": etag, "size": size, "chunk_size": chunk_size, "received": {}}
+        try:
+            with open(state_path) as f:
+                saved = json.load(f)
+            if all(saved.get(key) == state[key] for key in ("etag", "size", "chunk_size")) \
+                    and os.path.exists(part_path):
+                state = saved
+                logger.info(f"Resuming download of {object_name}")
+        except (FileNotFoundError, ValueError):
+            pass
+
+        lock = threading.Lock()
+
+        def save_state():
+            with lock:
+                with open(state_path, "w") as f:
+                    json.dump(state, f)
+
+        ranges = [(offset, min(chunk_size, size - offset)) for offset in range(0, size, chunk_size)]
+        for offset, _ in ranges:
+            state["received"].setdefault(str(offset), 0)
+
+        mode = "r+b" if os.path.exists(part_path) and any(state["received"].values()) else "wb"
+        with open(part_path, mode) as f:
+            f.truncate(size)
+            fd = f.fileno()
+            semaphore = asyncio.Semaphore(self.range_fanout)
+
+            async def fetch(offset, length):
+                key = str(offset)
+                done = state["received"].get(key, 0)
+                if done >= length:
+                    return
+                position = [offset + done]
+
+                def write(chunk):
+                    os.pwrite(fd, chunk, position[0])
+                    position[0] += len(chunk)
+                    state["received"][key] = position[0] - offset
+
+                async with semaphore:
+                    try:
+                        await self._run(
+                            self._fetch_range, bucket_name, object_name,
+                            offset + done, length - done, write, etag=etag
+                        )
+                    finally:
+                        await asyncio.to_thread(save_state)
+
+            # let every range settle before the file is closed
+            results = await asyncio.gather(
+                *[fetch(offset, length) for offset, length in ranges],
+                return_exceptions=True
+            )
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
+
+        os.replace(part_path, file_path)
+        os.unlink(state_path)
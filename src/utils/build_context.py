@@ -0,0 +1,142 @@
+import os
+import tarfile
+import threading
+from src.logger import get_logger
+
+logger = get_logger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+# files that must never reach the docker build context from a team archive
+DROPPED_FILES = ["Dockerfile", ".dockerignore"]
+
+
+def _split_member_name(name):
+    """Split a member name into its top level folder and the rest of the path"""
+    name = name.lstrip("/")
+    while name.startswith("./"):
+        name = name[2:]
+    name = name.rstrip("/")
+    if "/" not in name:
+        return name, ""
+    top, rest = name.split("/", 1)
+    return top, rest
+
+
+def validate_team_archive(archive_path, team_name, required_files=("start",)):
+    """Check the members of a team archive without extracting it
+
+    Args:
+        archive_path (str): path of the team .tar.gz
+        team_name (str): expected name of the single top level folder
+        required_files (tuple, optional): files that must exist in the team folder
+
+    Returns:
+        tuple[list, list]: errors found and embedded docker files that will be dropped
+    """
+    folders = set()
+    files = set()
+    dropped = []
+    with tarfile.open(archive_path, mode="r|*") as tar:
+        for member in tar:
+            top, rest = _split_member_name(member.name)
+            if top in ("", "."):
+                continue
+            if rest == "" and not member.isdir():
+                if top in DROPPED_FILES:
+                    dropped.append(top)
+                continue
+            folders.add(top)
+            if top == team_name:
+                if rest in DROPPED_FILES:
+                    dropped.append(f"{top}/{rest}")
+                files.add(rest)
+
+    errors = []
+    if len(folders) != 1:
+        errors.append("There should be only one folder in the extracted folder")
+    elif team_name not in folders:
+        errors.append(f"Teamname and extracted folder {next(iter(folders))} name do not match")
+    else:
+        not_found_files = [f for f in required_files if f not in files]
+        if len(not_found_files) > 0:
+            errors.append(f"Required files not found: {not_found_files}")
+    return errors, dropped
+
+
+class TeamContextStream:
+    """Docker build context generated on the fly from a team archive
+
+    Members of `<team_name>/...` are renamed to `bin/...`, embedded
+    Dockerfile/.dockerignore files are dropped, `start` is made executable and
+    the given Dockerfile is injected at the root of the context. The resulting
+    tar is written into a pipe by a producer thread and handed out in chunks,
+    so it can be passed as a custom context to `APIClient.build` and never
+    exists as a whole in memory or on disk.
+    """
+
+    def __init__(self, archive_path, team_name, dockerfile_path, chunk_size=CHUNK_SIZE):
+        self.archive_path = archive_path
+        self.team_name = team_name
+        self.dockerfile_path = dockerfile_path
+        self.chunk_size = chunk_size
+        self.dropped = []
+        self.error = None
+
+    def _rewrite_member(self, member):
+        top, rest = _split_member_name(member.name)
+        if top != self.team_name:
+            return None
+        if rest in DROPPED_FILES:
+            self.dropped.append(member.name)
+            return None
+
+        member.name = f"bin/{rest}" if rest else "bin"
+        if member.islnk():
+            link_top, link_rest = _split_member_name(member.linkname)
+            if link_top != self.team_name:
+                return None
+            member.linkname = f"bin/{link_rest}"
+        if rest == "start" and member.isfile():
+            member.mode = 0o755
+        return member
+
+    def _produce(self, write_fd):
+        try:
+            with os.fdopen(write_fd, "wb") as out, \
+                    tarfile.open(self.archive_path, mode="r|*") as src, \
+                    tarfile.open(fileobj=out, mode="w|") as dst:
+                with open(self.dockerfile_path, "rb") as dockerfile:
+                    info = tarfile.TarInfo("Dockerfile")
+                    info.size = os.fstat(dockerfile.fileno()).st_size
+                    info.mode = 0o644
+                    dst.addfile(info, dockerfile)
+                for member in src:
+                    member = self._rewrite_member(member)
+                    if member is None:
+                        continue
+                    if member.isfile():
+                        dst.addfile(member, src.extractfile(member))
+                    else:
+                        dst.addfile(member)
+        except BrokenPipeError:
+            logger.debug("Build context consumer went away")
+        except Exception as e:
+            logger.error(f"Failed to generate build context: {e}")
+            self.error = e
+
+    def __iter__(self):
+        read_fd, write_fd = os.pipe()
+        producer = threading.Thread(target=self._produce, args=(write_fd,), daemon=True)
+        producer.start()
+        try:
+            with os.fdopen(read_fd, "rb") as src:
+                while True:
+                    chunk = src.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+        finally:
+            producer.join()
+        if self.error is not None:
+            raise self.error
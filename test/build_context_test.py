@@ -0,0 +1,80 @@
+import io
+import os
+import tarfile
+import tempfile
+from src.logger import get_logger
+from src.utils.build_context import TeamContextStream, validate_team_archive
+
+logger = get_logger(__name__)
+
+# streams the build context of a team archive and reads it back: python test.py build_context_test
+
+
+def add_file(tar, name, content=b"", mode=0o644):
+    info = tarfile.TarInfo(name)
+    info.size = len(content)
+    info.mode = mode
+    tar.addfile(info, io.BytesIO(content))
+
+
+def add_link(tar, name, linkname):
+    info = tarfile.TarInfo(name)
+    info.type = tarfile.LNKTYPE
+    info.linkname = linkname
+    tar.addfile(info)
+
+
+def team_archive(folder, team_name):
+    path = os.path.join(folder, f"{team_name}.tar.gz")
+    with tarfile.open(path, "w:gz") as tar:
+        info = tarfile.TarInfo(f"./{team_name}")
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+        tar.addfile(info)
+        add_file(tar, f"./{team_name}/start", b"#!/bin/sh\n")
+        add_file(tar, f"./{team_name}/Dockerfile", b"FROM scratch\n")
+        add_file(tar, f"./{team_name}/lib/player.so", b"\x7fELF")
+        add_file(tar, f"./{team_name}/lib/.dockerignore", b"*\n")
+        add_link(tar, f"./{team_name}/lib/player2.so", f"./{team_name}/lib/player.so")
+    return path
+
+
+async def run():
+    folder = tempfile.mkdtemp()
+    archive_path = team_archive(folder, "cyrus2d")
+    dockerfile_path = os.path.join(folder, "Dockerfile")
+    with open(dockerfile_path, "wb") as dockerfile:
+        dockerfile.write(b"FROM base\nCOPY bin /home/bin\n")
+
+    errors, dropped = validate_team_archive(archive_path, "cyrus2d")
+    assert errors == [], errors
+    assert dropped == ["cyrus2d/Dockerfile"], dropped
+    errors, _ = validate_team_archive(archive_path, "helios")
+    assert len(errors) == 1, errors
+
+    # small chunks, so the context comes out in many of them
+    stream = TeamContextStream(archive_path, "cyrus2d", dockerfile_path, chunk_size=512)
+    chunks = list(stream)
+    assert len(chunks) > 1
+    assert stream.dropped == ["./cyrus2d/Dockerfile"], stream.dropped
+
+    with tarfile.open(fileobj=io.BytesIO(b"".join(chunks))) as tar:
+        members = {member.name: member for member in tar}
+        assert list(members) == ["Dockerfile", "bin", "bin/start", "bin/lib/player.so", "bin/lib/.dockerignore", "bin/lib/player2.so"], list(members)
+        # the injected Dockerfile, not the one of the team
+        assert tar.extractfile("Dockerfile").read() == b"FROM base\nCOPY bin /home/bin\n"
+        assert members["bin/start"].mode == 0o755
+        assert tar.extractfile("bin/lib/player.so").read() == b"\x7fELF"
+        assert members["bin/lib/player2.so"].islnk() and members["bin/lib/player2.so"].linkname == "bin/lib/player.so"
+
+    # a broken archive fails the stream
+    broken_path = os.path.join(folder, "broken.tar.gz")
+    with open(broken_path, "wb") as broken:
+        broken.write(b"not a tar")
+    try:
+        list(TeamContextStream(broken_path, "cyrus2d", dockerfile_path))
+    except tarfile.TarError:
+        pass
+    else:
+        raise AssertionError("broken archive streamed")
+    logger.info("build context OK")
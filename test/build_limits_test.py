@@ -0,0 +1,81 @@
+from src import env
+from src.build_limits import container_limits, stage_timeouts
+from src.logger import get_logger
+
+logger = get_logger(__name__)
+
+# checks the overrides of the stage deadlines and resource limits: python test.py build_limits_test
+
+SETTINGS = {
+    "STAGE_TIMEOUT_DOWNLOAD": 600,
+    "STAGE_TIMEOUT_EXTRACT": 300,
+    "STAGE_TIMEOUT_BUILD": 1800,
+    "STAGE_TIMEOUT_PUSH": 900,
+    "STAGE_TIMEOUT_MAX": 3600,
+    "BUILD_MEMORY": 2 * 1024 ** 3,
+    "BUILD_MEMORY_MAX": 4 * 1024 ** 3,
+    "BUILD_CPU_SHARES": 0,
+    "BUILD_CPU_SHARES_MAX": 0,
+    "BUILD_CPU_QUOTA": 100000,
+    "BUILD_CPU_QUOTA_MAX": 200000,
+    "BUILD_CPU_PERIOD": 100000,
+    "BUILD_CPUSET_CPUS": "",
+    "BUILD_CPUSET_CPUS_ALLOWED": "0-3",
+}
+
+
+def check_timeouts():
+    timeouts, warnings = stage_timeouts({})
+    assert timeouts == {"download": 600, "extract": 300, "build": 1800, "push": 900}, timeouts
+    assert warnings == []
+
+    timeouts, warnings = stage_timeouts({"timeouts": {"build": 7200, "push": "60", "extract": 0, "foo": 1, "download": True}})
+    assert timeouts == {"download": 600, "extract": 300, "build": 3600, "push": 60}, timeouts
+    assert len(warnings) == 4, warnings
+
+    timeouts, warnings = stage_timeouts({"timeouts": [60]})
+    assert timeouts["build"] == 1800 and len(warnings) == 1, warnings
+
+
+def check_limits():
+    limits, warnings = container_limits({})
+    assert limits == {
+        "memory": 2 * 1024 ** 3, "memswap": 2 * 1024 ** 3, "cpuquota": 100000, "cpuperiod": 100000,
+    }, limits
+    assert warnings == []
+
+    # clamped to the maximums, within the allowed cpus
+    limits, warnings = container_limits({"resources": {"memory": 8 * 1024 ** 3, "cpuquota": 150000, "cpusetcpus": "1-2"}})
+    assert limits == {
+        "memory": 4 * 1024 ** 3, "memswap": 4 * 1024 ** 3, "cpuquota": 150000, "cpuperiod": 100000, "cpusetcpus": "1-2",
+    }, limits
+    assert len(warnings) == 1, warnings
+
+    # invalid values, cpus not allowed and limits without a maximum keep the defaults
+    limits, warnings = container_limits({"resources": {"memory": -1, "cpuquota": "x", "cpushares": 512, "cpusetcpus": "2-5"}})
+    assert limits == {
+        "memory": 2 * 1024 ** 3, "memswap": 2 * 1024 ** 3, "cpuquota": 100000, "cpuperiod": 100000,
+    }, limits
+    assert len(warnings) == 4, warnings
+
+    limits, warnings = container_limits({"resources": {"cpusetcpus": ","}})
+    assert "cpusetcpus" not in limits and len(warnings) == 1, warnings
+    limits, warnings = container_limits({"resources": "all"})
+    assert limits["memory"] == 2 * 1024 ** 3 and len(warnings) == 1, warnings
+
+    env.BUILD_CPUSET_CPUS_ALLOWED = ""
+    limits, warnings = container_limits({"resources": {"cpusetcpus": "0"}})
+    assert "cpusetcpus" not in limits and warnings == ["cpusetcpus can't be overridden, using the default"], warnings
+
+
+async def run():
+    saved = {name: getattr(env, name) for name in SETTINGS}
+    for name, value in SETTINGS.items():
+        setattr(env, name, value)
+    try:
+        check_timeouts()
+        check_limits()
+    finally:
+        for name, value in saved.items():
+            setattr(env, name, value)
+    logger.info("build limits OK")
@@ -0,0 +1,89 @@
+import os
+import tempfile
+from src.job_store import JobStore
+from src.logger import get_logger
+from src.states import StateManager
+
+logger = get_logger(__name__)
+
+# persists jobs, restarts and checks what comes back: python test.py job_store_test
+
+
+def build_data(build_id, team_name):
+    return {
+        "build_id": build_id,
+        "team_name": team_name,
+        "image_name": team_name,
+        "image_tag": "latest",
+        "file": {"_type": "minio", "bucket": "test", "file_id": build_id},
+    }
+
+
+async def run():
+    path = os.path.join(tempfile.mkdtemp(), "jobs.sqlite")
+
+    # first run: two jobs over, one failed, two still running when it stops
+    store = JobStore(path)
+    store.open()
+    state_manager = StateManager(max_jobs=3, store=store)
+    for i, team_name in enumerate(["cyrus2d", "helios", "cyrus2d", "helios", "oxsy"]):
+        state_manager.add_run_job(str(i), None, build_data(str(i), team_name), reply_to=f"reply-{i}")
+    state_manager.update_stage("3", "team_build", "start")
+    await state_manager.update_state("0", "finished")
+    await state_manager.kill_run_job("1")
+    await state_manager.update_state("2", "failed")
+    await state_manager.update_state("3", "progress")
+    store.close()
+
+    # restart
+    store = JobStore(path)
+    store.open()
+    state_manager = StateManager(store=store)
+    orphaned = state_manager.restore()
+    jobs = state_manager.get_all_jobs()
+
+    assert {build_id: job.status for build_id, job in jobs.items()} == {
+        "0": "finished", "1": "killed", "2": "failed", "3": "orphaned", "4": "orphaned",
+    }, jobs
+    assert sorted(job.build_id for job in orphaned) == ["3", "4"]
+    for job in orphaned:
+        # requeued with their request and reply queue
+        assert job.data == build_data(job.build_id, job.team_name), job.data
+        assert job.reply_to == f"reply-{job.build_id}"
+    assert jobs["3"].stages["team_build"][0] == "start"
+    for build_id in ("0", "1", "2"):
+        assert jobs[build_id].compacted and jobs[build_id].finished_at is not None
+
+    # the orphaned status is written back
+    store.close()
+    store = JobStore(path)
+    store.open()
+
+    history = store.history(team_name="cyrus2d")
+    assert [job["build_id"] for job in history] == ["2", "0"], history
+    history = store.history(status="orphaned")
+    assert [job["build_id"] for job in history] == ["4", "3"], history
+    history = store.history(team_name="helios", status="killed")
+    assert [job["build_id"] for job in history] == ["1"], history
+    assert "data" not in history[0]
+    assert store.history(since=jobs["4"].created_at) == store.history(limit=1)
+
+    # a job still running older than the latest max_jobs is orphaned too
+    state_manager = StateManager(max_jobs=1, store=store)
+    state_manager.add_run_job("5", None, build_data("5", "oxsy"), reply_to="reply-5")
+    state_manager.add_run_job("6", None, build_data("6", "helios"), reply_to="reply-6")
+    await state_manager.update_state("5", "progress")
+    await state_manager.update_state("6", "finished")
+    store.close()
+    store = JobStore(path)
+    store.open()
+    state_manager = StateManager(max_jobs=1, store=store)
+    orphaned = state_manager.restore()
+    assert [job.build_id for job in orphaned] == ["5"], orphaned
+    assert orphaned[0].data == build_data("5", "oxsy")
+    store.close()
+    store = JobStore(path)
+    store.open()
+    assert store.history(status="orphaned", limit=1)[0]["build_id"] == "5"
+    store.close()
+    logger.info("job store OK")
@@ -0,0 +1,113 @@
+import asyncio
+import io
+import json
+import os
+import tarfile
+import tempfile
+from src.base_image import BaseImageManager
+from src.docker import Docker
+from src.logger import get_logger
+from src.oci import build_team_layer, parse_team_instructions, team_image
+from src.registry import RegistryClient, file_sender
+from src import env
+
+logger = get_logger(__name__)
+
+# compares the image assembled by the oci builder with the one the docker
+# daemon builds from the same archive: python test.py oci_build_test
+TEAM_NAME = "oci_test"
+IMAGE_TAG = "latest"
+
+
+def make_archive(path):
+    with tarfile.open(path, "w:gz") as tar:
+        for name, data, mode in [("start", b"#!/bin/bash\necho start\n", 0o644), ("lib/player.conf", b"x=1\n", 0o600)]:
+            info = tarfile.TarInfo(f"{TEAM_NAME}/{name}")
+            info.size = len(data)
+            info.mode = mode
+            tar.addfile(info, io.BytesIO(data))
+
+
+def image_files(docker, ref):
+    # files of the last layer of an image, as the daemon exports them
+    files = {}
+    with tempfile.TemporaryFile() as f:
+        for chunk in docker.client.images.get(ref).save():
+            f.write(chunk)
+        f.seek(0)
+        with tarfile.open(fileobj=f) as image:
+            manifest = json.load(image.extractfile("manifest.json"))[0]
+            layer = image.extractfile(manifest["Layers"][-1])
+            with tarfile.open(fileobj=layer, mode="r|*") as tar:
+                for member in tar:
+                    files[member.name.rstrip("/")] = (member.type, oct(member.mode), member.uid, member.size)
+    return files
+
+
+async def run():
+    registry = env.DOCKER_REGISTERY_ADDRESS + ":" + str(env.DOCKER_REGISTERY_PORT)
+    docker = Docker(
+        default_registry=registry,
+        username=env.DOCKER_REGISTERY_USERNAME,
+        password=env.DOCKER_REGISTERY_PASSWORD,
+    )
+    docker.connect()
+
+    folder = tempfile.mkdtemp()
+    archive_path = os.path.join(folder, f"{TEAM_NAME}.tar.gz")
+    make_archive(archive_path)
+
+    base_ref, dockerfile = BaseImageManager(docker, os.path.join(folder, "base.lock")).ensure(env.DEFAULT_TEAM_BUILD_DOCKERFILE)
+    logger.info(f"base image {base_ref}")
+
+    # daemon path
+    docker_folder = os.path.join(folder, "docker")
+    with tarfile.open(archive_path) as tar:
+        tar.extractall(docker_folder)
+    os.rename(os.path.join(docker_folder, TEAM_NAME), os.path.join(docker_folder, "bin"))
+    os.chmod(os.path.join(docker_folder, "bin", "start"), 0o755)
+    with open(os.path.join(docker_folder, "Dockerfile"), "w") as f:
+        f.write(dockerfile)
+    for line in docker.build_with_path(path=docker_folder, image_name="oci-test-daemon", image_tag=IMAGE_TAG, rm=True):
+        logger.debug(line)
+
+    # oci path
+    plan = parse_team_instructions(dockerfile)
+    layer_path = os.path.join(folder, "layer.tar.gz")
+    layer = build_team_layer(archive_path, TEAM_NAME, plan["dest"], layer_path)
+    base_name, base_tag = base_ref[len(registry) + 1:].rsplit(":", 1)
+    async with RegistryClient(registry, docker.username, docker.password) as client:
+        _, _, body = await client.get_manifest(base_name, base_tag)
+        base_manifest = json.loads(body)
+        base_config = await client.get_blob_json(base_name, base_manifest["config"]["digest"])
+        config, manifest, media_type = team_image(base_manifest, base_config, layer, plan)
+        for base_layer in base_manifest["layers"]:
+            await client.copy_blob(base_name, "oci-test", base_layer["digest"], base_layer["size"])
+        await client.push_blob("oci-test", layer["digest"], layer["size"], lambda: file_sender(layer_path))
+        await client.push_blob("oci-test", json.loads(manifest)["config"]["digest"], len(config), config)
+        await client.put_manifest("oci-test", IMAGE_TAG, manifest, media_type)
+    docker.api.pull(f"{registry}/oci-test", tag=IMAGE_TAG)
+
+    daemon_ref = f"{registry}/oci-test-daemon:{IMAGE_TAG}"
+    oci_ref = f"{registry}/oci-test:{IMAGE_TAG}"
+    differences = []
+    for key in ("User", "WorkingDir", "Cmd", "Env", "Entrypoint"):
+        daemon_value = docker.api.inspect_image(daemon_ref)["Config"].get(key)
+        oci_value = docker.api.inspect_image(oci_ref)["Config"].get(key)
+        logger.info(f"{key}: {'OK' if daemon_value == oci_value else 'DIFFERENT'} {daemon_value} / {oci_value}")
+        if daemon_value != oci_value:
+            differences.append(key)
+
+    daemon_files = image_files(docker, daemon_ref)
+    oci_files = image_files(docker, oci_ref)
+    for name in sorted(set(daemon_files) | set(oci_files)):
+        if daemon_files.get(name) != oci_files.get(name):
+            logger.info(f"{name}: DIFFERENT {daemon_files.get(name)} / {oci_files.get(name)}")
+            differences.append(name)
+
+    assert not differences, f"the oci image differs from the daemon image: {differences}"
+    logger.info("the oci image matches the daemon image")
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
@@ -0,0 +1,99 @@
+import asyncio
+import time
+from src.logger import get_logger
+from src.scheduler import BuildScheduler
+
+logger = get_logger(__name__)
+
+# orders builds of several tournaments and teams: python test.py scheduler_test
+
+
+def build_data(tournament_id, team_name, image_tag="latest", priority=None):
+    data = {
+        "tournament_id": tournament_id,
+        "team_name": team_name,
+        "image_name": team_name,
+        "image_tag": image_tag,
+    }
+    if priority is not None:
+        data["priority"] = priority
+    return data
+
+
+def pop_all(scheduler):
+    order = []
+    while (popped := scheduler.pop()) is not None:
+        order.append(popped[0])
+    return order
+
+
+async def run():
+    # a team uploading over and over only delays its own builds, the
+    # tournaments and then the teams take turns
+    scheduler = BuildScheduler(max_running=10)
+    for build_id, tournament_id, team_name in [
+        ("a1", 1, "cyrus2d"), ("a2", 1, "cyrus2d"), ("a3", 1, "cyrus2d"),
+        ("b1", 1, "helios"), ("c1", 2, "oxsy"), ("c2", 2, "oxsy"),
+    ]:
+        scheduler.push(build_id, build_data(tournament_id, team_name, build_id))
+    plan = scheduler.plan()
+    order = pop_all(scheduler)
+    assert order == ["a1", "c1", "b1", "c2", "a2", "a3"], order
+    assert sorted(plan, key=lambda build_id: plan[build_id][0]) == order, plan
+
+    # higher priorities first, whatever their turn
+    scheduler = BuildScheduler(max_running=10)
+    scheduler.push("low", build_data(1, "cyrus2d"))
+    scheduler.push("high", build_data(1, "helios", priority=5))
+    scheduler.push("invalid", build_data(1, "oxsy", priority="high"))
+    assert pop_all(scheduler) == ["high", "low", "invalid"]
+
+    # no more than max_running at once
+    scheduler = BuildScheduler(max_running=2)
+    for build_id in ("a", "b", "c"):
+        scheduler.push(build_id, build_data(1, build_id))
+    assert pop_all(scheduler) == ["a", "b"]
+    assert len(scheduler) == 1 and scheduler.pop() is None
+    scheduler.done("a")
+    assert pop_all(scheduler) == ["c"]
+
+    # the estimated starts account for how long the running builds have run
+    scheduler = BuildScheduler(max_running=2, default_duration=60)
+    for build_id in ("a", "b", "c", "d", "e"):
+        scheduler.push(build_id, build_data(1, build_id))
+    pop_all(scheduler)
+    now = time.time()
+    scheduler.running["a"] = now - 50
+    scheduler.running["b"] = now - 100
+    scheduler.max_running = 2  # drops the cached plan
+    waits = {build_id: round(start_at - now) for build_id, (_, start_at) in scheduler.plan().items()}
+    assert waits == {"c": 0, "d": 10, "e": 60}, waits
+    assert scheduler.plan() is scheduler.plan()
+
+    # a lowered max_running waits for enough running builds to finish
+    scheduler.max_running = 1
+    waits = {build_id: round(start_at - now) for build_id, (_, start_at) in scheduler.plan().items()}
+    assert waits == {"c": 10, "d": 70, "e": 130}, waits
+
+    # with a debounce window, the builds wait it out and the last build of
+    # an image supersedes the queued one
+    scheduler = BuildScheduler(max_running=10, debounce=0.2)
+    assert scheduler.push("a1", build_data(1, "cyrus2d", "v1")) == []
+    assert scheduler.push("b1", build_data(1, "helios")) == []
+    assert scheduler.push("a2", build_data(1, "cyrus2d", "v1")) == ["a1"]
+    assert scheduler.push("a3", build_data(1, "cyrus2d", "v2")) == []
+    assert len(scheduler) == 3
+    assert scheduler.pop() is None
+    assert 0 < scheduler.next_ready_in() <= 0.2
+    await asyncio.sleep(0.25)
+    assert scheduler.next_ready_in() is None
+    assert pop_all(scheduler) == ["b1", "a2", "a3"]
+
+    # the running build of the image is reported, for the preemption
+    assert scheduler.running_build(build_data(1, "cyrus2d", "v1")) == "a2"
+    assert scheduler.push("a4", build_data(1, "cyrus2d", "v1")) == []
+    scheduler.done("a2")
+    assert scheduler.running_build(build_data(1, "cyrus2d", "v1")) is None
+    assert not scheduler.remove("a1") and scheduler.remove("a4")
+    assert scheduler.push("a5", build_data(1, "cyrus2d", "v1")) == []
+    logger.info("scheduler OK")
@@ -0,0 +1,64 @@
+from src.logger import get_logger
+from src.stage_limits import StageLimits
+
+logger = get_logger(__name__)
+
+# grants and gives back the stage slots of several builds: python test.py stage_limits_test
+
+
+async def run():
+    stage_limits = StageLimits({"download": 2, "push": 1})
+    granted = []
+
+    def grant(build_id, stage_class):
+        return lambda: granted.append((build_id, stage_class))
+
+    # up to the limit at once, the others wait in line
+    for build_id in ("a", "b", "c", "d"):
+        stage_limits.acquire(build_id, "download", grant(build_id, "download"))
+    assert granted == [("a", "download"), ("b", "download")], granted
+    assert stage_limits.running["download"] == {"a", "b"}
+
+    # a class without a limit is granted right away
+    stage_limits.acquire("a", "build", grant("a", "build"))
+    assert granted[-1] == ("a", "build")
+
+    # a released slot goes to the first in line
+    stage_limits.release("a", "download")
+    assert granted[-1] == ("c", "download")
+    assert stage_limits.running["download"] == {"b", "c"}
+
+    # a dead worker gives back its slots and its place in line
+    stage_limits.acquire("c", "push", grant("c", "push"))
+    stage_limits.acquire("d", "push", grant("d", "push"))
+    stage_limits.release_all("c")
+    assert granted[-2:] == [("d", "download"), ("d", "push")], granted
+    assert stage_limits.running == {"download": {"b", "d"}, "push": {"d"}}
+
+    # a raised limit grants the builds in line
+    for build_id in ("e", "f"):
+        stage_limits.acquire(build_id, "download", grant(build_id, "download"))
+    stage_limits.set_limit("download", 3)
+    assert granted[-1] == ("e", "download")
+    assert list(waiter[0] for waiter in stage_limits.waiting["download"]) == ["f"]
+
+    # a grant that fails gives the slot back
+    stage_limits.acquire("g", "push", lambda: 1 / 0)
+    stage_limits.release("d", "push")
+    assert "g" not in stage_limits.running["push"]
+
+    # a limit below 1 would never grant a slot
+    for limits in ({"download": 0}, {"push": -1}):
+        try:
+            StageLimits(limits)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(f"{limits} accepted")
+    try:
+        stage_limits.set_limit("build", 0)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("limit 0 accepted")
+    logger.info("stage limits OK")